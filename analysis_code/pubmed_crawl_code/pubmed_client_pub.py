@@ -0,0 +1,310 @@
+# Name:     pubmed_client_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Runs the Pubmed crawl from pubmed_search_pub.ipynb (disease only,
+#   pathogen only and every disease-pathogen pair) as concurrent esearch
+#   queries instead of one Entrez.esearch call at a time.
+#
+#   Queries run in a thread pool, but every request first takes a slot from a
+#   shared rate limiter so we stay under NCBI's limit (10 requests/s with an
+#   API key, 3/s without). Rate limit (429), server (5xx) and connection
+#   errors are retried with exponential backoff.
+#
+#   Every response is kept in an on-disk cache, one JSON file per query named
+#   by the sha256 of the query string, so re-running (or picking back up after
+#   a crash) only sends the queries we don't already have. With --date the
+#   searches are also limited to records entered in Pubmed on or before that
+#   date and the date becomes part of the cache key, so the cached counts can
+#   be reproduced later. Without --date a cached response is reused no matter
+#   what day it was fetched, use a fresh --cache_dir to re-crawl from scratch.
+#
+#   --base_url points the client at another esearch endpoint, e.g. a local
+#   stand-in server for testing.
+#
+#   Writes the same three files as the notebook:
+#       dis_only_py_pubmed_search.tsv
+#       path_only_py_pubmed_search.tsv
+#       pairs_py_pubmed_search.tsv
+#
+#   Usage:
+#       export NCBI_API_KEY=xxxxxxxx NCBI_EMAIL=yyyy@zzzz.com
+#       python pubmed_client_pub.py --workers 8 --date 2020/08/11
+#
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from tqdm import tqdm
+
+HOME_DIR = "/data/pathogen_ncd"
+OUT_DIR = f"{HOME_DIR}/results/other"
+CACHE_DIR = f"{HOME_DIR}/results/other/pubmed_cache"
+
+ESEARCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+
+RETMAX = 100000
+
+# Requests per second NCBI allows with and without an API key
+RATE_WITH_KEY = 10
+RATE_NO_KEY = 3
+
+MAX_TRIES = 6
+BACKOFF_BASE = 0.5
+TIMEOUT = 60
+
+# Status codes worth trying again
+RETRY_CODES = {429, 500, 502, 503, 504}
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Hands out evenly spaced request slots across threads, each call blocks until
+# its slot comes up.
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+# The error NCBI hands back (sometimes with a 200) when we go too fast
+class RetryableError(Exception):
+    pass
+
+# Same queries the notebook builds
+def dis_query(dis):
+    return f"({dis})"
+
+def org_query(org_name, abbrev, mesh_id):
+    return f"(({org_name}) OR ({abbrev}) OR ({mesh_id}))"
+
+def pair_query(dis, org_name, abbrev, mesh_id):
+    return f"(({dis}) AND (({org_name}) OR ({abbrev}) OR ({mesh_id})))"
+
+# Cache file for a query, date is only part of the key when the search is
+# limited to that date (None otherwise)
+def cache_path(cache_dir, term, date = None):
+    key_str = term if date is None else f"{term}\t{date}"
+    key = hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    return f"{cache_dir}/{key[:2]}/{key}.json"
+
+def read_cache(cache_fn):
+    if not os.path.exists(cache_fn):
+        return None
+
+    with open(cache_fn, 'r') as in_file:
+        return json.load(in_file)
+
+def write_cache(cache_fn, entry):
+    os.makedirs(os.path.dirname(cache_fn), exist_ok = True)
+
+    tmp_fn = f"{cache_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_fn, 'w') as out_file:
+        json.dump(entry, out_file)
+
+    os.replace(tmp_fn, cache_fn)
+
+# Pull count, translated query and PMIDs out of an esearch JSON response
+def parse_esearch(body):
+    res = json.loads(body)
+
+    if 'error' in res:
+        raise RetryableError(res['error'])
+
+    res = res['esearchresult']
+    if 'ERROR' in res:
+        raise ValueError(f"esearch error: {res['ERROR']}")
+
+    return {'count'   : int(res['count']),
+            'query'   : res.get('querytranslation'),
+            'PMIDs'   : res.get('idlist', [])}
+
+class PubmedClient:
+    def __init__(self, api_key = None, email = None, base_url = ESEARCH_URL,
+                 cache_dir = CACHE_DIR, date = None, restrict_date = False,
+                 rate = None):
+        self.api_key = api_key
+        self.email = email
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.date = date if date else datetime.date.today().strftime('%Y/%m/%d')
+        self.restrict_date = restrict_date
+
+        if rate is None:
+            rate = RATE_WITH_KEY if api_key else RATE_NO_KEY
+        self.limiter = RateLimiter(rate)
+
+    def build_url(self, term):
+        params = {'db'      : 'pubmed',
+                  'term'    : term,
+                  'retmax'  : RETMAX,
+                  'retmode' : 'json'}
+
+        if self.restrict_date:
+            params.update({'datetype' : 'edat', 'mindate' : '1000/01/01',
+                           'maxdate' : self.date})
+        if self.api_key:
+            params['api_key'] = self.api_key
+        if self.email:
+            params['email'] = self.email
+
+        return f"{self.base_url}?{urllib.parse.urlencode(params)}"
+
+    # One esearch request, retrying with backoff on rate limit, server and
+    # connection errors.
+    def fetch(self, term):
+        url = self.build_url(term)
+
+        for curr_try in range(MAX_TRIES):
+            self.limiter.wait()
+
+            try:
+                with urllib.request.urlopen(url, timeout = TIMEOUT) as resp:
+                    body = resp.read().decode('utf-8')
+
+                return body, parse_esearch(body)
+
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRY_CODES:
+                    raise
+                err = e
+            except (urllib.error.URLError, TimeoutError, ConnectionError, RetryableError) as e:
+                err = e
+
+            if curr_try < MAX_TRIES - 1:
+                time.sleep(BACKOFF_BASE * (2 ** curr_try) * (1 + random.random()))
+
+        raise RuntimeError(f"esearch failed after {MAX_TRIES} tries for {term}: {err}")
+
+    # Search a single query, from the cache when we already have it (for this
+    # date if we are restricting to it).
+    def search(self, term):
+        cache_fn = cache_path(self.cache_dir, term,
+                              self.date if self.restrict_date else None)
+
+        entry = read_cache(cache_fn)
+        if entry is not None:
+            return parse_esearch(entry['body'])
+
+        body, res = self.fetch(term)
+        write_cache(cache_fn, {'term' : term, 'date' : self.date, 'body' : body})
+
+        return res
+
+    # Search many queries at once, results come back in the order given.
+    def search_many(self, terms, workers = 8):
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            return list(tqdm(pool.map(self.search, terms), total = len(terms)))
+
+# Diseases (with square brackets stripped, esearch drops them from the query)
+# and pathogens to search for
+def load_terms(home_dir = HOME_DIR):
+    dis_ab = pd.read_csv(f"{home_dir}/misc/a_and_b_disease_data.txt",
+                         sep = '\t', encoding = "ISO-8859-1")
+
+    dis_other = pd.read_csv(f"{home_dir}/misc/all_other_disease_data.txt",
+                            sep = '\t', encoding = "ISO-8859-1")
+
+    orgs = pd.read_csv(f"{home_dir}/misc/org_data.txt",
+                       sep = '\t', encoding = "ISO-8859-1")
+
+    dis = pd.concat([dis_ab, dis_other], ignore_index = True)
+    dis['disease'] = dis['disease'].str.replace(r'\[|\]', " ", regex = True)
+
+    return dis, orgs
+
+# Run all three searches, returning the same tables the notebook made
+def crawl(client, dis, orgs, workers = 8):
+    dis_terms = [dis_query(x) for x in dis['disease']]
+    org_terms = [org_query(x.org_name, x.abbrev, x.mesh_id) for x in orgs.itertuples()]
+
+    pair_rows = [(x, y) for x in dis.itertuples() for y in orgs.itertuples()]
+    pair_terms = [pair_query(x.disease, y.org_name, y.abbrev, y.mesh_id) for x, y in pair_rows]
+
+    print(f"{len(dis_terms):,} disease, {len(org_terms):,} pathogen and "
+          f"{len(pair_terms):,} pair queries")
+
+    dis_res = client.search_many(dis_terms, workers)
+    dis_res_df = pd.DataFrame({'Disease'  : dis['disease'],
+                               'icd'      : dis['icd'],
+                               'icd_cat'  : dis['icd_cat'],
+                               'icd_site' : dis['icd_site'].apply(str).str.zfill(2),
+                               'count'    : [x['count'] for x in dis_res],
+                               'query'    : [x['query'] for x in dis_res],
+                               'PMIDs'    : [x['PMIDs'] for x in dis_res]})
+
+    org_res = client.search_many(org_terms, workers)
+    org_res_df = pd.DataFrame({'org_name' : orgs['org_name'],
+                               'abbrev'   : orgs['abbrev'],
+                               'mesh_id'  : orgs['mesh_id'],
+                               'count'    : [x['count'] for x in org_res],
+                               'query'    : [x['query'] for x in org_res],
+                               'PMIDs'    : [x['PMIDs'] for x in org_res]})
+
+    pair_res = client.search_many(pair_terms, workers)
+    pair_res_df = pd.DataFrame([[x.disease, x.icd, x.icd_cat, str(x.icd_site).zfill(2),
+                                 y.org_name, y.abbrev, y.mesh_id,
+                                 res['count'], res['query'], res['PMIDs']]
+                                for (x, y), res in zip(pair_rows, pair_res)],
+                               columns = ['Disease', 'icd', 'icd_cat', 'icd_site',
+                                          'org_name', 'abbrev', 'mesh_id', 'count',
+                                          'query', 'PMIDs'])
+
+    return dis_res_df, org_res_df, pair_res_df
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Concurrent, cached Pubmed crawl for LPF')
+    parser.add_argument('--workers', type = int, default = 8, help = 'Queries in flight at once')
+    parser.add_argument('--date', default = None,
+                        help = 'Crawl date (YYYY/MM/DD), limits searches to records entered by then')
+    parser.add_argument('--rate', type = float, default = None,
+                        help = 'Requests per second (default: NCBI limit for key / no key)')
+    parser.add_argument('--base_url', default = ESEARCH_URL, help = 'esearch endpoint')
+    parser.add_argument('--cache_dir', default = CACHE_DIR, help = 'Response cache directory')
+    parser.add_argument('--home_dir', default = HOME_DIR, help = 'Where misc/ search terms live')
+    parser.add_argument('--out_dir', default = OUT_DIR, help = 'Where to write results')
+    args = vars(parser.parse_args())
+
+    client = PubmedClient(api_key = os.environ.get('NCBI_API_KEY'),
+                          email = os.environ.get('NCBI_EMAIL'),
+                          base_url = args['base_url'],
+                          cache_dir = args['cache_dir'],
+                          date = args['date'],
+                          restrict_date = args['date'] is not None,
+                          rate = args['rate'])
+
+    dis, orgs = load_terms(args['home_dir'])
+    dis_res_df, org_res_df, pair_res_df = crawl(client, dis, orgs, args['workers'])
+
+    os.makedirs(args['out_dir'], exist_ok = True)
+    dis_res_df.to_csv(f"{args['out_dir']}/dis_only_py_pubmed_search.tsv", sep = '\t', index = False)
+    org_res_df.to_csv(f"{args['out_dir']}/path_only_py_pubmed_search.tsv", sep = '\t', index = False)
+    pair_res_df.to_csv(f"{args['out_dir']}/pairs_py_pubmed_search.tsv", sep = '\t', index = False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# Name:     pubmed_cooccur_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Builds the disease-pathogen pair counts for LPF locally from the PMIDs the
+#   disease only and pathogen only searches already returned, instead of
+#   sending one (disease) AND (pathogen) query per pair to Pubmed.
+#
+#   The PMIDs of every disease and pathogen search are kept in a compact
+#   binary store (pmid_store.npz): one sorted uint32 array of all PMIDs plus
+#   offsets into it for each search, along with the count Pubmed reported.
+#   Pair PMIDs are then found for every disease and pathogen at once: a table
+#   indexed by PMID holds one bit per pathogen, a single lookup of the
+#   concatenated disease PMIDs gives each one's pathogens, and the pair counts
+#   are summed per disease, so all ~8,500 pairs take seconds instead of
+#   thousands of round trips.
+#
+#   A search whose count is larger than the PMIDs it returned was cut off at
+#   retmax, so any pair involving it is only a lower bound. Those pairs are
+#   written to pairs_to_requery.tsv, and with --fallback they are sent to
+#   Pubmed with pubmed_client_pub.py and the local result replaced.
+#
+#   Writes pairs_py_pubmed_search.tsv in the same layout as the notebook.
+#
+#   Usage:
+#       python pubmed_cooccur_pub.py --build
+#       python pubmed_cooccur_pub.py --fallback --workers 8
+#
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from pubmed_client_pub import PubmedClient, pair_query
+
+HOME_DIR = "/data/pathogen_ncd"
+OUT_DIR = f"{HOME_DIR}/results/other"
+
+DIS_FN = f"{OUT_DIR}/dis_only_py_pubmed_search.tsv"
+ORG_FN = f"{OUT_DIR}/path_only_py_pubmed_search.tsv"
+STORE_FN = f"{OUT_DIR}/pmid_store.npz"
+
+PAIR_COLS = ['Disease', 'icd', 'icd_cat', 'icd_site', 'org_name', 'abbrev',
+             'mesh_id', 'count', 'query', 'PMIDs']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Parse the stringified PMID lists the search tables were saved with into
+# sorted uint32 arrays.
+def parse_pmids(pmid_strs):
+    return [np.unique(np.array(x, dtype = np.uint32))
+            for x in pmid_strs.fillna('').astype(str).str.findall(r'\d+')]
+
+# Pack a list of PMID arrays into one array plus offsets: search i's PMIDs are
+# pmids[offsets[i]:offsets[i + 1]].
+def pack(pmid_ls):
+    lens = np.array([len(x) for x in pmid_ls], dtype = np.int64)
+    offsets = np.zeros(len(pmid_ls) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(lens)
+
+    if len(pmid_ls):
+        pmids = np.concatenate(pmid_ls).astype(np.uint32)
+    else:
+        pmids = np.array([], dtype = np.uint32)
+
+    return pmids, offsets
+
+def unpack(pmids, offsets, idx):
+    return pmids[offsets[idx]:offsets[idx + 1]]
+
+# Build the store from the disease only and pathogen only search tables.
+def build_store(dis_fn = DIS_FN, org_fn = ORG_FN, store_fn = STORE_FN):
+    dis = pd.read_csv(dis_fn, sep = '\t', dtype = {'icd_site' : str})
+    orgs = pd.read_csv(org_fn, sep = '\t')
+
+    dis_pmids, dis_offsets = pack(parse_pmids(dis['PMIDs']))
+    org_pmids, org_offsets = pack(parse_pmids(orgs['PMIDs']))
+
+    tmp_fn = f"{store_fn}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_fn,
+             dis_pmids = dis_pmids, dis_offsets = dis_offsets,
+             dis_count = dis['count'].to_numpy(np.int64),
+             org_pmids = org_pmids, org_offsets = org_offsets,
+             org_count = orgs['count'].to_numpy(np.int64))
+    os.replace(tmp_fn, store_fn)
+
+    return load_store(store_fn)
+
+def load_store(store_fn = STORE_FN):
+    with np.load(store_fn) as store:
+        return {x : store[x] for x in store.files}
+
+# Searches that hit retmax: Pubmed counted more than it handed back
+def get_truncated(store, kind):
+    n_ids = np.diff(store[f'{kind}_offsets'])
+
+    return store[f'{kind}_count'] > n_ids
+
+# Pair counts and PMIDs for every disease x pathogen from the store. Returns
+# counts and the truncated flags as (n_dis, n_org) arrays, and the PMIDs as a
+# list (by disease) of lists (by pathogen) of arrays.
+def cooccur(store):
+    dis_pmids = store['dis_pmids']
+    dis_offsets = store['dis_offsets']
+    org_pmids = store['org_pmids']
+    org_offsets = store['org_offsets']
+
+    n_dis = len(dis_offsets) - 1
+    n_org = len(org_offsets) - 1
+
+    # Which disease each position in dis_pmids belongs to
+    dis_idx = np.repeat(np.arange(n_dis), np.diff(dis_offsets))
+
+    counts = np.zeros((n_dis, n_org), dtype = np.int64)
+    pair_pmids = [[None] * n_org for _ in range(n_dis)]
+
+    # Pathogens are done 64 at a time: a table indexed by PMID holds a bit for
+    # each pathogen that PMID came back for, so one lookup of every disease
+    # PMID tells us which of those pathogens it pairs with.
+    max_pmid = max(dis_pmids.max(initial = 0), org_pmids.max(initial = 0))
+
+    for blk_start in range(0, n_org, 64):
+        blk_orgs = range(blk_start, min(blk_start + 64, n_org))
+
+        org_bits = np.zeros(int(max_pmid) + 1, dtype = np.uint64)
+        for curr_org in blk_orgs:
+            org_bits[unpack(org_pmids, org_offsets, curr_org)] |= np.uint64(1 << (curr_org - blk_start))
+
+        dis_bits = org_bits[dis_pmids]
+        del org_bits
+
+        for curr_org in blk_orgs:
+            hit = (dis_bits & np.uint64(1 << (curr_org - blk_start))) != 0
+
+            counts[:, curr_org] = np.bincount(dis_idx[hit], minlength = n_dis)
+
+            # Hits are still grouped by disease, split them back up
+            hit_pmids = dis_pmids[hit]
+            hit_offsets = np.zeros(n_dis + 1, dtype = np.int64)
+            hit_offsets[1:] = np.cumsum(counts[:, curr_org])
+
+            for curr_dis in range(n_dis):
+                pair_pmids[curr_dis][curr_org] = unpack(hit_pmids, hit_offsets, curr_dis)
+
+    truncated = get_truncated(store, 'dis')[:, None] | get_truncated(store, 'org')[None, :]
+
+    return counts, truncated, pair_pmids
+
+# Lay the pair results out like the notebook's pairs_py_pubmed_search.tsv,
+# query is the one we would have sent rather than Pubmed's translation of it.
+def pair_table(dis, orgs, counts, pair_pmids):
+    rows = []
+    for x, curr_dis in enumerate(dis.itertuples()):
+        for y, curr_org in enumerate(orgs.itertuples()):
+            rows.append([curr_dis.Disease, curr_dis.icd, curr_dis.icd_cat,
+                         str(curr_dis.icd_site).zfill(2), curr_org.org_name,
+                         curr_org.abbrev, curr_org.mesh_id, counts[x, y],
+                         pair_query(curr_dis.Disease, curr_org.org_name,
+                                    curr_org.abbrev, curr_org.mesh_id),
+                         [str(z) for z in pair_pmids[x][y]]])
+
+    return pd.DataFrame(rows, columns = PAIR_COLS)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Local disease-pathogen co-occurrence from cached PMIDs')
+    parser.add_argument('--build', action = 'store_true',
+                        help = '(Re)build the PMID store from the search tables first')
+    parser.add_argument('--fallback', action = 'store_true',
+                        help = 'Re-query pairs involving a truncated search on Pubmed')
+    parser.add_argument('--workers', type = int, default = 8, help = 'Fallback queries in flight at once')
+    parser.add_argument('--date', default = None, help = 'Crawl date for fallback queries (YYYY/MM/DD)')
+    parser.add_argument('--out_dir', default = OUT_DIR, help = 'Where the search tables live')
+    args = vars(parser.parse_args())
+
+    dis_fn = f"{args['out_dir']}/dis_only_py_pubmed_search.tsv"
+    org_fn = f"{args['out_dir']}/path_only_py_pubmed_search.tsv"
+    store_fn = f"{args['out_dir']}/pmid_store.npz"
+
+    if args['build'] or not os.path.exists(store_fn):
+        store = build_store(dis_fn, org_fn, store_fn)
+    else:
+        store = load_store(store_fn)
+
+    dis = pd.read_csv(dis_fn, sep = '\t', usecols = ['Disease', 'icd', 'icd_cat', 'icd_site'],
+                      dtype = {'icd_site' : str})
+    orgs = pd.read_csv(org_fn, sep = '\t', usecols = ['org_name', 'abbrev', 'mesh_id'])
+
+    start = time.time()
+    counts, truncated, pair_pmids = cooccur(store)
+    print(f"{counts.size:,} pairs in {time.time() - start:.2f}s, "
+          f"{truncated.sum():,} involve a search truncated at retmax")
+
+    pair_res_df = pair_table(dis, orgs, counts, pair_pmids)
+    requery = truncated.ravel()
+
+    pair_res_df.loc[requery, ['Disease', 'abbrev', 'query']].to_csv(
+        f"{args['out_dir']}/pairs_to_requery.tsv", sep = '\t', index = False)
+
+    if args['fallback'] and requery.any():
+        client = PubmedClient(api_key = os.environ.get('NCBI_API_KEY'),
+                              email = os.environ.get('NCBI_EMAIL'),
+                              date = args['date'],
+                              restrict_date = args['date'] is not None)
+
+        res_ls = client.search_many(pair_res_df.loc[requery, 'query'].tolist(), args['workers'])
+
+        pair_res_df.loc[requery, 'count'] = [x['count'] for x in res_ls]
+        pair_res_df.loc[requery, 'PMIDs'] = pd.Series([x['PMIDs'] for x in res_ls],
+                                                      index = pair_res_df.index[requery])
+
+    pair_res_df.to_csv(f"{args['out_dir']}/pairs_py_pubmed_search.tsv", sep = '\t', index = False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Name:     test_ukb_icd_empirical_p_calculations_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Runs ukb_icd_empirical_p_calculations_pub.py --adaptive on a small
+#   permutation result file and _perm_counts.tsv laid out the way
+#   ukb_icd_permutation_analysis_pub.R writes them: Antigen is the raw UKB
+#   antigen name (column name minus _init) in both, and the counts file also
+#   has the clean name. The observed results use the clean name. Checks the
+#   pooled null is every permutation of the pairs that ran to completion and
+#   the pair that stopped early keeps its own counts.
+#
+#   Usage:
+#       python -m pytest -q analysis_code/tests
+#
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+SCRIPT_FN = (f"{os.path.dirname(os.path.abspath(__file__))}/.."
+             "/ukb_icd_empirical_p_calculations_pub.py")
+
+ICD = 'K50'
+N_PERMS = 100
+
+# raw antigen name, clean name, organism, observed p, perms run if it stopped
+# early (None if it ran them all)
+PAIRS = [('1gG antigen for Herpes Simplex virus-1', '1gG', 'HSV1', 0.03, None),
+         ('VCA p18 antigen for Epstein-Barr Virus', 'VCA p18', 'EBV', 0.5, None),
+         ('EBNA-1 antigen for Epstein-Barr Virus', 'EBNA-1', 'EBV', 0.9, 20)]
+
+# ukb_mod_results columns, in the order the script expects them
+OBS_COLS = ['Unparsed_Disease', 'Disease', 'ICD10_Cat', 'ICD10_Site',
+            'sex_specific_dis', 'nCase', 'nControl', 'control_set', 'n_mixed',
+            'Antigen', 'organism', 'p_val', 'anti_OR', 'anti_CI', 'model', 'r2_tjur',
+            'r2_mcfad', 'r2_adj_mcfad', 'r2_nagelkerke', 'r2_coxsnell', 'cov_ps',
+            'sig_covs', 'cov_adj_for', 'cov_ors', 'avg_age_case', 'avg_avg_con',
+            'avg_titer_case', 'avg_titer_con', 'std_titer_case', 'std_titer_con',
+            'med_titer_case', 'med_titer_con', 'Warnings', 'is_warning',
+            'vanilla_pair', 'vanilla_dis', 'proc_time', 'date_time', 'mod_version',
+            'icd', 'std_lev', 'p_sig', 'risk', 'protect', 'effect']
+
+
+@pytest.fixture
+def emp_run(tmp_path):
+    rng = np.random.default_rng(5)
+    res_dir = f"{tmp_path}/results"
+    perm_dir = f"{res_dir}/perm_p_sims/final"
+    os.makedirs(perm_dir)
+    os.makedirs(f"{res_dir}/perm_p_sims/emp_calcs")
+
+    obs = pd.DataFrame(np.nan, index = range(len(PAIRS)), columns = OBS_COLS, dtype = object)
+    obs['Unparsed_Disease'] = f"Crohn's disease [{ICD}]"
+    obs['icd'] = ICD
+    obs['Antigen'] = [x[1] for x in PAIRS]
+    obs['organism'] = [x[2] for x in PAIRS]
+    obs['p_val'] = [x[3] for x in PAIRS]
+    obs.to_csv(f"{res_dir}/ukb_mod_results_01_17_2023.csv", index = False)
+
+    perms = []
+    cnts = []
+    for raw_ant, clean_ant, org, obs_p, n_stop in PAIRS:
+        n_run = N_PERMS if n_stop is None else n_stop
+        p_vals = rng.random(n_run)
+        perms.append(pd.DataFrame({'Disease' : "Crohn's disease", 'Antigen' : raw_ant,
+                                   'organism' : org, 'p_val' : p_vals,
+                                   'perm_n' : np.arange(1, n_run + 1)}))
+        cnts.append([raw_ant, clean_ant, org, obs_p, n_run,
+                     int((p_vals <= obs_p).sum()), 'FALSE' if n_stop is None else 'TRUE'])
+
+    perm_fn = f"{perm_dir}/{ICD}_perms_10000_pid_1_01_17_2023_result.tsv"
+    perms = pd.concat(perms, ignore_index = True)
+    perms.to_csv(perm_fn, sep = '\t', index = False)
+
+    pd.DataFrame(cnts, columns = ['Antigen', 'clean_ant_name', 'organism', 'obs_p',
+                                  'perms_run', 'perms_lt_obs_p', 'stopped_early']
+                 ).to_csv(perm_fn.replace('_result.tsv', '_perm_counts.tsv'),
+                          sep = '\t', index = False)
+
+    env = dict(os.environ, PATHOGEN_NCD_HOME = str(tmp_path))
+    env.pop('PATHOGEN_NCD_LEDGER', None)
+    proc = subprocess.run([sys.executable, SCRIPT_FN, '--icd', ICD, '--adaptive'],
+                          env = env, capture_output = True, text = True)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+
+    emp = pd.read_csv(f"{res_dir}/perm_p_sims/emp_calcs/{ICD}_emp_p_results.tsv", sep = '\t')
+
+    return perms, emp.set_index('anti'), proc.stdout
+
+
+def test_pooled_null_is_completed_pairs(emp_run):
+    perms, emp, stdout = emp_run
+    n_done = sum(x[4] is None for x in PAIRS)
+
+    assert f"pooled null has {n_done * N_PERMS} perms" in stdout
+
+    done_p = perms.loc[perms['Antigen'].isin([x[0] for x in PAIRS if x[4] is None]), 'p_val']
+    for _, clean_ant, _, obs_p, n_stop in PAIRS:
+        if n_stop is not None:
+            continue
+        B = int((done_p <= obs_p).sum())
+        assert emp.loc[clean_ant, 'tot_dis_perms'] == n_done * N_PERMS
+        assert emp.loc[clean_ant, 'perms_lt_mod_3_p'] == B
+        assert emp.loc[clean_ant, 'mod_3_emp_p'] == pytest.approx((B + 1) / (n_done * N_PERMS + 1))
+
+def test_stopped_pair_keeps_own_counts(emp_run):
+    perms, emp, _ = emp_run
+    raw_ant, clean_ant, _, obs_p, n_stop = PAIRS[2]
+
+    B = int((perms.loc[perms['Antigen'] == raw_ant, 'p_val'] <= obs_p).sum())
+    assert emp.loc[clean_ant, 'tot_dis_perms'] == n_stop
+    assert emp.loc[clean_ant, 'perms_lt_mod_3_p'] == B
+    assert emp.loc[clean_ant, 'mod_3_emp_p'] == pytest.approx((B + 1) / (n_stop + 1))
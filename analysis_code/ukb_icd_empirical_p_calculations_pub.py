@@ -8,6 +8,18 @@
 #   should for the null distribution, then calculates a BH FDR and adds that
 #   to the result file which it writes out in the end.
 #
+#   If the permutations were run with --adaptive (sequential stopping) pass
+#   --adaptive here too. Pairs then have different numbers of permutations,
+#   which we read from the _perm_counts.tsv file. Pairs that ran all of their
+#   permutations are compared against a null pooled from just those pairs, so
+#   if nothing stopped early this is the same 450K null (and resolution) as a
+#   normal run. Pairs that stopped early use their own counts (b = perms run
+#   for that pair and B = how many of those were <= the observed p-value),
+#   they hit h exceedances so they were never going to be significant.
+#
+#   Runs are recorded in the pipeline run ledger when PATHOGEN_NCD_LEDGER is
+#   set (pipeline_code/run_ledger_pub.py).
+#
 
 # Data manipulation
 import numpy as np
@@ -23,15 +35,21 @@ import argparse
 
 # Misc libraries
 import os
+import sys
 import glob
 
-HOME_DIR =  "/data/pathogen_ncd"
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../pipeline_code")
+from run_ledger_pub import start_run
+
+# Set PATHOGEN_NCD_HOME to read/write somewhere other than the real data
+HOME_DIR = os.environ.get('PATHOGEN_NCD_HOME', "/data/pathogen_ncd")
 
 # Create the parser
 parser = argparse.ArgumentParser()
 
 # Add an argument
 parser.add_argument('--icd', type=str, required=True)
+parser.add_argument('--adaptive', action='store_true')
 
 # Parse the argument
 args = parser.parse_args()
@@ -66,28 +84,60 @@ out_fn = f'{perm_res_out_dir}/{curr_icd}_emp_p_results.tsv'
 curr_dis_res = res.loc[res['icd'] == curr_icd,]
 
 # Find permutation result file
-curr_search = f"{perm_res_dir}/{curr_icd}_perms_10000_pid*.tsv"
+curr_search = f"{perm_res_dir}/{curr_icd}_perms_10000_pid*_result.tsv"
 
 curr_fn_ls = glob.glob(curr_search)
 
+if len(curr_fn_ls) == 0:
+    print(f"No permutation file found for {curr_icd} ({curr_search})")
+    sys.exit(1)
+
 if len(curr_fn_ls) != 1:
     print(f"Found {len(curr_fn_ls)} permutation files for {curr_icd}")
     #continue
 
 # Read in perm result file for dis
 curr_fn = curr_fn_ls[0]
+run = start_run('ukb_icd_empirical_p', key = curr_icd, params = vars(args),
+                inputs = [f'{res_dir}/ukb_mod_results_01_17_2023.csv', curr_fn])
 curr_perms = pd.read_csv(curr_fn, sep="\t", low_memory = False)
 
 # 10,000 permutations for 45 Abs should be 450,000 results
 # if not we need to warn and look into this more closely
 tot_perms = len(curr_perms)
-if tot_perms != 450000:
+if (tot_perms != 450000) and (not args.adaptive):
     print(f"{curr_fn} only has {tot_perms} perms, not the expected 450k!")
     #continue
 
 # Create null distribution for disease
 p_dist = curr_perms.loc[:, 'p_val'].values.tolist()
 tot_perms = len(p_dist)
+
+# Per-pair permutation counts written out by the permutation script
+if args.adaptive:
+    cnt_fn = curr_fn.replace('_result.tsv', '_perm_counts.tsv')
+    perm_cnts = pd.read_csv(cnt_fn, sep="\t", low_memory = False)
+
+    # Pool the null from the pairs that ran to completion, the stopped pairs
+    # only have the permutations it took them to reach h exceedances. The
+    # permutation results carry the raw antigen name (UKB column without
+    # _init), not the clean one, so match on that.
+    raw_ant = lambda x : x.astype(str).str.replace('_init$', '', regex = True)
+
+    done_cnts = perm_cnts.loc[perm_cnts['stopped_early'] != True, :]
+    done_pairs = set(zip(done_cnts['organism'], raw_ant(done_cnts['Antigen'])))
+    is_done = [(org, ab) in done_pairs for org, ab in
+               zip(curr_perms['organism'], raw_ant(curr_perms['Antigen']))]
+
+    p_dist = curr_perms.loc[is_done, 'p_val'].values.tolist()
+    print(f"{len(done_pairs)} of {len(perm_cnts)} pairs ran all permutations, "
+          f"pooled null has {len(p_dist)} perms")
+
+    if done_pairs and (len(p_dist) == 0):
+        print(f"None of the {len(done_pairs)} completed pairs in {cnt_fn} match "
+              f"the permutation results in {curr_fn}")
+        sys.exit(1)
+
 # Loop through each dis-Ab pair calculating en empirical p-value
 fin_res_ls = []
 for curr_org, curr_ab in tqdm.tqdm(org_ab_ls):
@@ -101,8 +151,22 @@ for curr_org, curr_ab in tqdm.tqdm(org_ab_ls):
 
     curr_res = curr_res.iloc[0]
 
-    b = tot_perms
-    B = sum(p_dist <= curr_res['p_val'])
+    if args.adaptive:
+        curr_cnt = perm_cnts.loc[((perm_cnts['organism'] == curr_org) &
+                                  (perm_cnts['clean_ant_name'] == curr_ab)), :]
+
+        if len(curr_cnt) == 0:
+            print(f"No permutation counts for {curr_icd} {curr_org} {curr_ab}")
+            continue
+
+        curr_cnt = curr_cnt.iloc[0]
+
+    if args.adaptive and (curr_cnt['stopped_early'] == True):
+        b = int(curr_cnt['perms_run'])
+        B = int(curr_cnt['perms_lt_obs_p'])
+    else:
+        b = len(p_dist)
+        B = sum(p_dist <= curr_res['p_val'])
     emp_p = (B + 1) / (b + 1)
 
     curr_res_ls = curr_res.tolist()
@@ -119,4 +183,6 @@ bh = mt(fin_res.loc[:, 'mod_3_emp_p'], method = 'fdr_bh')[1]
 fin_res['bon'] = bon
 fin_res['bh_fdr'] = bh
 
-fin_res.to_csv(out_fn, sep = '\t', index = False)
\ No newline at end of file
+fin_res.to_csv(out_fn, sep = '\t', index = False)
+
+run.finish(rows_in = tot_perms, rows_out = len(fin_res), outputs = [out_fn])
\ No newline at end of file
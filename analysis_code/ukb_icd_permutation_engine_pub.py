@@ -0,0 +1,417 @@
+# Name:     ukb_icd_permutation_engine_pub.py
+# Author:   Mike Lape
+# Date:     2024
+# Description:
+#
+#   Vectorized replacement for ukb_icd_permutation_analysis_pub.R. You provide
+#   an ICD10 code and a number of permutations and this script builds the null
+#   distribution for that disease against all 45 Abs, writing the same
+#   {icd}_perms_{N}_pid_{pid}_{date}_result.tsv file that
+#   ukb_icd_empirical_p_calculations_pub.py consumes.
+#
+#   Instead of refitting a full glm for every shuffle x antibody, the
+#   covariates a pair was adjusted for (cov_adj_for from the analytical
+#   results) are fixed for the disease, so antibodies are grouped by covariate
+#   set and for each group we:
+#       1) fit the covariates-only (null) logistic model for a whole batch of
+#          permuted label vectors at once (batched IRLS on a fixed design)
+#       2) compute the score test statistic for every antibody in the group
+#          against every permuted label vector in the batch as dense matrix
+#          products.
+#   The score test is asymptotically equivalent to the Wald test glm reports
+#   and only needs the null model, which is why it is so much cheaper.
+#
+#   Permutations are processed in batches of --batch permuted label vectors
+#   (memory is roughly n_samples x batch x n_covariates floats) and the RNG is
+#   seeded with --seed (defaults to 5, our usual OUR_SEED).
+#
+#   Usage:
+#       python ukb_icd_permutation_engine_pub.py --icd M32 --perm 10000
+#
+
+# Data manipulation
+import numpy as np
+import pandas as pd
+
+# Stats
+from scipy.stats import chi2
+
+import argparse
+import tqdm
+
+# Misc libraries
+import os
+import re
+from datetime import datetime
+
+HOME_DIR =  "/data/pathogen_ncd"
+OUT_FILE_DATE = '01_17_2023'
+OUR_SEED = 5
+
+# Same columns (and order) as the R permutation script writes out.
+RESULT_COLS = ['Unparsed_Disease', 'Disease', 'ICD10_Cat', 'ICD10_Site',
+               'sex_specific_dis', 'nCase', 'nControl', 'control_set',
+               'n_mixed', 'Antigen', 'organism', 'p_val', 'anti_OR',
+               'anti_CI', 'model', 'r2_tjur', 'r2_mcfad', 'r2_adj_mcfad',
+               'r2_nagelkerke', 'r2_coxsnell', 'cov_ps', 'sig_covs',
+               'cov_adj_for', 'cov_ors', 'avg_age_case', 'avg_avg_con',
+               'avg_titer_case', 'avg_titer_con', 'std_titer_case',
+               'std_titer_con', 'med_titer_case', 'med_titer_con', 'Warnings',
+               'is_warning', 'proc_time', 'date_time', 'perm_n']
+
+# Covariates that are factors in the R models, everything else (age, bmi) is
+# numeric.
+FACTOR_COVS = ['sex', 'ethnic', 'tdi_quant', 'num_in_house', 'tobac', 'alc',
+               'num_sex_part', 'same_sex']
+
+HEALTHY_PREGNANCY_CODES = ['O80', 'O81', 'O82', 'O83', 'O84']
+O_CON_STR = ','.join(HEALTHY_PREGNANCY_CODES)
+
+# R float underflow floor used in perm_ind_anti_analysis
+MIN_P = 2.22e-300
+
+IRLS_MAX_ITER = 25
+IRLS_TOL = 1e-8
+
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Python version of get_icd in helper_functions_pub.R
+#   "abnormalities of forces of labour[O62]" ->
+#       ("abnormalities of forces of labour", "O", "62")
+def get_icd(dis_name):
+    m = re.search(r'\[([A-Za-z])(\d+)\]', dis_name)
+    if m is None:
+        return dis_name, "NA", "NA"
+
+    return dis_name[:m.start()], m.group(1), m.group(2)
+
+
+# Split a comma separated covariate string from the results file into a list,
+# handling the empty/NaN case.
+def split_covs(cov_str):
+    if not isinstance(cov_str, str):
+        return []
+
+    return [x.strip() for x in cov_str.split(',') if x.strip() != '']
+
+
+# Python version of load_data in helper_functions_pub.R, along with the data
+# prep done at the top of the R permutation script (log10 titers, fixing
+# antibody names, converting disease strings to booleans and unifying indices).
+def load_data(base_dir):
+    cov_dat = pd.read_csv(f'{base_dir}/procd/cov_dat.csv', index_col = 0)
+    ant_dat = pd.read_csv(f'{base_dir}/procd/clean_antigen_data.csv',
+                          index_col = 0)
+    dis_dat = pd.read_csv(f'{base_dir}/procd/dis_dat.csv', index_col = 0)
+    roll_dat = pd.read_csv(f'{base_dir}/procd/rolled_code.csv', index_col = 0)
+    ant_dict = pd.read_excel(f'{base_dir}/dicts/viral_dict.xlsx')
+
+    all_dis = dis_dat.join(roll_dat, how = 'outer')
+    all_dis = (all_dis.astype(str) == "True")
+
+    # Titers, log10 transforming any column that hasn't been already (see R
+    # script for reasoning behind the > 5 cutoff).
+    ant_dat = ant_dat.iloc[:, :45].astype(float)
+    for x in ant_dat.columns:
+        if ant_dat[x].max(skipna = True) > 5:
+            ant_dat[x] = np.log10(ant_dat[x])
+
+    ant_dat.columns = [x.replace('_init', '') for x in ant_dat.columns]
+    ant_dat.columns = [x + 's' if x.endswith("Sarcoma-Associated Herpesviru")
+                       else x for x in ant_dat.columns]
+
+    common_idx = all_dis.index.intersection(cov_dat.index)
+    common_idx = common_idx.intersection(ant_dat.index)
+
+    return (cov_dat.loc[common_idx, :], ant_dat.loc[common_idx, :],
+            all_dis.loc[common_idx, :], ant_dict)
+
+
+# Build the case/control set exactly like perm_analysis does, returning the
+# disease status (0/1) indexed by eid and the number of mixed samples dropped.
+def get_dis_status(all_dis, cov_dat, dis_name, icd_cat, dis_sex, control_str):
+    curr_dis = all_dis[dis_name]
+    case_inds = curr_dis.index[curr_dis]
+    control_inds = curr_dis.index[~curr_dis]
+    mixed_cnt = 0
+
+    if (icd_cat == 'O') and (control_str == O_CON_STR):
+        dis_w_10 = all_dis.loc[:, all_dis.sum() >= 10]
+        o_cols = [x for x in dis_w_10.columns
+                  if any(f'[{y}]' in x for y in HEALTHY_PREGNANCY_CODES)]
+        control_inds = dis_w_10.index[dis_w_10[o_cols].any(axis = 1)]
+
+        in_both = case_inds.intersection(control_inds)
+        mixed_cnt = len(in_both)
+        case_inds = case_inds.difference(in_both)
+        control_inds = control_inds.difference(in_both)
+
+    elif dis_sex != -1:
+        sex_inds = cov_dat.index[cov_dat['sex'] == dis_sex]
+        case_inds = case_inds.intersection(sex_inds)
+        control_inds = control_inds.intersection(sex_inds)
+
+    status = pd.Series(0, index = case_inds.append(control_inds))
+    status.loc[case_inds] = 1
+
+    return status, mixed_cnt
+
+
+# Turn the covariates a model was adjusted for into a design matrix with an
+# intercept, using treatment contrasts for factors like R does.  Dummy columns
+# that are constant in this sample are dropped, R would give an NA coefficient
+# for them anyway.
+def build_design(cov_df, covs):
+    cols = [np.ones(len(cov_df))]
+    for c in covs:
+        if c in FACTOR_COVS:
+            lvls = np.sort(cov_df[c].unique())
+            for lvl in lvls[1:]:
+                cols.append((cov_df[c].values == lvl).astype(float))
+        else:
+            cols.append(cov_df[c].values.astype(float))
+
+    X = np.column_stack(cols)
+    keep = [0] + [i for i in range(1, X.shape[1]) if np.ptp(X[:, i]) > 0]
+
+    return X[:, keep]
+
+
+############################################
+#                                          #
+#           Score test engine              #
+#                                          #
+############################################
+
+# Fit the covariates-only logistic model for every column of Y (n x K matrix
+# of permuted 0/1 label vectors) at once. The design X (n x p) is the same for
+# every permutation, so each IRLS step is a batched p x p solve.
+# Returns the fitted probabilities (n x K).
+def batch_null_fit(X, Y):
+    n, p = X.shape
+    K = Y.shape[1]
+
+    # Start from the intercept-only solution which is what we'd get with no
+    # covariates and is identical for every permutation.
+    ybar = np.clip(Y.mean(axis = 0), 1e-8, 1 - 1e-8)
+    beta = np.zeros((p, K))
+    beta[0, :] = np.log(ybar / (1 - ybar))
+
+    if p == 1:
+        return np.broadcast_to(ybar, (n, K)).copy()
+
+    for _ in range(IRLS_MAX_ITER):
+        eta = X @ beta
+        mu = 1 / (1 + np.exp(-eta))
+        w = np.clip(mu * (1 - mu), 1e-10, None)
+
+        # X'WX for every permutation: (K x p x p)
+        XtWX = np.einsum('np,nk,nq->kpq', X, w, X, optimize = True)
+        score = X.T @ (Y - mu)
+
+        step = np.linalg.solve(XtWX, score.T[:, :, None])[:, :, 0].T
+        beta = beta + step
+
+        if np.max(np.abs(step)) < IRLS_TOL:
+            break
+
+    return 1 / (1 + np.exp(-(X @ beta)))
+
+
+# Score test for adding each antibody (columns of G, n x A) to the null model
+# fit to each permuted label vector (columns of Y, n x K).
+#   U = G'(y - mu)
+#   V = G'WG - G'WX (X'WX)^-1 X'WG
+# Returns chi-square(1) p-values as an (A x K) matrix.
+def batch_score_test(X, G, Y):
+    n, p = X.shape
+    K = Y.shape[1]
+    A = G.shape[1]
+
+    mu = batch_null_fit(X, Y)
+    w = mu * (1 - mu)
+
+    U = G.T @ (Y - mu)
+    GtWG = (G ** 2).T @ w
+
+    # G'WX for all permutations at once via a single (A x n) @ (n x K*p) matmul
+    WX = (w[:, :, None] * X[:, None, :]).reshape(n, K * p)
+    GtWX = (G.T @ WX).reshape(A, K, p).transpose(1, 0, 2)
+    XtWX = np.einsum('np,nk,nq->kpq', X, w, X, optimize = True)
+
+    # (X'WX)^-1 X'WG for each permutation: K x p x A
+    sol = np.linalg.solve(XtWX, GtWX.transpose(0, 2, 1))
+    adj = np.einsum('kap,kpa->ak', GtWX, sol, optimize = True)
+
+    V = np.clip(GtWG - adj, 1e-300, None)
+    stat = U ** 2 / V
+
+    p_vals = chi2.sf(stat, df = 1)
+    p_vals[p_vals == 0] = MIN_P
+
+    return p_vals
+
+
+############################################
+#                                          #
+#           Main                           #
+#                                          #
+############################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Vectorized score test permutation null for UKB disease-Ab models')
+    parser.add_argument('--icd', type = str, required = True)
+    parser.add_argument('--perm', type = int, required = True)
+    parser.add_argument('--batch', type = int, default = 500,
+                        help = 'Number of permuted label vectors to process at once')
+    parser.add_argument('--seed', type = int, default = OUR_SEED)
+    args = parser.parse_args()
+
+    curr_icd = args.icd
+    N_PERMUTE = args.perm
+
+    res_dir = f'{HOME_DIR}/results/perm_p_sims/final'
+
+    pid = os.getpid()
+    curr_res_fn = (f'{res_dir}/{curr_icd}_perms_{N_PERMUTE}_pid_{pid}_'
+                   f'{OUT_FILE_DATE}_result.tsv')
+    print(f"Result file: {curr_res_fn}")
+
+    # We don't need to run analysis on healthy control pregnancies
+    if curr_icd in HEALTHY_PREGNANCY_CODES:
+        o_out_str = 'ICD10 chapter O control disease (healthy pregnancy) skipping!'
+        pd.DataFrame([[o_out_str] * len(RESULT_COLS)], columns = RESULT_COLS
+                     ).to_csv(curr_res_fn, sep = '\t', index = False)
+        print(o_out_str)
+        return
+
+    cov_dat, ant_dat, all_dis, ant_dict = load_data(HOME_DIR)
+
+    prev_res = pd.read_csv(f'{HOME_DIR}/results/ukb_mod_results_01_17_2023.csv',
+                           low_memory = False)
+    dis_prev_res = prev_res.loc[prev_res['icd'] == curr_icd, :]
+
+    curr_dis_name = dis_prev_res['Unparsed_Disease'].iloc[0]
+    curr_dis_con_set = dis_prev_res['control_set'].iloc[0]
+    curr_dis_sex = dis_prev_res['sex_specific_dis'].iloc[0]
+
+    if curr_dis_sex == 'Both':
+        dis_sex, dis_sex_str, control_str = -1, 'Both', 'all'
+    elif curr_dis_sex == 'Female':
+        dis_sex, dis_sex_str, control_str = 0, 'Female', curr_dis_con_set
+    else:
+        dis_sex, dis_sex_str, control_str = 1, 'Male', 'male'
+
+    dis, icd_cat, icd_loc = get_icd(curr_dis_name)
+
+    status, mixed_cnt = get_dis_status(all_dis, cov_dat, curr_dis_name,
+                                       icd_cat, dis_sex, control_str)
+
+    # perm_analysis reports the sex-specific string as the control set
+    if (dis_sex != -1) and not ((icd_cat == 'O') and (control_str == O_CON_STR)):
+        control_str = dis_sex_str
+
+    mod_cov = cov_dat.loc[status.index, :]
+    mod_cov = mod_cov.loc[mod_cov.notna().all(axis = 1), :]
+    status = status.loc[mod_cov.index]
+    mod_ant = ant_dat.loc[status.index, :]
+
+    # Group antibodies by (covariates adjusted for, rows with titer data) so
+    # each group shares a design matrix and a batch of null fits.
+    groups = {}
+    ant_info = {}
+    for y in ant_dat.columns:
+        ant_row = ant_dict.loc[ant_dict['Antigen'].str.contains(y, regex = False), :].iloc[0]
+        org = ant_row['Abbrev']
+        clean_ant_name = ant_row['Clean Ant Name']
+
+        pair_res = dis_prev_res.loc[(dis_prev_res['organism'] == org) &
+                                    (dis_prev_res['Antigen'] == clean_ant_name), :]
+
+        # Happens for tier 1 with HIV Abs - no results entry, so univariate
+        if len(pair_res) == 0:
+            covs, sig_covs = [], []
+        else:
+            covs = split_covs(pair_res['cov_adj_for'].iloc[0])
+            sig_covs = split_covs(pair_res['sig_covs'].iloc[0])
+
+        if dis_sex != -1:
+            covs = [x for x in covs if x != 'sex']
+
+        has_titer = mod_ant[y].notna().values
+        key = (tuple(covs), has_titer.tobytes())
+        groups.setdefault(key, []).append(y)
+        ant_info[y] = (org, ', '.join(sig_covs), ', '.join(covs),
+                       int(status.values[has_titer].sum()),
+                       int((1 - status.values[has_titer]).sum()))
+
+    print(f"{curr_dis_name}: {len(status)} samples, {ant_dat.shape[1]} Abs, "
+          f"{len(groups)} covariate groups")
+
+    # Build each group's design and titer matrix once, they don't change
+    # across permutations.
+    group_mats = []
+    for (covs, mask_bytes), ant_ls in groups.items():
+        mask = np.frombuffer(mask_bytes, dtype = bool)
+        X = build_design(mod_cov.loc[mask, :], list(covs))
+        G = mod_ant.loc[mask, ant_ls].values
+        group_mats.append((mask, X, G, ant_ls))
+
+    rng = np.random.default_rng(args.seed)
+    labels = status.values.astype(float)
+
+    # Write header into our output file
+    pd.DataFrame(columns = RESULT_COLS).to_csv(curr_res_fn, sep = '\t',
+                                               index = False)
+
+    dis_info = {'Unparsed_Disease' : curr_dis_name, 'Disease' : dis,
+                'ICD10_Cat' : icd_cat, 'ICD10_Site' : icd_loc,
+                'sex_specific_dis' : dis_sex_str, 'control_set' : control_str,
+                'n_mixed' : mixed_cnt, 'model' : 'score_test',
+                'Warnings' : '', 'is_warning' : False}
+
+    perm_start = 1
+    for batch_start in tqdm.tqdm(range(0, N_PERMUTE, args.batch)):
+        start_time = datetime.now()
+        K = min(args.batch, N_PERMUTE - batch_start)
+
+        # Each column is an independent shuffle of the disease labels
+        Y = rng.permuted(np.tile(labels[:, None], (1, K)), axis = 0)
+
+        batch_res = []
+        for mask, X, G, ant_ls in group_mats:
+            p_vals = batch_score_test(X, G, Y[mask, :])
+
+            for a_idx, y in enumerate(ant_ls):
+                org, sig_cov_str, cov_str, n_case, n_con = ant_info[y]
+                batch_res.append(pd.DataFrame({
+                    'Antigen' : y, 'organism' : org,
+                    'nCase' : n_case, 'nControl' : n_con,
+                    'p_val' : p_vals[a_idx, :],
+                    'sig_covs' : sig_cov_str, 'cov_adj_for' : cov_str,
+                    'perm_n' : np.arange(perm_start, perm_start + K)}))
+
+        batch_res = pd.concat(batch_res, ignore_index = True)
+        for k, v in dis_info.items():
+            batch_res[k] = v
+
+        elapsed = (datetime.now() - start_time).total_seconds()
+        batch_res['proc_time'] = round(elapsed / len(batch_res), 6)
+        batch_res['date_time'] = str(datetime.now())
+
+        batch_res = batch_res.sort_values(['perm_n'], kind = 'stable')
+        batch_res = batch_res.reindex(columns = RESULT_COLS, fill_value = 'NAN')
+        batch_res.to_csv(curr_res_fn, sep = '\t', index = False, header = False,
+                         mode = 'a')
+
+        perm_start = perm_start + K
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# Name:     fastq_stats_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Raw fastq file stats for the VIRTUS pipeline logs (what fq_stats in
+#   geo_pipe_funcs_pub.sh reports) in a single pass over the file instead of
+#   wc -l, du and an awk histogram followed by a bc call per read length.
+#
+#   Only the sequence line of each read is looked at, in batches, so counting
+#   stays in C (islice/map/Counter) and nothing but the read length histogram
+#   (and base counts with --bases) is kept in memory. Gzipped files are
+#   detected by their magic bytes and decompressed by pigz when --threads > 1
+#   and it is on the PATH, otherwise by isal if installed, otherwise gzip.
+#
+#   Reports number of reads, mean/SD (population, as before)/min/max/mode
+#   read length, the length histogram and optionally base composition, as
+#   JSON (to stdout or --out). --summary prints the values fq_stats sets on
+#   one tab separated line for the shell to read in.
+#
+#   Only uses the standard library so it runs under the python3/3.7.8 module
+#   the pipeline loads.
+#
+#   Usage:
+#       python fastq_stats_pub.py SRR123.fastq --bases --out SRR123.stats.json
+#       python fastq_stats_pub.py SRR123_1.fastq.gz SRR123_2.fastq.gz --threads 4
+#
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import subprocess
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+
+try:
+    from isal import igzip
+    HAVE_ISAL = True
+except ImportError:
+    HAVE_ISAL = False
+
+# Sequence lines looked at per batch
+BATCH_SIZE = 200000
+
+READ_BUF = 1 << 20
+
+BASES = ['A', 'C', 'G', 'T', 'N']
+
+SUMMARY_COLS = ['num_reads', 'fq_size', 'mean_len', 'sd_len', 'min_len',
+                'max_len', 'mode_len', 'mode_cnt']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def is_gzip(fq_fn):
+    with open(fq_fn, 'rb') as in_file:
+        return in_file.read(2) == b'\x1f\x8b'
+
+# Open a (possibly gzipped) fastq for reading as bytes
+@contextmanager
+def open_fastq(fq_fn, threads = 1):
+    if not is_gzip(fq_fn):
+        with open(fq_fn, 'rb', buffering = READ_BUF) as in_file:
+            yield in_file
+        return
+
+    if (threads > 1) and shutil.which('pigz'):
+        proc = subprocess.Popen(['pigz', '-dc', '-p', str(threads), fq_fn],
+                                stdout = subprocess.PIPE, bufsize = READ_BUF)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise IOError(f"pigz failed to decompress {fq_fn}")
+        return
+
+    opener = igzip.open if HAVE_ISAL else gzip.open
+    with opener(fq_fn, 'rb') as in_file:
+        yield in_file
+
+# Same format as du -h
+def human_size(n_bytes):
+    for curr_unit in ['', 'K', 'M', 'G', 'T']:
+        if n_bytes < 1024:
+            break
+        n_bytes /= 1024
+
+    return f"{n_bytes:.1f}{curr_unit}" if curr_unit else f"{int(n_bytes)}"
+
+# Stream the file once, building the read length histogram and (if wanted)
+# base counts.
+def scan_fastq(fq_fn, bases = False, threads = 1):
+    len_hist = Counter()
+    base_cnt = Counter()
+
+    with open_fastq(fq_fn, threads) as in_file:
+        # Every 4th line starting with the 2nd is a read's sequence
+        seq_lines = islice(in_file, 1, None, 4)
+
+        while True:
+            batch = list(islice(seq_lines, BATCH_SIZE))
+            if not batch:
+                break
+
+            # rstrip drops the newline (and any \r)
+            batch = list(map(bytes.rstrip, batch))
+            len_hist.update(map(len, batch))
+
+            if bases:
+                blob = b''.join(batch).upper()
+                n_known = 0
+                for curr_base in BASES:
+                    curr_cnt = blob.count(curr_base.encode())
+                    base_cnt[curr_base] += curr_cnt
+                    n_known += curr_cnt
+
+                base_cnt['other'] += len(blob) - n_known
+
+    return len_hist, base_cnt
+
+# Summary stats from the read length histogram
+def hist_stats(len_hist):
+    num_reads = sum(len_hist.values())
+    if num_reads == 0:
+        return {'num_reads' : 0, 'tot_base' : 0, 'mean_len' : None, 'sd_len' : None,
+                'min_len' : None, 'max_len' : None, 'mode_len' : None,
+                'mode_cnt' : None}
+
+    tot_base = sum(x * n for x, n in len_hist.items())
+    mean = tot_base / num_reads
+    sd = (sum(n * (x - mean) ** 2 for x, n in len_hist.items()) / num_reads) ** 0.5
+
+    # Most common length, shortest one on ties
+    mode_len, mode_cnt = min(len_hist.items(), key = lambda x: (-x[1], x[0]))
+
+    return {'num_reads' : num_reads,
+            'tot_base'  : tot_base,
+            'mean_len'  : round(mean, 3),
+            'sd_len'    : round(sd, 3),
+            'min_len'   : min(len_hist),
+            'max_len'   : max(len_hist),
+            'mode_len'  : mode_len,
+            'mode_cnt'  : mode_cnt}
+
+def fastq_stats(fq_fn, bases = False, threads = 1):
+    len_hist, base_cnt = scan_fastq(fq_fn, bases, threads)
+
+    size = os.path.getsize(fq_fn)
+    stats = {'file' : os.path.abspath(fq_fn), 'size_bytes' : size,
+             'fq_size' : human_size(size)}
+    stats.update(hist_stats(len_hist))
+    stats['len_hist'] = {str(x) : len_hist[x] for x in sorted(len_hist)}
+
+    if bases:
+        stats['base_comp'] = dict(base_cnt)
+
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Single pass fastq stats as JSON')
+    parser.add_argument('fastqs', nargs = '+', help = 'Fastq files (plain or gzipped)')
+    parser.add_argument('--bases', action = 'store_true', help = 'Also count base composition')
+    parser.add_argument('--threads', type = int, default = 1, help = 'Threads for decompression')
+    parser.add_argument('--out', default = None, help = 'Write JSON here instead of stdout')
+    parser.add_argument('--summary', action = 'store_true',
+                        help = 'Print the fq_stats values on one tab separated line per file')
+    args = vars(parser.parse_args())
+
+    res = [fastq_stats(x, args['bases'], args['threads']) for x in args['fastqs']]
+
+    out_str = json.dumps(res[0] if len(res) == 1 else res, indent = 1)
+
+    if args['out'] is not None:
+        with open(args['out'], 'w') as out_file:
+            out_file.write(f"{out_str}\n")
+
+    if args['summary']:
+        for curr_stats in res:
+            vals = [curr_stats.get(x) for x in SUMMARY_COLS]
+            print('\t'.join(f"{x:.3f}" if isinstance(x, float) else str(x) for x in vals))
+    elif args['out'] is None:
+        print(out_str)
+
+if __name__ == '__main__':
+    main()
@@ -62,67 +62,20 @@ function dl_file () {
 	fi
 }
 
-# Function to calculate different stats of input fastq file
+# fastq_stats_pub.py lives next to this file
+FUNCS_DIR="$(dirname "$(realpath "${BASH_SOURCE[0]}")")"
+
+# Function to calculate different stats of input fastq file, done in a single
+# pass by fastq_stats_pub.py. Full stats (length histogram, base composition)
+# are saved as JSON in the log directory.
 # $1: Path to 1st fastq file
 function fq_stats () {
 
-	# Number of reads
-	tot_lines=$(wc -l "${1}" | awk '{print $1}')
-	num_reads="$(( tot_lines / 4 ))"
-    fq_size=$(du -h "${1}" | awk '{print $1}')
-
-	# Read length stats
-	# Calculate histogram in form of "read_len cnt"
-	hist=$(awk 'NR%4 == 2 {lengths[length($0)]++} END {for (l in lengths) {print l"\t"lengths[l]}}' "${1}")
-
-	# Mode
-	mode_row=$(echo "${hist}" | sort -k2 -V -r | head -n1)
-	mode_len=$(echo "${mode_row}" | awk '{print $1}')
-	mode_cnt=$(echo "${mode_row}" | awk '{print $2}')
-
-	# Mean
-	# Loop over our histogram
-	tot_base=0
-	while read -r len cnt; do 
-		# Multiply read length by number of reads of that length and add to tot_base
-		tot_base=$(  bc <<< "scale=10; ${tot_base} + (${len} * ${cnt})")
-
-	done < <(printf '%s\n' "${hist}")
-
-	mean=$( bc <<< "scale=10; ${tot_base} / ${num_reads}" )
-
-	# numerator for standard deviation calculation
-	sd_num=0
-
-	while read -r len cnt; do 
-
-		# Multiply read length by number of reads of that length and add to tot_base	
-		curr_num=$( bc <<< "scale=10; ${len} - ${mean}")
-
-		# Square result
-		curr_num=$( bc <<< "scale=10; ${curr_num} * ${curr_num}" )
-
-		# Multiply by freq
-		curr_num=$( bc <<< "scale=10; ${curr_num} * ${cnt}" )
-
-		# Now add to running total
-		sd_num=$( bc <<< "scale=10;  ${sd_num} + ${curr_num}" )
-
-	done < <(printf '%s\\n' "$hist")
-
-	# Calculate SD and round to 3 decimal points
-	sd=$( bc <<< "scale=10; sqrt(${sd_num} / ${num_reads})")
-	sd=$( printf "%.3f\\n" "$(echo "${sd}" | bc -l)")
-
-	# Round mean to 2 decimal points after using it for SD calculation
-	# Rounding: https://stackoverflow.com/a/26465573
-	mean=$( printf "%.3f\\n" "$(echo "${mean}" | bc -l)")
-
-	# Max read len
-	max=$(echo "${hist}" | awk '{print $1}' | sort | tail -n1)
+	stats_json="${LOG_DIR}/$(basename "${1}").stats.json"
 
-	# Min read len
-	min=$(echo "${hist}" | awk '{print $1}' | sort | head -n1)
+	read -r num_reads fq_size mean sd min max mode_len mode_cnt < <(
+		python3 "${FUNCS_DIR}/fastq_stats_pub.py" "${1}" --bases --summary \
+			--out "${stats_json}")
 }
 
 # Requires you to have run fq_stats first, otherwise will fail
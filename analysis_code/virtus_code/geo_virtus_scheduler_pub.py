@@ -0,0 +1,492 @@
+# Name:     geo_virtus_scheduler_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Runs the geo_virtus_pipe_pub.sh steps (download with fasterq-dump -> raw
+#   fastq stats -> VIRTUS -> post-processing -> clean up) over a whole sample
+#   table instead of one SRR per job, overlapping the stages so the next
+#   samples are being downloaded while the current ones are aligning.
+#
+#   Downloads and VIRTUS runs each get their own pool:
+#       --dl_workers    fasterq-dump downloads at once
+#       --max_virtus    VIRTUS (cwltool) runs at once, each with --cores
+#       --prefetch      most samples downloaded (or downloading) but not yet
+#                       handed to VIRTUS
+#   New downloads are also held back while the work directory is using more
+#   than --max_scratch_gb or the disk has less than --min_free_gb free.
+#
+#   Each sample's progress (pending, downloaded, done, failed) is saved to its
+#   own JSON file in the state directory, so re-running the same table skips
+#   finished samples and sends already downloaded ones straight to VIRTUS.
+#   --retry_failed gives failed samples another go.
+#
+#   fasterq-dump and cwltool are called by the names given in --fasterq_dump
+#   and --cwltool, so stub scripts can stand in for them when testing. The
+#   modules the shell script loads (sratoolkit, singularity, nodejs, python)
+#   need to be loaded before starting this.
+#
+#   Sample table: one sample per line, GSE ID, SRX ID, SRR ID and optional
+#   second SRR ID, whitespace separated (the sAJ VAR1 lines).
+#
+#   Usage:
+#       python geo_virtus_scheduler_pub.py --samples ms_samples.txt --dis ms \
+#           --dl_workers 2 --max_virtus 2 --prefetch 4 --max_scratch_gb 500
+#
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from fastq_stats_pub import fastq_stats
+
+HOME_DIR = "/data/pathogen_ncd"
+SINGULARITY_HOME = f"{HOME_DIR}/singularity"
+
+# Resources to give to each VIRTUS run, RAM in GB
+RAM = 150
+CORES = 16
+
+# VIRTUS workflows
+VIRT_SE = f"{HOME_DIR}/virtus/code/VIRTUS/workflow/VIRTUS.SE.cwl"
+VIRT_PE = f"{HOME_DIR}/virtus/code/VIRTUS/workflow/VIRTUS.PE.cwl"
+
+# UKB orgs + Human index file
+STAR_VIR = f"{HOME_DIR}/virtus/procd/indices/manual/STAR_index_virus"
+STAR_HUMAN = f"{HOME_DIR}/virtus/procd/indices/local/STAR_index_human"
+SALMON_IDX = f"{HOME_DIR}/virtus/procd/indices/local/salmon_index_human"
+
+# Table to convert NC IDs to organism names
+CONV_TAB = f"{HOME_DIR}/virtus/procd/ncbi_id_conv_table.txt"
+
+VIRTUS_HIT_THRESH = 0
+
+# Maximum number of times to try to re-run fasterq-dump
+MAX_DL_RETRIES = 5
+
+# Files bigger than this are removed from the work dir when cleaning up
+CLEAN_SIZE = 75 * 1024 * 1024
+
+# How often (s) to re-check the disk when downloads are being held back
+POLL = 30
+
+RES_COLS = ['virus_id', 'virus_name', 'num_hit', 'rate_hit', 'genome_len', 'mapped_human']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def ds():
+    return datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+
+def log(msg, log_fn = None):
+    line = f"{ds()} {msg}"
+    print(line, flush = True)
+
+    if log_fn is not None:
+        with open(log_fn, 'a') as out_file:
+            out_file.write(f"{line}\n")
+
+# Read the sample table into a list of dicts
+def read_samples(sample_fn):
+    samples = []
+    with open(sample_fn, 'r') as in_file:
+        for line in in_file:
+            parts = line.split()
+            if len(parts) < 3:
+                continue
+
+            samples.append({'gse'  : parts[0],
+                            'srx'  : parts[1],
+                            'srr'  : parts[2],
+                            'srr2' : parts[3] if len(parts) > 3 else None})
+
+    return samples
+
+def samp_key(samp):
+    return (samp['gse'], samp['srx'], samp['srr'])
+
+# Where everything for one sample goes, laid out like geo_virtus_pipe_pub.sh
+def sample_paths(cfg, samp):
+    gse, srx, srr = samp['gse'], samp['srx'], samp['srr']
+
+    return {'work_dir'    : f"{cfg['work_dir']}/{gse}/{srr}",
+            'res_dir'     : f"{cfg['res_dir']}/{gse}",
+            'scratch_dir' : f"{cfg['scratch_dir']}/{gse}/{srr}",
+            'out_log'     : f"{cfg['log_dir']}/{gse}_{srx}.out",
+            'err_log'     : f"{cfg['log_dir']}/{gse}_{srx}.err",
+            'state_fn'    : f"{cfg['state_dir']}/{gse}_{srx}_{srr}.json"}
+
+def load_state(state_fn):
+    if not os.path.exists(state_fn):
+        return {'stage' : 'pending', 'dl_tries' : 0, 'virtus_tries' : 0}
+
+    with open(state_fn, 'r') as in_file:
+        return json.load(in_file)
+
+def save_state(state_fn, state):
+    state['updated'] = ds()
+
+    tmp_fn = f"{state_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, 'w') as out_file:
+        json.dump(state, out_file, indent = 1)
+
+    os.replace(tmp_fn, state_fn)
+
+# Bytes used by everything under a directory
+def dir_size(path):
+    tot = 0
+    for root, _, files in os.walk(path):
+        for curr_fn in files:
+            try:
+                tot += os.path.getsize(os.path.join(root, curr_fn))
+            except OSError:
+                pass
+
+    return tot
+
+# Whether there is room to start another download
+def disk_ok(cfg):
+    free_gb = shutil.disk_usage(cfg['work_dir']).free / 1e9
+    used_gb = dir_size(cfg['work_dir']) / 1e9
+
+    return (free_gb >= cfg['min_free_gb']) and (used_gb < cfg['max_scratch_gb'])
+
+# Run fasterq-dump for one SRR in the current sample's work dir, retrying like
+# dl_file does. fasterq-dump doesn't always exit non-zero on failure so any
+# 'err' in its output counts as a failure too.
+def fasterq_dump(cfg, srr, work_dir, out_log):
+    for curr_try in range(MAX_DL_RETRIES):
+        proc = subprocess.run([cfg['fasterq_dump'], srr, '-p', '-o', f"{srr}.fastq"],
+                              cwd = work_dir, stdout = subprocess.PIPE,
+                              stderr = subprocess.STDOUT, text = True)
+
+        with open(out_log, 'a') as out_file:
+            out_file.write(proc.stdout)
+
+        if (proc.returncode == 0) and ('err' not in proc.stdout):
+            return True
+
+        log(f"fasterq-dump failed for {srr} (try {curr_try + 1} of {MAX_DL_RETRIES})", out_log)
+
+    return False
+
+# Get a sample's fastq file(s) into its work dir, reusing copies left in
+# scratch by an earlier run. Returns (mode, fastq paths) or None on failure.
+def download(cfg, samp):
+    paths = sample_paths(cfg, samp)
+    work_dir = paths['work_dir']
+    srr = samp['srr']
+
+    os.makedirs(work_dir, exist_ok = True)
+
+    se_scratch = f"{paths['scratch_dir']}/{srr}.fastq"
+    pe_scratch = [f"{paths['scratch_dir']}/{srr}_1.fastq", f"{paths['scratch_dir']}/{srr}_2.fastq"]
+
+    if os.path.exists(se_scratch):
+        log(f"Found {se_scratch} already downloaded, reusing", paths['out_log'])
+        shutil.copy(se_scratch, work_dir)
+
+    elif all(os.path.exists(x) for x in pe_scratch):
+        log(f"Found {pe_scratch[0]} and {pe_scratch[1]} already downloaded, reusing", paths['out_log'])
+        for curr_fn in pe_scratch:
+            shutil.copy(curr_fn, work_dir)
+
+    else:
+        start = time.time()
+        if not fasterq_dump(cfg, srr, work_dir, paths['out_log']):
+            return None
+
+        # A second SRR for this SRX is appended to the first
+        if samp['srr2']:
+            if not fasterq_dump(cfg, samp['srr2'], work_dir, paths['out_log']):
+                return None
+
+            cat_path = f"{work_dir}/{samp['srr2']}.fastq"
+            with open(f"{work_dir}/{srr}.fastq", 'ab') as out_file, open(cat_path, 'rb') as in_file:
+                shutil.copyfileobj(in_file, out_file)
+            os.remove(cat_path)
+
+        log(f"Downloaded {srr} in {time.time() - start:.0f}s", paths['out_log'])
+
+    pe_paths = [f"{work_dir}/{srr}_1.fastq", f"{work_dir}/{srr}_2.fastq"]
+    if all(os.path.exists(x) for x in pe_paths):
+        mode, fastqs = 'PE', pe_paths
+    elif os.path.exists(f"{work_dir}/{srr}.fastq"):
+        mode, fastqs = 'SE', [f"{work_dir}/{srr}.fastq"]
+    else:
+        log(f"No fastq file found for {srr} after download", paths['err_log'])
+        return None
+
+    # Raw fastq stats for the logs, full stats saved next to them as JSON
+    for curr_fn in fastqs:
+        stats = fastq_stats(curr_fn, bases = True)
+
+        with open(f"{cfg['log_dir']}/{os.path.basename(curr_fn)}.stats.json", 'w') as out_file:
+            json.dump(stats, out_file, indent = 1)
+
+        log(f"Fastq stats for {os.path.basename(curr_fn)}: {stats['num_reads']:,} reads, "
+            f"{stats['fq_size']}, length {stats['mean_len']} +/- {stats['sd_len']} "
+            f"[{stats['min_len']}-{stats['max_len']}], mode {stats['mode_len']}",
+            paths['out_log'])
+
+    return mode, fastqs
+
+# Same cwltool call as run_virtus
+def virtus_cmd(cfg, samp, mode, fastqs):
+    cmd = [cfg['cwltool'], '--basedir', '.', '--outdir', './out',
+           '--tmpdir-prefix', f"./tmp/{samp['srr']}", '--singularity']
+
+    if mode == 'SE':
+        cmd += [VIRT_SE, '--fastq', fastqs[0]]
+    else:
+        cmd += [VIRT_PE, '--fastq1', fastqs[0], '--fastq2', fastqs[1]]
+
+    cmd += ['--genomeDir_human', STAR_HUMAN, '--genomeDir_virus', STAR_VIR,
+            '--salmon_index_human', SALMON_IDX, '--salmon_quantdir_human', 'salmon_out',
+            '--hit_cutoff', str(VIRTUS_HIT_THRESH), '--nthreads', str(cfg['cores'])]
+
+    return cmd
+
+# Normalize VIRTUS output the same way the shell script does: add organism
+# names and genome lengths from the conversion table and the number of reads
+# mapped to human (STAR's unique + multi-mapped).
+def post_process(samp, paths, conv_tab = CONV_TAB):
+    out_dir = f"{paths['work_dir']}/out"
+    virtus_out = f"{paths['res_dir']}/{samp['srr']}_virtus_out.tsv"
+    virtus_out_orig = f"{paths['res_dir']}/{samp['srr']}_virtus_out_orig.tsv"
+
+    shutil.copy(f"{out_dir}/virus.counts.final.tsv", virtus_out_orig)
+
+    mapped = {}
+    with open(f"{out_dir}/Log.final.out", 'r') as in_file:
+        for line in in_file:
+            if '|' in line:
+                key, val = line.split('|', 1)
+                mapped[key.strip()] = val.strip()
+
+    tot_mapped = (int(mapped['Uniquely mapped reads number']) +
+                  int(mapped['Number of reads mapped to multiple loci']))
+
+    res = pd.read_csv(virtus_out_orig, sep = '\t', header = None, dtype = str,
+                      usecols = [0, 1, 2], names = ['virus_id', 'num_hit', 'rate_hit'])
+    conv = pd.read_csv(conv_tab, sep = '\t', header = None, dtype = str,
+                       usecols = [0, 2, 3], names = ['virus_name', 'virus_id', 'genome_len'])
+
+    # Inner join like the shell's join, so VIRTUS' header line drops out
+    res = res.merge(conv, on = 'virus_id')
+    res['mapped_human'] = tot_mapped
+    res = res.sort_values('num_hit', kind = 'stable')
+
+    res.to_csv(virtus_out, sep = '\t', index = False, columns = RES_COLS)
+
+    return virtus_out
+
+# clean_virtus: drop BAMs (but the filtered viral one), large fastq files and
+# singularity images from the work dir. With fastqs = True the sample's own
+# fastq files go too (clean_success).
+def clean_work_dir(work_dir, fastqs = None):
+    for curr_fn in fastqs or []:
+        if os.path.exists(curr_fn):
+            os.remove(curr_fn)
+
+    for root, _, files in os.walk(work_dir):
+        for curr_fn in files:
+            full_fn = os.path.join(root, curr_fn)
+            lower_fn = curr_fn.lower()
+
+            is_bam = (lower_fn.endswith('.bam') and
+                      (curr_fn != 'virusAligned.filtered.sortedByCoord.out.bam'))
+            is_big_fq = (('.fastq' in lower_fn or 'fq' in lower_fn) and
+                         (os.path.getsize(full_fn) > CLEAN_SIZE))
+
+            if is_bam or is_big_fq or lower_fn.endswith('.sif'):
+                os.remove(full_fn)
+
+# Run VIRTUS on a downloaded sample, post-process and clean up. Returns the
+# results file or None on failure.
+def run_virtus(cfg, samp, mode, fastqs):
+    paths = sample_paths(cfg, samp)
+    work_dir = paths['work_dir']
+
+    os.makedirs(f"{work_dir}/out", exist_ok = True)
+    os.makedirs(f"{work_dir}/tmp", exist_ok = True)
+    os.makedirs(paths['res_dir'], exist_ok = True)
+
+    env = dict(os.environ, SINGULARITYENV_TMPDIR = SINGULARITY_HOME,
+               SINGULARITY_CACHEDIR = SINGULARITY_HOME,
+               CWL_SINGULARITY_CACHE = SINGULARITY_HOME)
+
+    cmd = virtus_cmd(cfg, samp, mode, fastqs)
+    log(f"Starting VIRTUS for {samp['srr']} ({mode}):\n\t\t{' '.join(cmd)}", paths['out_log'])
+
+    start = time.time()
+    with open(paths['out_log'], 'a') as out_file:
+        ret = subprocess.run(cmd, cwd = work_dir, env = env, stdout = out_file,
+                             stderr = subprocess.STDOUT).returncode
+
+    log(f"Finished VIRTUS for {samp['srr']} in {time.time() - start:.0f}s", paths['out_log'])
+
+    if ret != 0:
+        log(f"VIRTUS failed for {samp['srr']}, cleaning up", paths['err_log'])
+        clean_work_dir(work_dir)
+        return None
+
+    virtus_out = post_process(samp, paths, cfg['conv_tab'])
+    clean_work_dir(work_dir, fastqs)
+
+    return virtus_out
+
+# Run every sample in the table, downloads and VIRTUS runs overlapping.
+# Returns the number of samples in each final stage.
+def schedule(cfg, samples):
+    for curr_dir in [cfg['work_dir'], cfg['res_dir'], cfg['log_dir'], cfg['state_dir']]:
+        os.makedirs(curr_dir, exist_ok = True)
+
+    states = {}
+    pending = deque()
+    ready = deque()
+
+    for samp in samples:
+        state = load_state(sample_paths(cfg, samp)['state_fn'])
+
+        if (state['stage'] == 'failed') and cfg['retry_failed']:
+            state['stage'] = 'pending'
+
+        # Downloaded (or interrupted mid VIRTUS) last time and the fastq files
+        # are still there, go straight to VIRTUS. Anything else unfinished
+        # starts over from the download.
+        if ((state['stage'] in ['downloaded', 'running']) and
+                all(os.path.exists(x) for x in state['fastqs'])):
+            ready.append(samp)
+        elif state['stage'] not in ['done', 'failed']:
+            state['stage'] = 'pending'
+            pending.append(samp)
+
+        states[samp_key(samp)] = state
+
+    log(f"{len(samples):,} samples: {len(pending):,} to download, {len(ready):,} already "
+        f"downloaded, {sum(x['stage'] == 'done' for x in states.values()):,} done")
+
+    dl_futs = {}
+    virt_futs = {}
+    held = False
+
+    def set_stage(samp, **kwargs):
+        state = states[samp_key(samp)]
+        state.update(kwargs)
+        save_state(sample_paths(cfg, samp)['state_fn'], state)
+
+        return state
+
+    with ThreadPoolExecutor(cfg['dl_workers']) as dl_pool, \
+         ThreadPoolExecutor(cfg['max_virtus']) as virt_pool:
+
+        while pending or ready or dl_futs or virt_futs:
+
+            # Hand downloaded samples to VIRTUS while there are free slots
+            while ready and (len(virt_futs) < cfg['max_virtus']):
+                samp = ready.popleft()
+                state = set_stage(samp, stage = 'running',
+                                  virtus_tries = states[samp_key(samp)]['virtus_tries'] + 1)
+                virt_futs[virt_pool.submit(run_virtus, cfg, samp, state['mode'], state['fastqs'])] = samp
+
+            # Prefetch more samples if we have room for them
+            while (pending and (len(dl_futs) < cfg['dl_workers']) and
+                   (len(ready) + len(dl_futs) < cfg['prefetch'])):
+
+                if not disk_ok(cfg):
+                    if not held:
+                        log("Scratch space is low, holding back downloads")
+                    held = True
+                    break
+
+                held = False
+                samp = pending.popleft()
+                set_stage(samp, stage = 'downloading',
+                          dl_tries = states[samp_key(samp)]['dl_tries'] + 1)
+                dl_futs[dl_pool.submit(download, cfg, samp)] = samp
+
+            if not (dl_futs or virt_futs):
+                if held:
+                    log("Nothing running to free up scratch space, stopping. "
+                        "Free up space and re-run to pick up where we left off")
+                    break
+                continue
+
+            done, _ = wait(list(dl_futs) + list(virt_futs),
+                           timeout = POLL if held else None,
+                           return_when = FIRST_COMPLETED)
+
+            for curr_fut in done:
+                if curr_fut in dl_futs:
+                    samp = dl_futs.pop(curr_fut)
+                    res = curr_fut.exception() or curr_fut.result()
+
+                    if isinstance(res, tuple):
+                        set_stage(samp, stage = 'downloaded', mode = res[0], fastqs = res[1])
+                        ready.append(samp)
+                    else:
+                        set_stage(samp, stage = 'failed', error = f"download: {res or 'failed'}")
+                        log(f"Download failed for {samp['srr']}")
+
+                else:
+                    samp = virt_futs.pop(curr_fut)
+                    res = curr_fut.exception() or curr_fut.result()
+
+                    if isinstance(res, str):
+                        set_stage(samp, stage = 'done', result = res)
+                        log(f"Finished {samp['gse']} {samp['srr']}: {res}")
+                    else:
+                        set_stage(samp, stage = 'failed', error = f"virtus: {res or 'failed'}")
+                        log(f"VIRTUS failed for {samp['srr']}")
+
+    return pd.Series([x['stage'] for x in states.values()]).value_counts().to_dict()
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Overlapped download / VIRTUS scheduler for GEO samples')
+    parser.add_argument('--samples', required = True, help = 'Table of GSE SRX SRR [SRR2] lines')
+    parser.add_argument('--dis', required = True, help = 'Disease abbreviation used in directory names, ms or sle, etc.')
+    parser.add_argument('--dl_workers', type = int, default = 2, help = 'Downloads at once')
+    parser.add_argument('--max_virtus', type = int, default = 1, help = 'VIRTUS runs at once')
+    parser.add_argument('--cores', type = int, default = CORES, help = 'Threads for each VIRTUS run')
+    parser.add_argument('--prefetch', type = int, default = 2,
+                        help = 'Most samples downloaded but waiting on VIRTUS')
+    parser.add_argument('--max_scratch_gb', type = float, default = 500,
+                        help = 'Hold back downloads while the work dir uses more than this')
+    parser.add_argument('--min_free_gb', type = float, default = 100,
+                        help = 'Hold back downloads while the disk has less than this free')
+    parser.add_argument('--retry_failed', action = 'store_true', help = 'Try failed samples again')
+    parser.add_argument('--fasterq_dump', default = 'fasterq-dump', help = 'fasterq-dump executable')
+    parser.add_argument('--cwltool', default = 'cwltool', help = 'cwltool executable')
+    parser.add_argument('--base_dir', default = f"{HOME_DIR}/virtus", help = 'VIRTUS base directory')
+    parser.add_argument('--conv_tab', default = CONV_TAB, help = 'NC ID to organism name table')
+    args = vars(parser.parse_args())
+
+    base_dir = args['base_dir']
+    dis = args['dis']
+
+    cfg = dict(args,
+               work_dir = f"{base_dir}/data/{dis}",
+               res_dir = f"{base_dir}/results/{dis}",
+               log_dir = f"{base_dir}/code/{dis}/logs",
+               scratch_dir = f"{base_dir}/scratch/{dis}_files",
+               state_dir = f"{base_dir}/code/{dis}/state")
+
+    samples = read_samples(args['samples'])
+    counts = schedule(cfg, samples)
+
+    log(f"Samples by stage: {counts}")
+
+if __name__ == '__main__':
+    main()
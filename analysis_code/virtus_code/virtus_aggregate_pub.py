@@ -0,0 +1,293 @@
+# Name:     virtus_aggregate_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Collects the per-SRR VIRTUS results written by geo_virtus_pipe_pub.sh /
+#   geo_virtus_scheduler_pub.py ({res_dir}/{dis}/{gse}/{srr}_virtus_out.tsv)
+#   into one sample x virus read count matrix for the downstream comparisons
+#   (e.g. CMV in UC vs controls).
+#
+#   The results tree is scanned incrementally: a manifest keeps the size and
+#   mtime of every result file already read, along with the long (sample,
+#   virus, count) table of hits and a per-sample table built from them, so a
+#   re-run only reads samples that are new or changed and drops samples whose
+#   result file is gone. A sample with no viral hits (header only result file)
+#   is still a sample, it gets an all zero row in the matrix. Its mapped_human
+#   isn't in the result file then, so it is read from the STAR log VIRTUS left
+#   in the sample's work dir (--data_dir) if that is still around.
+#
+#   Outputs in --out_dir:
+#       virtus_counts.npz       sparse CSR int32 matrix, samples x viruses
+#       virtus_samples.*        one row per matrix row: disease, GSE, SRX,
+#                               SRR, second SRR, human mapped reads, total
+#                               viral reads (from the GSE sample tables)
+#       virtus_viruses.*        one row per matrix column: NC ID, name,
+#                               genome length
+#       virtus_long.*           the long table (also the incremental cache)
+#       virtus_sample_cache.*   every result file read (incremental cache)
+#   Tables are Parquet if pyarrow is installed, otherwise TSV.
+#
+#   Usage:
+#       python virtus_aggregate_pub.py --samples ms_samples.txt uc_samples.txt
+#
+#   Downstream:
+#       from virtus_aggregate_pub import load_matrix
+#       counts, samples, viruses = load_matrix(out_dir)
+#
+
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    import pyarrow
+    HAVE_ARROW = True
+except ImportError:
+    HAVE_ARROW = False
+
+HOME_DIR = "/data/pathogen_ncd"
+RES_DIR = f"{HOME_DIR}/virtus/results"
+DATA_DIR = f"{HOME_DIR}/virtus/data"
+OUT_DIR = f"{HOME_DIR}/virtus/results/aggregated"
+
+MANIFEST_FN = 'manifest.tsv'
+
+# Types of the columns in a post-processed VIRTUS result file
+VIRTUS_DTYPES = {'virus_id'     : 'string',
+                 'virus_name'   : 'string',
+                 'num_hit'      : 'int64',
+                 'rate_hit'     : 'float64',
+                 'genome_len'   : 'Int64',
+                 'mapped_human' : 'int64'}
+
+SAMPLE_COLS = ['gse', 'srx', 'srr', 'srr2']
+
+# One row per result file read, hits or not
+SAMP_CACHE_DTYPES = {'res_fn'       : 'string',
+                     'dis'          : 'string',
+                     'gse'          : 'string',
+                     'srr'          : 'string',
+                     'mapped_human' : 'Int64'}
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def table_fn(out_dir, stub):
+    ext = 'parquet' if HAVE_ARROW else 'tsv'
+
+    return f"{out_dir}/{stub}.{ext}"
+
+def write_table(df, out_fn):
+    tmp_fn = f"{out_fn}.{os.getpid()}.tmp"
+
+    if out_fn.endswith('.parquet'):
+        df.to_parquet(tmp_fn, index = False)
+    else:
+        df.to_csv(tmp_fn, sep = '\t', index = False)
+
+    os.replace(tmp_fn, out_fn)
+
+def read_table(in_fn, dtypes = None):
+    if in_fn.endswith('.parquet'):
+        return pd.read_parquet(in_fn)
+
+    return pd.read_csv(in_fn, sep = '\t', dtype = dtypes)
+
+# Reads mapped to human (STAR's unique + multi-mapped, like the post
+# processing in geo_virtus_pipe_pub.sh) from a Log.final.out, None if the log
+# is gone.
+def read_star_mapped(log_fn):
+    if not os.path.exists(log_fn):
+        return None
+
+    mapped = {}
+    with open(log_fn, 'r') as in_file:
+        for line in in_file:
+            if '|' in line:
+                key, val = line.split('|', 1)
+                mapped[key.strip()] = val.strip()
+
+    return (int(mapped['Uniquely mapped reads number']) +
+            int(mapped['Number of reads mapped to multiple loci']))
+
+# One sample's result file, with the disease, GSE and SRR taken from where it
+# sits in the results tree. Returns the hit rows (none for a sample without
+# viral hits) and the sample's row for the per-sample table.
+def read_virtus_out(res_fn, data_dir = DATA_DIR):
+    res = pd.read_csv(res_fn, sep = '\t', dtype = VIRTUS_DTYPES)
+
+    gse_dir = os.path.dirname(res_fn)
+    samp = {'res_fn' : res_fn,
+            'dis'    : os.path.basename(os.path.dirname(gse_dir)),
+            'gse'    : os.path.basename(gse_dir),
+            'srr'    : os.path.basename(res_fn).replace('_virtus_out.tsv', '')}
+
+    for curr_col in ['res_fn', 'dis', 'gse', 'srr']:
+        res[curr_col] = samp[curr_col]
+
+    if len(res):
+        samp['mapped_human'] = res['mapped_human'].iloc[0]
+    else:
+        samp['mapped_human'] = read_star_mapped(f"{data_dir}/{samp['dis']}/{samp['gse']}/"
+                                                f"{samp['srr']}/out/Log.final.out")
+
+    return res, samp
+
+# GSE sample tables (GSE SRX SRR [SRR2] lines) for the sample metadata
+def read_sample_tables(sample_fns):
+    rows = []
+    for curr_fn in sample_fns:
+        with open(curr_fn, 'r') as in_file:
+            for line in in_file:
+                parts = line.split()
+                if len(parts) >= 3:
+                    rows.append((parts + [None])[:4])
+
+    return pd.DataFrame(rows, columns = SAMPLE_COLS).drop_duplicates(['gse', 'srr'])
+
+def load_manifest(out_dir):
+    manifest_fn = f"{out_dir}/{MANIFEST_FN}"
+    if not os.path.exists(manifest_fn):
+        return pd.DataFrame(columns = ['res_fn', 'size', 'mtime_ns'])
+
+    return pd.read_csv(manifest_fn, sep = '\t')
+
+# Concat the non-empty tables in df_ls, or an empty copy of like if they are
+# all empty
+def stack(df_ls, like):
+    df_ls = [x for x in df_ls if len(x)]
+    if len(df_ls) == 0:
+        return like.iloc[:0]
+
+    return pd.concat(df_ls, ignore_index = True)
+
+# Bring the long (hits) and per-sample tables up to date with the result
+# files under res_dir. Returns them and the number of files read.
+def update_long(res_dir, out_dir, data_dir = DATA_DIR):
+    manifest = load_manifest(out_dir)
+
+    long_fn = table_fn(out_dir, 'virtus_long')
+    samp_fn = table_fn(out_dir, 'virtus_sample_cache')
+    if os.path.exists(long_fn) and os.path.exists(samp_fn) and len(manifest):
+        seen = {row.res_fn : (row.size, row.mtime_ns) for row in manifest.itertuples()}
+        long_df = read_table(long_fn, dict(VIRTUS_DTYPES, res_fn = str, dis = str,
+                                           gse = str, srr = str))
+        samp_df = read_table(samp_fn, {'res_fn' : str, 'dis' : str, 'gse' : str, 'srr' : str})
+    else:
+        # Nothing (or only part of the cache) to go on, read everything
+        seen = {}
+        long_df = pd.DataFrame(columns = list(VIRTUS_DTYPES) + ['res_fn', 'dis', 'gse', 'srr'])
+        samp_df = pd.DataFrame(columns = list(SAMP_CACHE_DTYPES))
+
+    res_fns = sorted(glob.glob(f"{res_dir}/*/*/*_virtus_out.tsv"))
+
+    man_ls = []
+    new_ls = []
+    new_samp_ls = []
+    for curr_fn in res_fns:
+        st = os.stat(curr_fn)
+        man_ls.append([curr_fn, st.st_size, st.st_mtime_ns])
+
+        if seen.get(curr_fn) != (st.st_size, st.st_mtime_ns):
+            curr_hits, curr_samp = read_virtus_out(curr_fn, data_dir)
+            new_ls.append(curr_hits)
+            new_samp_ls.append(curr_samp)
+
+    # Keep what we had for files that are unchanged and still there, every
+    # changed file is replaced, even if it now has no hits at all
+    new_fns = set(x['res_fn'] for x in new_samp_ls)
+    keep = long_df['res_fn'].isin(res_fns) & ~long_df['res_fn'].isin(new_fns)
+    long_df = stack([long_df.loc[keep, :]] + new_ls, long_df).astype(VIRTUS_DTYPES)
+
+    keep = samp_df['res_fn'].isin(res_fns) & ~samp_df['res_fn'].isin(new_fns)
+    samp_df = stack([samp_df.loc[keep, :],
+                     pd.DataFrame(new_samp_ls, columns = list(SAMP_CACHE_DTYPES))],
+                    samp_df).astype(SAMP_CACHE_DTYPES)
+
+    write_table(long_df, long_fn)
+    write_table(samp_df, samp_fn)
+
+    manifest = pd.DataFrame(man_ls, columns = ['res_fn', 'size', 'mtime_ns'])
+    tmp_fn = f"{out_dir}/{MANIFEST_FN}.{os.getpid()}.tmp"
+    manifest.to_csv(tmp_fn, sep = '\t', index = False)
+    os.replace(tmp_fn, f"{out_dir}/{MANIFEST_FN}")
+
+    return long_df, samp_df, len(new_samp_ls)
+
+# Sample x virus count matrix from the long table, with the row (sample) and
+# column (virus) tables that go with it. Every sample in samp_df gets a row,
+# samples without any hits are all zero.
+def build_matrix(long_df, samp_df, sample_tab = None):
+    samples = samp_df.sort_values('res_fn').reset_index(drop = True)
+    samp_pos = pd.Index(samples['res_fn'].astype(str)).get_indexer(long_df['res_fn'].astype(str))
+    virus_cat = pd.Categorical(long_df['virus_id'].astype(str))
+
+    counts = sp.csr_matrix((long_df['num_hit'].to_numpy(np.int32),
+                            (samp_pos, virus_cat.codes)),
+                           shape = (len(samples), len(virus_cat.categories)),
+                           dtype = np.int32)
+
+    samples['tot_hit'] = np.asarray(counts.sum(axis = 1)).ravel()
+
+    if sample_tab is not None:
+        samples = samples.merge(sample_tab[['gse', 'srr', 'srx', 'srr2']],
+                                on = ['gse', 'srr'], how = 'left')
+
+    viruses = (long_df.groupby(long_df['virus_id'].astype(str), sort = True)
+                      .agg(virus_name = ('virus_name', 'first'),
+                           genome_len = ('genome_len', 'first'))
+                      .reindex(virus_cat.categories)
+                      .rename_axis('virus_id')
+                      .reset_index())
+
+    return counts, samples, viruses
+
+def save_matrix(counts, samples, viruses, out_dir):
+    tmp_fn = f"{out_dir}/virtus_counts.{os.getpid()}.tmp.npz"
+    sp.save_npz(tmp_fn, counts)
+    os.replace(tmp_fn, f"{out_dir}/virtus_counts.npz")
+
+    write_table(samples, table_fn(out_dir, 'virtus_samples'))
+    write_table(viruses, table_fn(out_dir, 'virtus_viruses'))
+
+# Load the saved matrix and its row/column tables
+def load_matrix(out_dir = OUT_DIR):
+    counts = sp.load_npz(f"{out_dir}/virtus_counts.npz")
+    samples = read_table(table_fn(out_dir, 'virtus_samples'),
+                         {'gse' : str, 'srx' : str, 'srr' : str, 'srr2' : str})
+    viruses = read_table(table_fn(out_dir, 'virtus_viruses'), {'virus_id' : str})
+
+    return counts, samples, viruses
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Aggregate VIRTUS results into a sample x virus matrix')
+    parser.add_argument('--res_dir', default = RES_DIR, help = 'VIRTUS results directory ({dis}/{gse}/...)')
+    parser.add_argument('--out_dir', default = OUT_DIR, help = 'Where to write the matrix')
+    parser.add_argument('--data_dir', default = DATA_DIR,
+                        help = 'VIRTUS work directory ({dis}/{gse}/{srr}/out/Log.final.out), '
+                               'for mapped_human of samples without hits')
+    parser.add_argument('--samples', nargs = '*', default = [],
+                        help = 'GSE sample tables (GSE SRX SRR [SRR2] lines) for sample metadata')
+    args = vars(parser.parse_args())
+
+    os.makedirs(args['out_dir'], exist_ok = True)
+
+    long_df, samp_df, n_read = update_long(args['res_dir'], args['out_dir'], args['data_dir'])
+
+    sample_tab = read_sample_tables(args['samples']) if args['samples'] else None
+    counts, samples, viruses = build_matrix(long_df, samp_df, sample_tab)
+    save_matrix(counts, samples, viruses, args['out_dir'])
+
+    print(f"Read {n_read:,} new or changed samples, matrix is {counts.shape[0]:,} samples x "
+          f"{counts.shape[1]:,} viruses ({counts.nnz:,} non-zero)")
+
+if __name__ == '__main__':
+    main()
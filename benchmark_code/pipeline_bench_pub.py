@@ -0,0 +1,532 @@
+# Name:     pipeline_bench_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   End to end benchmarks of the data prep and analysis stages on synthetic
+#   data (synth_data_gen_pub.py) at several scales, so we can see how long a
+#   stage takes at a given size, how it scales, and whether a change made it
+#   slower.
+#
+#   Stages (each run as its own process with PATHOGEN_NCD_HOME pointed at the
+#   synthetic data):
+#       synth        synth_data_gen_pub.py itself
+#       chunk_diags  process_patient_ids from tnx_phecode_chunking_diags_pub.py
+#                    over the sorted 4 column diagnosis file
+#       icd_pairs    tnx_icd_gen_pairs_pub.py on the most common ICD10 code
+#       phe_pairs    tnx_phecode_generating_pairs_pub.py on the largest
+#                    Phecode slice
+#       emp_p        ukb_icd_empirical_p_calculations_pub.py on one disease
+#                    (10,000 permutations x 45 antibodies)
+#
+#   A scale is {patients}x{LOINCs}, e.g. 20000x100. For every stage and scale
+#   we record wall time, peak RSS (largest process in the stage's tree), input
+#   rows/sec and the size of what the stage wrote. Records are appended to a
+#   JSON lines history in --work_dir, one line per stage per scale, tagged
+#   with the run id and git commit.
+#
+#   save-baseline stores a run as the baseline. compare checks a run against
+#   it, flags any stage/scale that got slower or bigger than --tol, or that
+#   now fails, and prints the fitted scaling exponent (slope of log time vs
+#   log patients at fixed LOINCs, and vs log LOINCs at fixed patients) so
+#   linear vs quadratic behaviour shows up. Exits 1 if anything regressed.
+#
+#   Synthetic data for each scale is cached under --work_dir/data and reused
+#   while its synth_params.json matches, unless the synth stage is run.
+#
+#   Usage:
+#       python pipeline_bench_pub.py run --scales 10000x100 20000x100 40000x100 40000x200
+#       python pipeline_bench_pub.py save-baseline
+#       # ... change some code ...
+#       python pipeline_bench_pub.py run --stages icd_pairs phe_pairs
+#       python pipeline_bench_pub.py compare --tol 0.25
+#
+
+import argparse
+import glob
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREP_DIR = f"{REPO_DIR}/data_prep_code"
+ANALYSIS_DIR = f"{REPO_DIR}/analysis_code"
+
+HOME_DIR = "/data/pathogen_ncd"
+WORK_DIR = f"{HOME_DIR}/benchmarks"
+
+HISTORY_FN = 'bench_history.jsonl'
+BASELINE_FN = 'bench_baseline.json'
+
+OUR_SEED = 5
+
+STAGES = ['synth', 'chunk_diags', 'icd_pairs', 'phe_pairs', 'emp_p']
+DEF_STAGES = ['chunk_diags', 'icd_pairs', 'phe_pairs', 'emp_p']
+DEF_SCALES = ['10000x100', '20000x100', '40000x100', '40000x200']
+
+# Directories (relative to the data dir) each stage writes to, cleared
+# before every run so the output size is just that run's
+STAGE_OUT = {'synth'       : [],
+             'chunk_diags' : ['phecode/tnx/tnx_procd/py_diags'],
+             'icd_pairs'   : ['trinetx/pair_data'],
+             'phe_pairs'   : ['phecode/tnx/phecode_lab_pair_final'],
+             'emp_p'       : ['results/perm_p_sims/emp_calcs']}
+
+# Rows per chunk file for chunk_diags, small enough that even the smaller
+# scales write several files per process
+CHUNK_LIM = 200000
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def parse_scale(scale):
+    n_pats, n_loincs = scale.lower().split('x')
+
+    return int(n_pats), int(n_loincs)
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', '-C', REPO_DIR, 'rev-parse', '--short', 'HEAD'],
+                             capture_output = True, text = True, check = True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def count_lines(in_fn):
+    n = 0
+    with open(in_fn, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(1 << 20), b''):
+            n += block.count(b'\n')
+
+    return n
+
+def dir_bytes(in_dir):
+    tot = 0
+    for root, _, files in os.walk(in_dir):
+        for curr_fn in files:
+            curr_fp = os.path.join(root, curr_fn)
+            if not os.path.islink(curr_fp):
+                tot += os.path.getsize(curr_fp)
+
+    return tot
+
+def largest(pattern):
+    fns = glob.glob(pattern)
+    if not fns:
+        return None
+
+    return max(fns, key = lambda x: (os.path.getsize(x), x))
+
+# Run a command, returning wall time, peak RSS in MB (of the largest process
+# in its tree, from wait4) and the return code. Output goes to log_fn.
+def timed_run(cmd, env, log_fn, cwd):
+    with open(log_fn, 'w') as log_file:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, env = env, cwd = cwd, stdout = log_file,
+                                stderr = subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+
+    # Keep Popen from trying to reap it again
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    return wall, usage.ru_maxrss / 1024, proc.returncode
+
+def tail(in_fn, n = 5):
+    with open(in_fn, 'r', errors = 'replace') as in_file:
+        return [x.rstrip() for x in in_file.readlines()[-n:]]
+
+############################################
+#                                          #
+#           Synthetic data                 #
+#                                          #
+############################################
+
+def synth_cmd(data_dir, n_pats, n_loincs, args):
+    return [sys.executable, f"{PREP_DIR}/synth_data_gen_pub.py", '--out_dir', data_dir,
+            '--seed', str(args['seed']), '--parts', 'tnx', 'ukb', 'perms',
+            '--n_pats', str(n_pats), '--n_loincs', str(n_loincs),
+            '--workers', str(args['synth_workers'])]
+
+def synth_params(data_dir):
+    params_fn = f"{data_dir}/synth_params.json"
+    if not os.path.exists(params_fn):
+        return None
+
+    with open(params_fn, 'r') as in_file:
+        return json.load(in_file)
+
+# Synthetic data for a scale, generated if it isn't already there
+def ensure_data(data_dir, n_pats, n_loincs, args):
+    params = synth_params(data_dir)
+    if params is not None:
+        p = params['args']
+        if ((p['n_pats'] == n_pats) and (p['n_loincs'] == n_loincs) and
+            (p['seed'] == args['seed']) and ('perms' in p['parts'])):
+            return params
+
+    print(f"Generating synthetic data for {n_pats}x{n_loincs} in {data_dir}")
+    shutil.rmtree(data_dir, ignore_errors = True)
+    os.makedirs(data_dir, exist_ok = True)
+    subprocess.run(synth_cmd(data_dir, n_pats, n_loincs, args), check = True,
+                   stdout = subprocess.DEVNULL)
+
+    return synth_params(data_dir)
+
+############################################
+#                                          #
+#               Stages                     #
+#                                          #
+############################################
+
+# Command to run a stage and the number of input rows it works through
+def stage_cmd(stage, data_dir, n_pats, n_loincs, args):
+    lab_rows = sum(count_lines(x) for x in glob.glob(f"{data_dir}/trinetx/lab_data/*.csv"))
+
+    if stage == 'synth':
+        cmd = synth_cmd(data_dir, n_pats, n_loincs, args)
+        return cmd, None
+
+    if stage == 'chunk_diags':
+        diag_fn = f"{data_dir}/phecode/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv"
+        cmd = [sys.executable, os.path.abspath(__file__), 'chunk', '--data_dir', data_dir,
+               '--procs', str(args['procs'])]
+        return cmd, count_lines(diag_fn)
+
+    if stage == 'icd_pairs':
+        icd_fn = largest(f"{data_dir}/trinetx/icd_data/*_only.csv")
+        curr_icd = os.path.basename(icd_fn).replace('_only.csv', '')
+        cmd = [sys.executable, f"{PREP_DIR}/tnx_icd_gen_pairs_pub.py", '-i', curr_icd]
+        return cmd, count_lines(icd_fn) + lab_rows
+
+    if stage == 'phe_pairs':
+        phe_fn = largest(f"{data_dir}/phecode/tnx/tnx_procd/mcc1/mcc1_*.tsv")
+        curr_phe = os.path.basename(phe_fn)[len('mcc1_'):-len('.tsv')]
+        cmd = [sys.executable, f"{PREP_DIR}/tnx_phecode_generating_pairs_pub.py", '-p', curr_phe]
+        return cmd, count_lines(phe_fn) - 1 + lab_rows
+
+    if stage == 'emp_p':
+        perm_fn = largest(f"{data_dir}/results/perm_p_sims/final/*_result.tsv")
+        curr_icd = os.path.basename(perm_fn).split('_perms_')[0]
+        cmd = [sys.executable, f"{ANALYSIS_DIR}/ukb_icd_empirical_p_calculations_pub.py",
+               '--icd', curr_icd]
+        return cmd, count_lines(perm_fn) - 1
+
+    raise ValueError(f"Unknown stage {stage}")
+
+# Run one stage at one scale --repeats times, keeping the fastest time and
+# the largest RSS
+def bench_stage(stage, data_dir, n_pats, n_loincs, args):
+    cmd, rows = stage_cmd(stage, data_dir, n_pats, n_loincs, args)
+
+    env = dict(os.environ, PATHOGEN_NCD_HOME = data_dir)
+    log_dir = f"{args['work_dir']}/logs"
+    os.makedirs(log_dir, exist_ok = True)
+    log_fn = f"{log_dir}/{stage}_{n_pats}x{n_loincs}.log"
+
+    walls = []
+    rss = 0
+    rc = 0
+    for _ in range(args['repeats']):
+        for curr_dir in STAGE_OUT[stage]:
+            shutil.rmtree(f"{data_dir}/{curr_dir}", ignore_errors = True)
+            os.makedirs(f"{data_dir}/{curr_dir}", exist_ok = True)
+        if stage == 'synth':
+            shutil.rmtree(data_dir, ignore_errors = True)
+            os.makedirs(data_dir, exist_ok = True)
+
+        wall, curr_rss, rc = timed_run(cmd, env, log_fn, os.path.dirname(cmd[1]))
+        walls.append(wall)
+        rss = max(rss, curr_rss)
+        if rc != 0:
+            break
+
+    if stage == 'synth':
+        params = synth_params(data_dir) or {'counts' : {}}
+        rows = params['counts'].get('n_diag', 0) + params['counts'].get('n_lab', 0)
+        out_bytes = dir_bytes(data_dir)
+    else:
+        out_bytes = sum(dir_bytes(f"{data_dir}/{x}") for x in STAGE_OUT[stage])
+
+    wall = min(walls)
+    rec = {'stage'       : stage,
+           'n_pats'      : n_pats,
+           'n_loincs'    : n_loincs,
+           'wall_s'      : round(wall, 3),
+           'peak_rss_mb' : round(rss, 1),
+           'rows'        : rows,
+           'rows_per_s'  : round(rows / wall, 1) if rows else None,
+           'out_bytes'   : out_bytes,
+           'repeats'     : len(walls),
+           'returncode'  : rc}
+    if rc != 0:
+        rec['error'] = tail(log_fn)
+
+    return rec
+
+# chunk_diags driver, the same thing the chunking script's __main__ does but
+# with the process count and chunk size set by us and no hard pyarrow engine
+def run_chunk(args):
+    import multiprocessing as mp
+
+    import pandas as pd
+
+    sys.path.insert(0, PREP_DIR)
+    from tnx_phecode_chunking_diags_pub import listener_func, process_patient_ids
+
+    data_dir = args['data_dir']
+    diag_fn = f"{data_dir}/phecode/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv"
+    out_dir = f"{data_dir}/phecode/tnx/tnx_procd/py_diags"
+    os.makedirs(out_dir, exist_ok = True)
+
+    log_queue = mp.Queue()
+    listener = mp.Process(target = listener_func,
+                          args = (log_queue, f"{out_dir}/mp_chunking_log.log"))
+    listener.start()
+
+    types = {'pat_id' : str, 'vocab': str, 'code' : str, 'date' : str}
+    diags = pd.read_csv(diag_fn, names = ['pat_id', 'vocab', 'code', 'date'], dtype = types)
+
+    pat_id_ls = diags['pat_id'].unique().tolist()
+    pat_id_chunks = [pat_id_ls[i::args['procs']] for i in range(args['procs'])]
+
+    processes = []
+    for i, curr_pat_id_chunk in enumerate(pat_id_chunks):
+        p = mp.Process(target = process_patient_ids,
+                       args = (diags, curr_pat_id_chunk, args['chunk_lim'], out_dir, i, log_queue))
+        processes.append(p)
+        p.start()
+
+    for p in processes:
+        p.join()
+
+    log_queue.put(None)
+    listener.join()
+
+    if any(p.exitcode != 0 for p in processes):
+        sys.exit(1)
+
+############################################
+#                                          #
+#        History, baseline, compare        #
+#                                          #
+############################################
+
+def load_history(work_dir):
+    hist_fn = f"{work_dir}/{HISTORY_FN}"
+    if not os.path.exists(hist_fn):
+        return []
+
+    with open(hist_fn, 'r') as in_file:
+        return [json.loads(x) for x in in_file if x.strip()]
+
+def append_history(work_dir, rec):
+    with open(f"{work_dir}/{HISTORY_FN}", 'a') as out_file:
+        out_file.write(json.dumps(rec) + '\n')
+
+def run_records(history, run_id = None):
+    if not history:
+        return None, []
+
+    if run_id is None:
+        run_id = history[-1]['run_id']
+
+    return run_id, [x for x in history if x['run_id'] == run_id]
+
+# Least squares slope of log(y) on log(x)
+def log_slope(pts):
+    pts = [(math.log(x), math.log(y)) for x, y in pts if (x > 0) and (y > 0)]
+    if len(set(x for x, _ in pts)) < 2:
+        return None
+
+    mx = sum(x for x, _ in pts) / len(pts)
+    my = sum(y for _, y in pts) / len(pts)
+    sxy = sum((x - mx) * (y - my) for x, y in pts)
+    sxx = sum((x - mx) ** 2 for x, _ in pts)
+
+    return sxy / sxx
+
+# Scaling exponents of wall time for each stage, vs patients (at the LOINC
+# count with the most scales) and vs LOINCs (same for patients)
+def scaling(recs):
+    out = {}
+    ok = [x for x in recs if x['returncode'] == 0]
+    for stage in sorted(set(x['stage'] for x in ok)):
+        curr = [x for x in ok if x['stage'] == stage]
+        exps = {}
+        for var, fixed in [('n_pats', 'n_loincs'), ('n_loincs', 'n_pats')]:
+            fixed_vals = [x[fixed] for x in curr]
+            most = max(set(fixed_vals), key = lambda x: (fixed_vals.count(x), x))
+            exps[var] = log_slope([(x[var], x['wall_s']) for x in curr if x[fixed] == most])
+        out[stage] = exps
+
+    return out
+
+def fmt_exp(val):
+    return '   -' if val is None else f"{val:4.2f}"
+
+def compare(base, curr, tol):
+    base_idx = {(x['stage'], x['n_pats'], x['n_loincs']) : x for x in base}
+    regs = []
+
+    print(f"{'stage':<12} {'scale':>12} {'base_s':>9} {'curr_s':>9} {'ratio':>6} "
+          f"{'base_mb':>8} {'curr_mb':>8} {'rows/s':>11}  flag")
+
+    for rec in sorted(curr, key = lambda x: (STAGES.index(x['stage']), x['n_pats'], x['n_loincs'])):
+        key = (rec['stage'], rec['n_pats'], rec['n_loincs'])
+        scale = f"{rec['n_pats']}x{rec['n_loincs']}"
+        prev = base_idx.get(key)
+
+        flags = []
+        if rec['returncode'] != 0:
+            if (prev is None) or (prev['returncode'] == 0):
+                flags.append('FAILS')
+        elif (prev is not None) and (prev['returncode'] == 0):
+            if rec['wall_s'] > prev['wall_s'] * (1 + tol):
+                flags.append('SLOWER')
+            if rec['peak_rss_mb'] > prev['peak_rss_mb'] * (1 + tol):
+                flags.append('MORE_MEM')
+        if flags:
+            regs.append((key, flags))
+
+        base_s = f"{prev['wall_s']:9.2f}" if prev else f"{'-':>9}"
+        base_mb = f"{prev['peak_rss_mb']:8.0f}" if prev else f"{'-':>8}"
+        ratio = (f"{rec['wall_s'] / prev['wall_s']:6.2f}"
+                 if prev and prev['wall_s'] and (rec['returncode'] == 0) else f"{'-':>6}")
+        rps = f"{rec['rows_per_s']:11,.0f}" if rec['rows_per_s'] else f"{'-':>11}"
+        print(f"{rec['stage']:<12} {scale:>12} {base_s} {rec['wall_s']:9.2f} {ratio} "
+              f"{base_mb} {rec['peak_rss_mb']:8.0f} {rps}  {' '.join(flags)}")
+
+    base_exp = scaling(base)
+    curr_exp = scaling(curr)
+    print(f"\nScaling exponent of wall time (1 = linear, 2 = quadratic), baseline -> current")
+    print(f"{'stage':<12} {'patients':>14} {'LOINCs':>14}")
+    for stage, exps in curr_exp.items():
+        prev = base_exp.get(stage, {})
+        print(f"{stage:<12} "
+              f"{fmt_exp(prev.get('n_pats')):>6} -> {fmt_exp(exps['n_pats'])} "
+              f"{fmt_exp(prev.get('n_loincs')):>6} -> {fmt_exp(exps['n_loincs'])}")
+
+    return regs
+
+############################################
+#                                          #
+#               Commands                   #
+#                                          #
+############################################
+
+def cmd_run(args):
+    os.makedirs(args['work_dir'], exist_ok = True)
+
+    run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+    meta = {'run_id'    : run_id,
+            'timestamp' : datetime.now().isoformat(timespec = 'seconds'),
+            'commit'    : git_commit(),
+            'host'      : platform.node(),
+            'seed'      : args['seed']}
+
+    for scale in args['scales']:
+        n_pats, n_loincs = parse_scale(scale)
+        data_dir = f"{args['work_dir']}/data/p{n_pats}_l{n_loincs}_s{args['seed']}"
+
+        stages = [x for x in STAGES if x in args['stages']]
+        if 'synth' not in stages:
+            ensure_data(data_dir, n_pats, n_loincs, args)
+
+        for stage in stages:
+            rec = dict(meta, **bench_stage(stage, data_dir, n_pats, n_loincs, args))
+            append_history(args['work_dir'], rec)
+
+            status = 'ok' if rec['returncode'] == 0 else f"FAILED ({rec['returncode']})"
+            rps = f"{rec['rows_per_s']:,.0f} rows/s" if rec['rows_per_s'] else '-'
+            print(f"{scale:>12} {stage:<12} {rec['wall_s']:8.2f}s {rec['peak_rss_mb']:8.0f} MB "
+                  f"{rps:>18} {rec['out_bytes'] / 1024 / 1024:9.1f} MB out  {status}")
+
+    print(f"Run {run_id} appended to {args['work_dir']}/{HISTORY_FN}")
+
+def cmd_save_baseline(args):
+    run_id, recs = run_records(load_history(args['work_dir']), args['run'])
+    if not recs:
+        sys.exit(f"No benchmark run {run_id or ''} in {args['work_dir']}/{HISTORY_FN}")
+
+    base_fn = f"{args['work_dir']}/{BASELINE_FN}"
+    tmp_fn = f"{base_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, 'w') as out_file:
+        json.dump({'run_id' : run_id, 'records' : recs}, out_file, indent = 1)
+    os.replace(tmp_fn, base_fn)
+
+    print(f"Saved run {run_id} ({len(recs)} records) as the baseline")
+
+def cmd_compare(args):
+    base_fn = args['baseline'] or f"{args['work_dir']}/{BASELINE_FN}"
+    with open(base_fn, 'r') as in_file:
+        base = json.load(in_file)
+
+    run_id, recs = run_records(load_history(args['work_dir']), args['run'])
+    if not recs:
+        sys.exit(f"No benchmark run {run_id or ''} in {args['work_dir']}/{HISTORY_FN}")
+
+    print(f"Run {run_id} vs baseline {base['run_id']} (tolerance {args['tol']:.0%})\n")
+    regs = compare(base['records'], recs, args['tol'])
+
+    if regs:
+        print(f"\n{len(regs)} regression(s):")
+        for (stage, n_pats, n_loincs), flags in regs:
+            print(f"    {stage} at {n_pats}x{n_loincs}: {', '.join(flags)}")
+        sys.exit(1)
+
+    print('\nNo regressions')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark pipeline stages on synthetic data')
+    parser.add_argument('--work_dir', default = WORK_DIR,
+                        help = 'Where the synthetic data, logs, history and baseline live')
+    sub = parser.add_subparsers(dest = 'cmd', required = True)
+
+    run_p = sub.add_parser('run', help = 'Benchmark stages at each scale')
+    run_p.add_argument('--scales', nargs = '+', default = DEF_SCALES,
+                       help = 'Scales as {patients}x{LOINCs}')
+    run_p.add_argument('--stages', nargs = '+', default = DEF_STAGES, choices = STAGES,
+                       help = 'Stages to run')
+    run_p.add_argument('--repeats', type = int, default = 1, help = 'Runs per stage, fastest is kept')
+    run_p.add_argument('--procs', type = int, default = 4, help = 'Processes for chunk_diags')
+    run_p.add_argument('--synth_workers', type = int, default = 4,
+                       help = 'Workers for generating synthetic data')
+    run_p.add_argument('--seed', type = int, default = OUR_SEED, help = 'Synthetic data seed')
+
+    base_p = sub.add_parser('save-baseline', help = 'Store a run as the baseline')
+    base_p.add_argument('--run', default = None, help = 'Run id (default: latest)')
+
+    cmp_p = sub.add_parser('compare', help = 'Compare a run against the baseline')
+    cmp_p.add_argument('--run', default = None, help = 'Run id (default: latest)')
+    cmp_p.add_argument('--baseline', default = None, help = 'Baseline JSON (default: in --work_dir)')
+    cmp_p.add_argument('--tol', type = float, default = 0.25,
+                       help = 'Allowed fractional increase in time or memory')
+
+    chunk_p = sub.add_parser('chunk', help = argparse.SUPPRESS)
+    chunk_p.add_argument('--data_dir', required = True)
+    chunk_p.add_argument('--procs', type = int, default = 4)
+    chunk_p.add_argument('--chunk_lim', type = int, default = CHUNK_LIM)
+
+    args = vars(parser.parse_args())
+
+    if args['cmd'] == 'run':
+        cmd_run(args)
+    elif args['cmd'] == 'save-baseline':
+        cmd_save_baseline(args)
+    elif args['cmd'] == 'compare':
+        cmd_compare(args)
+    else:
+        run_chunk(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# Name:     pair_profiler_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Opt-in stage timing for the TNX pair generators (tnx_icd_gen_pairs_pub.py
+#   and tnx_phecode_generating_pairs_pub.py, --profile). Each step of the
+#   per-LOINC loop (glob, read_csv, applymap, to_datetime, filters, merge,
+#   sort/dedupe, to_csv) is wrapped in prof.stage(name), and row counts are
+#   noted after each filter with prof.rows(name, n), so we can see where the
+#   time in a slow job actually goes.
+#
+#   Every lab file the loop works on is one item (prof.new_item()), and gives
+#   one row of extra summary columns:
+#       t_{stage}       seconds spent in that stage for this file
+#       n_{name}        rows left after that step
+#       peak_rss_mb     peak resident memory while working on this file
+#   Stages run outside an item (loading the diagnoses, the per-LOINC glob
+#   after prof.end_item()) only count towards the job totals.
+#
+#   Peak memory per item comes from resetting the kernel's high water mark
+#   (/proc/self/clear_refs) at the start of each item and reading VmHWM at
+#   the end. Where that isn't possible we fall back to the largest RSS seen
+#   at the end of a stage.
+#
+#   When profiling is off stage() hands back a shared no-op context manager
+#   and nothing is recorded.
+#
+#   Usage:
+#       prof = StageProfiler(enabled = args['profile'])
+#       with prof.stage('read_csv'):
+#           curr_lab = pd.read_csv(...)
+#       prof.rows('lab_read', len(curr_lab))
+#       ...
+#       new_meas = pd.concat([new_meas, prof.item_df()], axis = 1)
+#       prof.dump(f"{pair_dir}/{curr_icd}_profile.json")
+#
+
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+
+STATUS_FN = '/proc/self/status'
+CLEAR_REFS_FN = '/proc/self/clear_refs'
+
+_NO_OP = nullcontext()
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# A field (in kB) from /proc/self/status, None if we can't read it
+def status_kb(field):
+    try:
+        with open(STATUS_FN, 'r') as in_file:
+            for line in in_file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+# Reset the peak RSS (VmHWM) to the current RSS, False if not supported
+def reset_peak():
+    try:
+        with open(CLEAR_REFS_FN, 'w') as out_file:
+            out_file.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_mb():
+    hwm = status_kb('VmHWM')
+    if hwm is None:
+        # ru_maxrss is kB on Linux
+        hwm = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return hwm / 1024
+
+def rss_mb():
+    rss = status_kb('VmRSS')
+
+    return None if rss is None else rss / 1024
+
+class StageProfiler:
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+
+        # Job totals: stage -> [seconds, calls]
+        self.totals = {}
+        self.row_totals = {}
+
+        # One dict per item, plus the order columns were first seen in
+        self.items = []
+        self.cols = []
+        self.job_peak = 0
+        self.is_open = False
+
+        self.can_reset = enabled and reset_peak()
+
+    def _col(self, col):
+        if col not in self.cols:
+            self.cols.append(col)
+
+    # Start profiling the next lab file, closing off the one before
+    def new_item(self):
+        if not self.enabled:
+            return
+
+        self.end_item()
+        self.items.append({})
+        self.is_open = True
+        if self.can_reset:
+            reset_peak()
+
+    # Stop attributing stages to the current item
+    def end_item(self):
+        if not self.enabled or not self.is_open:
+            return
+
+        self.is_open = False
+
+        curr = self.items[-1]
+        if self.can_reset:
+            curr['peak_rss_mb'] = round(peak_mb(), 1)
+        self.job_peak = max(self.job_peak, curr.get('peak_rss_mb', 0))
+        self._col('peak_rss_mb')
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            dur = time.perf_counter() - start
+
+            tot = self.totals.setdefault(name, [0.0, 0])
+            tot[0] += dur
+            tot[1] += 1
+
+            if self.is_open:
+                curr = self.items[-1]
+                col = f"t_{name}"
+                self._col(col)
+                curr[col] = round(curr.get(col, 0) + dur, 4)
+
+                if not self.can_reset:
+                    rss = rss_mb()
+                    if rss is not None:
+                        curr['peak_rss_mb'] = round(max(curr.get('peak_rss_mb', 0), rss), 1)
+
+    # Time a block of code as stage `name`
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_OP
+
+        return self._timed(name)
+
+    # Note how many rows are left after step `name`
+    def rows(self, name, n):
+        if not self.enabled:
+            return
+
+        self.row_totals[name] = self.row_totals.get(name, 0) + int(n)
+        if self.is_open:
+            col = f"n_{name}"
+            self._col(col)
+            self.items[-1][col] = int(n)
+
+    # Extra summary columns, one row per item
+    def item_df(self):
+        import pandas as pd
+
+        self.end_item()
+
+        # Timing columns first, then row counts, then memory
+        order = ([x for x in self.cols if x.startswith('t_')] +
+                 [x for x in self.cols if x.startswith('n_')] +
+                 [x for x in self.cols if x == 'peak_rss_mb'])
+
+        res = pd.DataFrame(self.items, columns = order)
+        n_cols = [x for x in order if x.startswith('n_')]
+        res[n_cols] = res[n_cols].astype('Int64')
+
+        return res
+
+    # Job wide profile: time per stage (and share of the job), rows after
+    # each step and peak memory. The high water mark is reset per item, so
+    # the job peak is the largest item peak or what we've hit since.
+    def summary(self):
+        self.end_item()
+        wall = time.perf_counter() - self.start
+        stages = sorted(self.totals.items(), key = lambda x: -x[1][0])
+
+        return {'wall_s'      : round(wall, 3),
+                'n_items'     : len(self.items),
+                'peak_rss_mb' : round(max(self.job_peak, peak_mb()), 1),
+                'stages'      : [{'stage' : name,
+                                  'total_s' : round(tot, 4),
+                                  'calls' : calls,
+                                  'mean_s' : round(tot / calls, 6),
+                                  'frac_of_job' : round(tot / wall, 4) if wall else None}
+                                 for name, (tot, calls) in stages],
+                'rows'        : self.row_totals}
+
+    def dump(self, out_fn, extra = None):
+        if not self.enabled:
+            return
+
+        res = dict(extra or {}, **self.summary())
+
+        tmp_fn = f"{out_fn}.{os.getpid()}.tmp"
+        with open(tmp_fn, 'w') as out_file:
+            json.dump(res, out_file, indent = 1)
+        os.replace(tmp_fn, out_fn)
+
+        print(f"Profile ({res['wall_s']:.1f}s, peak {res['peak_rss_mb']:.0f} MB) written to {out_fn}")
+        for curr in res['stages']:
+            print(f"    {curr['stage']:<16} {curr['total_s']:10.2f}s {curr['calls']:8,d} calls "
+                  f"{curr['frac_of_job'] or 0:7.1%}")
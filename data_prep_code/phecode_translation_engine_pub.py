@@ -0,0 +1,485 @@
+# Name:     phecode_translation_engine_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Python replacement for the code -> Phecode translation done by
+#   ukb_phecode_translation_pub.R / tnx_phecode_translation_pub.R (PheWAS
+#   createPhenotypes) and for the Read v2/CTV3 -> ICD10 merges in
+#   ukb_phecode_raw_data_proc.ipynb.
+#
+#   Every vocabulary is compiled once into dictionary-encoded lookup arrays
+#   (a pandas Index of source codes plus CSR style offsets into an int array of
+#   target codes), so translating a block of codes is a hash lookup and a
+#   np.repeat instead of a merge, and one-to-many maps (Read -> ICD10, ICD ->
+#   Phecode, Phecode -> rolled up Phecodes) come out the same way a merge
+#   would. ICD9/ICD10 reformatting is done on whole columns.
+#
+#   UKB codes are normalized to the period convention (fix_icd10/fix_icd9 in
+#   the notebook) before the Phecode lookup, so the diagnosis file can carry
+#   them as UKB stores them. --gp_file adds the raw primary care records
+#   (gp_clin.tsv): Read v2 -> ICD10, or CTV3 -> ICD10 when Read v2 has none,
+#   like the notebook's merges, then on through the same lookup. Only use it
+#   when the diagnosis file doesn't already have the GP rows.
+#
+#   Input files are streamed in blocks of --chunksize rows and only the
+#   distinct (id, phecode, date) triples are kept, so memory no longer depends
+#   on the size of the input file. TNX chunk files are independent (a patient
+#   is only ever in one chunk) so they are translated in parallel, one per
+#   worker.
+#
+#   What we reproduce from createPhenotypes(min.code.count = 1,
+#   add.phecode.exclusions = T, map.codes.make.distinct = F):
+#       - codes mapped to Phecodes and rolled up with the rollup map
+#       - count = number of distinct dates per (id, phecode)
+#       - exclusion Phecodes of anything a person has are NA unless they have
+#         that Phecode themselves
+#       - male only Phecodes NA for females and vice versa, for the whole
+#         Phecode column like restrictPhecodesBySex, not just the people that
+#         have the code
+#   Output is long (id, phecode, status) holding only the True/NA entries,
+#   everything not listed is False, except that every female is NA for a male
+#   only Phecode (and every male for a female only one) whether they are
+#   listed or not. --wide writes the createPhenotypes layout (one row per id in
+#   the full population, one column per Phecode) with that already applied.
+#   The TNX full population is every id in the chunk, including patients none
+#   of whose codes map to a Phecode (full.population.ids in the R script).
+#
+#   Usage:
+#       python phecode_translation_engine_pub.py --src tnx --workers 16 \
+#           --diag_files /data/pathogen_ncd/phecode/tnx/tnx_procd/py_diags/chunk_*.csv
+#
+#       python phecode_translation_engine_pub.py --src ukb
+#
+#       python phecode_translation_engine_pub.py --src ukb \
+#           --diag_files /data/pathogen_ncd/phecode/ukb/ukb_proc/ukb_no_gp_prepped_for_phecode.tsv \
+#           --gp_file /data/pathogen_ncd/phecode/ukb/ukb_raw/gp_clin.tsv
+#
+
+import argparse
+import glob
+import multiprocessing as mp
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+LOCAL_COPY_PATH = "/data/pathogen_ncd"
+PHE_DIR = f'{LOCAL_COPY_PATH}/phecode'
+PHE_REF_DIR = f'{PHE_DIR}/ref_files'
+
+# Phecode ref files (same ones the R scripts use)
+PHE_VOCAB_FN     = f'{PHE_REF_DIR}/orig_phecode_map_1.2024.csv'
+PHE_VOCAB_UKB_FN = f'{PHE_REF_DIR}/icd9cm_w_icd10_phecode_map_for_ukb.csv'
+PHE_EXCL_FN      = f'{PHE_REF_DIR}/original_phecodes_exclusion.csv'
+PHE_SEX_SPEC_FN  = f'{PHE_REF_DIR}/original_phecodes_gender_restriction.csv'
+PHE_ROLLUP_FN    = f'{PHE_REF_DIR}/phecode_rollup_map_1.2024.csv'
+
+# Denaxas et al. Read v2 / CTV3 -> ICD10 -> Phecode tables
+UKB_GP_DICT_DIR = f'{PHE_DIR}/misc/ukb_gp_to_icd10_to_phecode'
+READ2_FN = f'{UKB_GP_DICT_DIR}/read2_to_phecode.csv'
+READ3_FN = f'{UKB_GP_DICT_DIR}/ctv3_to_phecode.csv'
+
+# Per source settings: input, sex file, where results go and how the
+# vocabulary column is renamed to match the PheWAS vocabulary
+SRC_INFO = {'tnx' : {'diag_glob' : f'{PHE_DIR}/tnx/tnx_procd/py_diags/chunk_*.csv',
+                     'sex_fn'    : f'{PHE_DIR}/misc/tnx_sex_data_prepped.tsv',
+                     'vocab_fn'  : PHE_VOCAB_FN,
+                     'out_dir'   : f'{PHE_DIR}/phecode_results/tnx/translation',
+                     'vocab_rename' : {'ICD-10-CM' : 'ICD10CM', 'ICD-9-CM' : 'ICD9CM'}},
+            'ukb' : {'diag_glob' : f'{PHE_DIR}/ukb/ukb_proc/all_ukb_prepped_for_phecode.tsv',
+                     'sex_fn'    : f'{LOCAL_COPY_PATH}/procd/cov_dat.csv',
+                     'vocab_fn'  : PHE_VOCAB_UKB_FN,
+                     'out_dir'   : f'{PHE_DIR}/phecode_results/ukb/translation',
+                     'vocab_rename' : {'ICD9' : 'ICD9CM'}}}
+
+CHUNK_SIZE = 5_000_000
+
+# Translation maps and sex lookup, set once per worker process
+MAPS = None
+SEX = None
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Returns the current date and time as a string for logging
+def dt():
+    return datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')
+
+# Compile a one-to-many map (keys[i] -> vals[i]) into lookup arrays:
+#   keys:    Index of distinct source codes (hash lookup)
+#   offsets: key k's targets are codes[offsets[k]:offsets[k + 1]]
+#   codes:   target codes as positions in labels
+#   labels:  Index of distinct target codes
+# Passing labels lets several maps share one target code space (e.g. Phecodes).
+def build_lookup(keys, vals, labels = None):
+    keys = pd.Series(keys, dtype = object).reset_index(drop = True)
+    vals = pd.Series(vals, dtype = object).reset_index(drop = True)
+
+    keep = keys.notna() & vals.notna()
+    keys = keys[keep]
+    vals = vals[keep]
+
+    if labels is None:
+        labels = pd.Index(pd.unique(vals))
+
+    key_index = pd.Index(pd.unique(keys))
+    key_pos = key_index.get_indexer(keys)
+    val_pos = labels.get_indexer(vals)
+
+    order = np.lexsort((val_pos, key_pos))
+    key_pos = key_pos[order]
+    val_pos = val_pos[order]
+
+    offsets = np.zeros(len(key_index) + 1, dtype = np.int64)
+    np.cumsum(np.bincount(key_pos, minlength = len(key_index)), out = offsets[1:])
+
+    return {'keys' : key_index, 'offsets' : offsets,
+            'codes' : val_pos.astype(np.int32), 'labels' : labels}
+
+# Expand positions into a lookup's key space (-1 = not found) to all of their
+# targets. Returns the input row each output came from and the target codes,
+# one output per match, unmatched rows dropped (an inner merge).
+def expand_lookup(key_pos, lut):
+    key_pos = np.asarray(key_pos)
+    hit = np.flatnonzero(key_pos >= 0)
+
+    starts = lut['offsets'][key_pos[hit]]
+    n_out = lut['offsets'][key_pos[hit] + 1] - starts
+
+    rows = np.repeat(hit, n_out)
+    run_start = np.repeat(np.cumsum(n_out) - n_out, n_out)
+    pos = np.repeat(starts, n_out) + (np.arange(len(rows)) - run_start)
+
+    return rows, lut['codes'][pos]
+
+# Look up codes (strings) in a compiled map.
+def apply_lookup(codes, lut):
+    return expand_lookup(lut['keys'].get_indexer(pd.Series(codes, dtype = object)), lut)
+
+# Vectorized fix_icd10: UKB stores ICD10 without the period, add it after the
+# third character.
+def norm_icd10(codes):
+    codes = pd.Series(codes, dtype = object).astype(str).str.replace('.', '', regex = False)
+    long_code = codes.str.len() > 3
+
+    return codes.where(~long_code, codes.str[:3] + '.' + codes.str[3:])
+
+# Vectorized fix_icd9: period after the third character, or after the fourth
+# for E and V codes.
+def norm_icd9(codes):
+    orig = pd.Series(codes, dtype = object).astype(str)
+    codes = orig.str.replace('.', '', regex = False)
+
+    is_ev = orig.str.contains('E', regex = False) | orig.str.contains('V', regex = False)
+    long_code = orig.str.len() > 3
+
+    out = codes.where(~(long_code & ~is_ev), codes.str[:3] + '.' + codes.str[3:])
+    out = out.where(~(long_code & is_ev), codes.str[:4] + '.' + codes.str[4:])
+
+    return out
+
+# Compile the Denaxas Read v2 and CTV3 -> ICD10 tables (read code, ICD10,
+# Phecode columns, we only use the first two)
+def load_read_maps(read2_fn = READ2_FN, read3_fn = READ3_FN):
+    v2 = pd.read_csv(read2_fn, sep = ',', dtype = str)
+    v3 = pd.read_csv(read3_fn, sep = ',', dtype = str)
+
+    return {'read2' : build_lookup(v2.iloc[:, 0], v2.iloc[:, 1]),
+            'read3' : build_lookup(v3.iloc[:, 0], v3.iloc[:, 1])}
+
+# Read v2/CTV3 -> ICD10 like the notebook's merges: the Read v2 ICD10 if there
+# is one, otherwise the CTV3 ICD10, rows with neither dropped. One output row
+# per ICD10 a Read code maps to.
+def translate_read(gp, read_maps):
+    v2_lut = read_maps['read2']
+    v3_lut = read_maps['read3']
+
+    rows2, icd2 = apply_lookup(gp['read_2'], v2_lut)
+
+    # Only go to CTV3 when Read v2 had nothing
+    no_v2 = np.ones(len(gp), dtype = bool)
+    no_v2[rows2] = False
+    v3_key = v3_lut['keys'].get_indexer(pd.Series(gp['read_3'], dtype = object))
+    v3_key[~no_v2] = -1
+    rows3, icd3 = expand_lookup(v3_key, v3_lut)
+
+    rows = np.concatenate([rows2, rows3])
+    fin_icd = np.concatenate([v2_lut['labels'].to_numpy()[icd2],
+                              v3_lut['labels'].to_numpy()[icd3]])
+
+    order = np.argsort(rows, kind = 'stable')
+    clean_gp = gp.iloc[rows[order], :].loc[:, ['eid', 'event_dt']].reset_index(drop = True)
+    clean_gp['fin_icd'] = fin_icd[order]
+
+    return clean_gp
+
+# Load and compile the Phecode reference files: vocabulary -> Phecode,
+# Phecode -> rolled up Phecodes, Phecode -> exclusion Phecodes and the sex
+# restricted Phecodes, all in one shared Phecode code space.
+def load_maps(vocab_fn):
+    vocab = pd.read_csv(vocab_fn, sep = ',', dtype = str)
+    vocab.columns = [x.lower() for x in vocab.columns]
+    rollup = pd.read_csv(PHE_ROLLUP_FN, sep = ',', dtype = str)
+    rollup.columns = [x.lower() for x in rollup.columns]
+    excl = pd.read_csv(PHE_EXCL_FN, sep = ',', dtype = str)
+    excl.columns = [x.lower() for x in excl.columns]
+    sex_spec = pd.read_csv(PHE_SEX_SPEC_FN, sep = ',', dtype = str)
+    sex_spec.columns = [x.lower() for x in sex_spec.columns]
+
+    # One label space for all Phecodes, sorted like R orders the columns
+    phe_labels = pd.Index(sorted(set(vocab['phecode'].dropna()) |
+                                 set(rollup['code'].dropna()) |
+                                 set(rollup['phecode_unrolled'].dropna()) |
+                                 set(excl['code'].dropna()) |
+                                 set(excl['exclusion_criteria'].dropna()) |
+                                 set(sex_spec['phecode'].dropna())))
+
+    maps = {}
+    maps['vocab'] = build_lookup(vocab['vocabulary_id'] + '|' + vocab['code'],
+                                 vocab['phecode'], phe_labels)
+    maps['rollup'] = build_lookup(rollup['code'], rollup['phecode_unrolled'], phe_labels)
+    maps['excl'] = build_lookup(excl['code'], excl['exclusion_criteria'], phe_labels)
+
+    # Rollup/exclusion keys are Phecodes, index them by Phecode position
+    for curr_map in ['rollup', 'excl']:
+        maps[f'{curr_map}_key'] = maps[curr_map]['keys'].get_indexer(phe_labels)
+
+    is_true = lambda x : x.str.upper().isin(['TRUE', 'T'])
+    maps['male_only'] = np.isin(np.arange(len(phe_labels)),
+                                phe_labels.get_indexer(sex_spec.loc[is_true(sex_spec['male_only']), 'phecode']))
+    maps['female_only'] = np.isin(np.arange(len(phe_labels)),
+                                  phe_labels.get_indexer(sex_spec.loc[is_true(sex_spec['female_only']), 'phecode']))
+    maps['labels'] = phe_labels
+
+    return maps
+
+# UKB codes to the period convention the Phecode map uses (fix_icd10 /
+# fix_icd9 in the notebook), already formatted codes come out the same
+def norm_codes(vocab_id, codes):
+    codes = pd.Series(codes, dtype = object).reset_index(drop = True)
+    vocab_id = pd.Series(vocab_id, dtype = object).reset_index(drop = True)
+
+    is_10 = (vocab_id == 'ICD10').to_numpy()
+    is_9 = (vocab_id == 'ICD9').to_numpy()
+    codes[is_10] = norm_icd10(codes[is_10]).to_numpy()
+    codes[is_9] = norm_icd9(codes[is_9]).to_numpy()
+
+    return codes
+
+# Stream one diagnosis file in blocks and return the distinct
+# (id, phecode, date) triples after mapping and rollup, along with every id in
+# the file (mapped codes or not).
+#   tnx: chunk files (id, vocabulary_id, code, index)
+#   ukb: eid, vocab, icd_code, diag_date, codes normalized on the way
+#   gp:  UKB primary care records (gp_clin.tsv), Read v2/CTV3 -> ICD10 with
+#        the Denaxas tables (needs maps['read']), then like ukb
+def map_file(diag_fn, src, maps, chunksize = CHUNK_SIZE):
+    if src == 'tnx':
+        reader = pd.read_csv(diag_fn, names = ['id', 'vocabulary_id', 'code', 'index'],
+                             dtype = str, chunksize = chunksize)
+    elif src == 'gp':
+        reader = pd.read_csv(diag_fn, sep = '\t', dtype = str, chunksize = chunksize,
+                             usecols = ['eid', 'event_dt', 'read_2', 'read_3'])
+    else:
+        reader = pd.read_csv(diag_fn, sep = '\t', dtype = str, chunksize = chunksize,
+                             usecols = ['eid', 'vocab', 'icd_code', 'diag_date'])
+
+    vocab_rename = SRC_INFO['ukb' if src == 'gp' else src]['vocab_rename']
+
+    trip_ls = []
+    id_ls = []
+    for chunk in reader:
+        if src == 'gp':
+            id_ls.append(chunk['eid'].dropna().unique())
+            chunk = translate_read(chunk, maps['read'])
+            chunk = pd.DataFrame({'eid' : chunk['eid'], 'vocab' : 'ICD10',
+                                  'icd_code' : chunk['fin_icd'], 'diag_date' : chunk['event_dt']})
+
+        if src != 'tnx':
+            chunk = chunk.loc[:, ['eid', 'vocab', 'icd_code', 'diag_date']].reset_index(drop = True)
+            chunk.columns = ['id', 'vocabulary_id', 'code', 'index']
+            chunk['code'] = norm_codes(chunk['vocabulary_id'], chunk['code'])
+
+        if src != 'gp':
+            id_ls.append(chunk['id'].dropna().unique())
+        vocab_id = chunk['vocabulary_id'].replace(vocab_rename)
+
+        # code -> Phecode -> rolled up Phecodes
+        rows, phe = apply_lookup(vocab_id + '|' + chunk['code'], maps['vocab'])
+        rows_up, phe_up = expand_lookup(maps['rollup_key'][phe], maps['rollup'])
+        rows = rows[rows_up]
+
+        trips = pd.DataFrame({'id'      : chunk['id'].to_numpy()[rows],
+                              'phecode' : phe_up,
+                              'index'   : chunk['index'].to_numpy()[rows]})
+        trip_ls.append(trips.drop_duplicates())
+
+    if len(trip_ls) == 0:
+        return pd.DataFrame({'id' : [], 'phecode' : [], 'index' : []}), np.array([], dtype = object)
+
+    return (pd.concat(trip_ls, ignore_index = True).drop_duplicates(),
+            pd.unique(np.concatenate(id_ls)))
+
+# Counts per (id, phecode), exclusions and sex restrictions. Returns the long
+# True/NA table (status True or NA). Sex restricted entries in here are NA, but
+# so is every other opposite sex id for that Phecode (see to_wide).
+def code_status(trips, sex, maps):
+    counts = trips.groupby(['id', 'phecode'], sort = False).size().reset_index(name = 'count')
+
+    # Exclusions: anyone with a Phecode gets NA for its exclusion Phecodes
+    rows, excl_phe = expand_lookup(maps['excl_key'][counts['phecode'].to_numpy()], maps['excl'])
+    excl = pd.DataFrame({'id' : counts['id'].to_numpy()[rows], 'phecode' : excl_phe})
+    excl = excl.drop_duplicates()
+
+    # Having the code yourself wins over being excluded
+    excl = excl.merge(counts.loc[:, ['id', 'phecode']], how = 'left',
+                      on = ['id', 'phecode'], indicator = True)
+    excl = excl.loc[excl['_merge'] == 'left_only', ['id', 'phecode']]
+
+    # status None (object) for the NAs, a float NaN would turn True into 1.0
+    res = pd.concat([counts.loc[counts['count'] >= 1, ['id', 'phecode']].assign(status = True),
+                     excl.assign(status = None)], ignore_index = True)
+    res['status'] = res['status'].astype(object)
+
+    # Sex restriction, unknown sex (NA) isn't restricted
+    res_sex = res['id'].map(sex)
+    phe = res['phecode'].to_numpy()
+    restrict = ((maps['male_only'][phe] & (res_sex == 'F').to_numpy()) |
+                (maps['female_only'][phe] & (res_sex == 'M').to_numpy()))
+    res.loc[restrict, 'status'] = np.nan
+
+    res['phecode'] = maps['labels'].to_numpy()[phe]
+    res.loc[res['status'].isna(), 'status'] = 'NA'
+
+    return res.sort_values(['id', 'phecode'], kind = 'stable').reset_index(drop = True)
+
+# createPhenotypes layout: one row per id in the full population, one column
+# per Phecode seen, True/False/NA. Like restrictPhecodesBySex every female is NA
+# in male only Phecode columns and every male in female only ones.
+def to_wide(res, pop_ids, sex, maps):
+    wide = res.pivot(index = 'id', columns = 'phecode', values = 'status')
+    wide = wide.reindex(pd.Index(pop_ids, name = 'id'))
+
+    # Keep every column object (True/False/'NA'), fillna would downcast the
+    # columns with no NAs to bool
+    wide = wide.where(wide.notna(), False).astype(object)
+
+    # Unknown sex (NA) isn't restricted
+    phe = maps['labels'].get_indexer(wide.columns)
+    pop_sex = sex.reindex(wide.index).to_numpy()
+    wide.loc[pop_sex == 'F', wide.columns[maps['male_only'][phe]]] = 'NA'
+    wide.loc[pop_sex == 'M', wide.columns[maps['female_only'][phe]]] = 'NA'
+
+    return wide.reset_index()
+
+# Sex lookup (id -> F/M/NA) for a source
+def load_sex(src, sex_fn):
+    if src == 'tnx':
+        sex = pd.read_csv(sex_fn, sep = '\t', dtype = str)
+        sex.columns = [x.lower() for x in sex.columns]
+        sex = sex.set_index('id')['sex']
+    else:
+        sex = pd.read_csv(sex_fn, sep = ',', dtype = {'eid' : str})
+        sex = sex.set_index('eid')['sex']
+        sex = pd.Series(np.where(sex == 0, 'F', 'M'), index = sex.index)
+
+    # Switch to NA per Phecode docs
+    return sex.where(sex != 'Unknown')
+
+def init_worker(maps, sex):
+    global MAPS, SEX
+    MAPS = maps
+    SEX = sex
+
+# Translate one diagnosis file (plus UKB primary care records if gp_fn is
+# given) and write out the results.
+def translate_file(diag_fn, src, out_dir, chunksize, wide, pop_ids, gp_fn = None):
+    st = datetime.now()
+
+    trips, chunk_ids = map_file(diag_fn, src, MAPS, chunksize)
+
+    if gp_fn is not None:
+        gp_trips, gp_ids = map_file(gp_fn, 'gp', MAPS, chunksize)
+        trips = pd.concat([trips, gp_trips], ignore_index = True).drop_duplicates()
+        chunk_ids = pd.unique(np.concatenate([chunk_ids, gp_ids]))
+
+    # Only people in the full population (UKB: the 9,429 we can still use)
+    if pop_ids is not None:
+        trips = trips.loc[trips['id'].isin(pop_ids), :]
+    res = code_status(trips, SEX, MAPS)
+
+    chunk_name = os.path.basename(diag_fn).replace('_prepped_for_phecode.tsv', '').replace('.csv', '')
+    out_fn = f'{out_dir}/{chunk_name}_one_min_code_cnt_phecode_long.tsv'
+    res.to_csv(out_fn, sep = '\t', index = False)
+
+    if wide:
+        # TNX: full population is everyone in the chunk, even if none of their
+        # codes map to a Phecode, UKB: everyone with sex
+        if pop_ids is None:
+            pop_ids = sorted(chunk_ids)
+        wide_fn = f'{out_dir}/{chunk_name}_one_min_code_cnt_phecode_translation.tsv'
+        to_wide(res, pop_ids, SEX, MAPS).to_csv(wide_fn, sep = '\t', index = False)
+
+    proc_time = round((datetime.now() - st).total_seconds() / 60, 3)
+    return f'{dt()} {chunk_name}: {res["id"].nunique():,} patients, {len(res):,} True/NA entries [{proc_time} mins]'
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Translate diagnosis codes to Phecodes')
+    parser.add_argument('--src', choices = list(SRC_INFO.keys()), required = True,
+                        help = 'Which data source the diagnosis files come from')
+    parser.add_argument('--diag_files', nargs = '+', default = None,
+                        help = 'Diagnosis files (defaults to all of them for --src)')
+    parser.add_argument('--out_dir', default = None, help = 'Where to write results')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'Number of files to translate at once')
+    parser.add_argument('--chunksize', type = int, default = CHUNK_SIZE,
+                        help = 'Rows read at a time from each file')
+    parser.add_argument('--wide', action = 'store_true',
+                        help = 'Also write the createPhenotypes (wide) layout')
+    parser.add_argument('--gp_file', default = None,
+                        help = ('UKB primary care records (gp_clin.tsv) to translate Read v2/CTV3 -> ICD10 '
+                                'and add to the UKB diagnoses, if --diag_files has no GP rows'))
+    args = vars(parser.parse_args())
+
+    if (args['gp_file'] is not None) and (args['src'] != 'ukb'):
+        parser.error('--gp_file only goes with --src ukb')
+
+    src_info = SRC_INFO[args['src']]
+    diag_fns = args['diag_files'] or sorted(glob.glob(src_info['diag_glob']))
+    if (args['gp_file'] is not None) and (len(diag_fns) != 1):
+        parser.error('--gp_file goes with a single UKB diagnosis file')
+    out_dir = args['out_dir'] or src_info['out_dir']
+    os.makedirs(out_dir, exist_ok = True)
+
+    print(f'{dt()} Loading Phecode maps')
+    maps = load_maps(src_info['vocab_fn'])
+    if args['gp_file'] is not None:
+        maps['read'] = load_read_maps()
+    sex = load_sex(args['src'], src_info['sex_fn'])
+
+    # UKB full population is everyone we have sex (covariates) for
+    pop_ids = sex.index.tolist() if args['src'] == 'ukb' else None
+
+    print(f'{dt()} Translating {len(diag_fns)} file(s) with {args["workers"]} worker(s)')
+    job_args = [(curr_fn, args['src'], out_dir, args['chunksize'], args['wide'], pop_ids,
+                 args['gp_file']) for curr_fn in diag_fns]
+
+    if args['workers'] > 1:
+        with mp.Pool(args['workers'], initializer = init_worker,
+                     initargs = (maps, sex)) as pool:
+            for msg in pool.starmap(translate_file, job_args):
+                print(msg)
+    else:
+        init_worker(maps, sex)
+        for curr_args in job_args:
+            print(translate_file(*curr_args))
+
+    print(f'{dt()} All done, results in {out_dir}')
+
+if __name__ == '__main__':
+    main()
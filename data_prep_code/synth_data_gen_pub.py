@@ -0,0 +1,787 @@
+# Name:     synth_data_gen_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Writes synthetic TNX and UKB inputs in exactly the layouts our scripts
+#   read, so the pipeline can be run, benchmarked and regression tested
+#   outside the secure enclave. Nothing here is derived from patient data,
+#   every value comes from a seeded RNG, and patient ids are prefixed with
+#   'syn' so the files can't be mistaken for the real thing.
+#
+#   The output tree mirrors HOME_DIR, point a script's base directory at
+#   --out_dir to run it on the synthetic data:
+#
+#     trinetx/
+#       procd/diagnosis_ehr_only_4_cols_sorted.csv
+#                     EHR diagnoses (patient, vocab, code, date), quoted and
+#                     sorted by patient, code, date like the parsort output
+#       icd_data/{icd}_only.csv
+#                     all diagnoses of one 3 char ICD10 code with the split
+#                     3 char code the awk step added ("E11,9" or "E11",)
+#       lab_data/{loinc}_only_single_thread.csv
+#                     quoted lab results, including the codes the awk/grep
+#                     extraction wrongly picked up (26587-6 for 587-6)
+#       clean_loinc_counts.tsv, loincs_with_more_than_0_res_new_version.txt,
+#       lab_test_data_analysis_latest_manual_review.xlsx
+#       patient.csv, procd_data/procd_covs.tsv
+#       diagnosis.csv  (raw 10 column file, only with --raw_diags)
+#     phecode/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv  (symlink)
+#     phecode/tnx/tnx_procd/mcc1/mcc1_{phecode}.tsv
+#                     Phecode slices (patient, True) for min code count 1
+#     procd/cov_dat.csv, clean_antigen_data.csv, dis_dat.csv, rolled_code.csv
+#     dicts/viral_dict.xlsx, dicts/sex_specific_codes.txt
+#     results/ukb_mod_results_01_17_2023.csv
+#                     observed disease x antibody results (--parts perms)
+#     results/perm_p_sims/final/{icd}_perms_{N}_pid_0_synthetic_result.tsv
+#                     null p-values for the first --n_perm_dis diseases
+#                     (--parts perms, needs the UKB part written first),
+#                     Antigen is the raw UKB name like the permutation
+#                     scripts write, not the clean one in the results
+#     results/perm_p_sims/final/{icd}_perms_{N}_pid_0_synthetic_perm_counts.tsv
+#                     per pair permutation counts, every pair run to the end
+#     synth_params.json   (arguments used and row counts written)
+#
+#   Scale is set by --n_pats, --enc_mean/--enc_tail (encounters per patient
+#   are heavy tailed: 1 + Lomax(enc_tail) scaled to a mean of enc_mean),
+#   --diag_per_enc, --lab_per_enc, --n_icds, --n_loincs, --n_phecodes and the
+#   UKB sizes. Patients are generated in chunks of --chunk_size (each with its
+#   own RNG stream from --seed and the chunk number), so memory stays flat at
+#   any scale, output is the same for any --workers, and chunks are written
+#   in patient order which keeps the sorted files sorted.
+#
+#   Usage:
+#       python synth_data_gen_pub.py --out_dir /scratch/synth --n_pats 100000
+#       # roughly production scale (12M patients, ~1.4B diagnoses)
+#       python synth_data_gen_pub.py --out_dir /scratch/synth --n_pats 12100000 \
+#           --enc_mean 40 --workers 32 --raw_diags
+#
+
+import argparse
+import json
+import os
+import string
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from tnx_covariates_pub import derive_covs
+
+HOME_DIR = "/data/pathogen_ncd"
+OUT_DIR = f"{HOME_DIR}/synthetic"
+OUR_SEED = 5
+
+PAT_PREFIX = 'syn'
+
+# Diagnosis and lab dates run up to when the TNX data was made available
+FIRST_DAY = np.datetime64('2000-01-01')
+LAST_DAY = np.datetime64('2023-02-12')
+CURR_YEAR = 2023
+
+# Same columns (and positions, see YOB_IDX/DEATH_IDX in tnx_covariates_pub)
+# as TNX patient.csv
+PATIENT_COLS = ['patient_id', 'sex', 'race', 'ethnicity', 'marital_status',
+                'year_of_birth', 'patient_regional_location', 'month_year_death']
+
+COVS_COLS = ['patient_id', 'sex', 'ethnic', 'age', 'imp_age']
+
+SEXES = {'F' : 0.654, 'M' : 0.345, 'Unknown' : 0.001}
+RACES = {'White'                                     : 0.45,
+         'Black or African American'                 : 0.15,
+         'Asian'                                     : 0.03,
+         'American Indian or Alaska Native'          : 0.005,
+         'Native Hawaiian or Other Pacific Islander' : 0.002,
+         'Unknown'                                   : 0.363}
+ETHNICITIES = {'Not Hispanic or Latino' : 0.55,
+               'Hispanic or Latino'     : 0.075,
+               'Unknown'                : 0.375}
+
+# Diagnoses a patient keeps coming back with, and how often a diagnosis is
+# one of those rather than a one off
+N_CHRONIC = 4
+CHRONIC_FRAC = 0.5
+
+# Fraction of diagnoses without a sub code (E11 rather than E11.9)
+NO_DOT_FRAC = 0.3
+
+# Skew of how common codes and lab tests are (Zipf-Mandelbrot, the offset
+# keeps the most common ones at a few percent)
+ZIPF_S = 1.1
+ZIPF_OFFSET = 10
+
+LAB_UNKNOWN_FRAC = 0.05
+FP_MAX_PREFIX = 99
+
+# UKB antibodies (name, organism abbreviation, seroprevalence)
+ANTIGENS = [('1gG antigen for Herpes Simplex virus-1', 'HSV1', 0.7),
+            ('2mgG unique antigen for Herpes Simplex virus-2', 'HSV2', 0.15),
+            ('gE / gI antigen for Varicella Zoster Virus', 'VZV', 0.95),
+            ('VCA p18 antigen for Epstein-Barr Virus', 'EBV', 0.95),
+            ('EBNA-1 antigen for Epstein-Barr Virus', 'EBV', 0.9),
+            ('ZEBRA antigen for Epstein-Barr Virus', 'EBV', 0.8),
+            ('EA-D antigen for Epstein-Barr Virus', 'EBV', 0.3),
+            ('pp150 Nter antigen for Human Cytomegalovirus', 'CMV', 0.55),
+            ('pp 52 antigen for Human Cytomegalovirus', 'CMV', 0.55),
+            ('pp 28 antigen for Human Cytomegalovirus', 'CMV', 0.55),
+            ('IE1A antigen for Human Herpesvirus-6', 'HHV6', 0.15),
+            ('IE1B antigen for Human Herpesvirus-6', 'HHV6', 0.6),
+            ('p101 k antigen for Human Herpesvirus-6', 'HHV6', 0.85),
+            ('U14 antigen for Human Herpesvirus-7', 'HHV7', 0.9),
+            ('LANA antigen for Kaposis Sarcoma-Associated Herpesvirus', 'KSHV', 0.05),
+            ('K8.1 antigen for Kaposis Sarcoma-Associated Herpesvirus', 'KSHV', 0.03),
+            ('HBc antigen for Hepatitis B Virus', 'HBV', 0.05),
+            ('HBe antigen for Hepatitis B Virus', 'HBV', 0.03),
+            ('Core antigen for Hepatitis C Virus', 'HCV', 0.01),
+            ('NS3 antigen for Hepatitis C Virus', 'HCV', 0.01),
+            ('p22 antigen for Toxoplasma gondii', 'TOXO', 0.25),
+            ('sag1 antigen for Toxoplasma gondii', 'TOXO', 0.3),
+            ('HTLV-1 gag antigen for Human T-Lymphotropic Virus 1', 'HTLV1', 0.01),
+            ('HTLV-1 env antigen for Human T-Lymphotropic Virus 1', 'HTLV1', 0.01),
+            ('HIV-1 gag antigen for Human Immunodeficiency Virus', 'HIV', 0.005),
+            ('HIV-1 env antigen for Human Immunodeficiency Virus', 'HIV', 0.005),
+            ('BK VP1 antigen for Human Polyomavirus BKV', 'BKV', 0.95),
+            ('JC VP1 antigen for Human Polyomavirus JCV', 'JCV', 0.6),
+            ('MC VP1 antigen for Merkel Cell Polyomavirus', 'MCV', 0.65),
+            ('L1 antigen for Human Papillomavirus type-16', 'HPV16', 0.2),
+            ('E6 antigen for Human Papillomavirus type-16', 'HPV16', 0.02),
+            ('E7 antigen for Human Papillomavirus type-16', 'HPV16', 0.03),
+            ('L1 antigen for Human Papillomavirus type-18', 'HPV18', 0.1),
+            ('momp D antigen for Chlamydia trachomatis', 'CT', 0.2),
+            ('momp A antigen for Chlamydia trachomatis', 'CT', 0.2),
+            ('tarp-D F1 antigen for Chlamydia trachomatis', 'CT', 0.3),
+            ('tarp-D F2 antigen for Chlamydia trachomatis', 'CT', 0.3),
+            ('PorB antigen for Chlamydia trachomatis', 'CT', 0.2),
+            ('pGP3 antigen for Chlamydia trachomatis', 'CT', 0.2),
+            ('CagA antigen for Helicobacter pylori', 'HP', 0.15),
+            ('VacA antigen for Helicobacter pylori', 'HP', 0.2),
+            ('OMP antigen for Helicobacter pylori', 'HP', 0.3),
+            ('GroEL antigen for Helicobacter pylori', 'HP', 0.3),
+            ('Catalase antigen for Helicobacter pylori', 'HP', 0.3),
+            ('UreA antigen for Helicobacter pylori', 'HP', 0.3)]
+
+# UKB covariates, the values each can take and how many are missing
+UKB_COVS = {'sex'          : ([0, 1], [0.56, 0.44], 0),
+            'ethnic'       : ([0, 1, 2, 3], [0.94, 0.02, 0.02, 0.02], 0),
+            'tdi_quant'    : ([0, 1, 2, 3, 4], [0.2] * 5, 0.001),
+            'num_in_house' : ([0, 1, 2, 3, 4], [0.18, 0.45, 0.16, 0.14, 0.07], 0.003),
+            'tobac'        : ([0, 1, 2], [0.55, 0.35, 0.1], 0.001),
+            'alc'          : ([0, 1, 2], [0.04, 0.04, 0.92], 0.001),
+            'num_sex_part' : ([0, 1, 2, 3, 4], [0.01, 0.25, 0.35, 0.24, 0.15], 0.1),
+            'same_sex'     : ([0, 1], [0.96, 0.04], 0.1)}
+
+# Permutation result file columns (RESULT_COLS in ukb_icd_permutation_engine_pub.py)
+PERM_COLS = ['Unparsed_Disease', 'Disease', 'ICD10_Cat', 'ICD10_Site',
+             'sex_specific_dis', 'nCase', 'nControl', 'control_set',
+             'n_mixed', 'Antigen', 'organism', 'p_val', 'anti_OR',
+             'anti_CI', 'model', 'r2_tjur', 'r2_mcfad', 'r2_adj_mcfad',
+             'r2_nagelkerke', 'r2_coxsnell', 'cov_ps', 'sig_covs',
+             'cov_adj_for', 'cov_ors', 'avg_age_case', 'avg_avg_con',
+             'avg_titer_case', 'avg_titer_con', 'std_titer_case',
+             'std_titer_con', 'med_titer_case', 'med_titer_con', 'Warnings',
+             'is_warning', 'proc_time', 'date_time', 'perm_n']
+
+# Observed UKB results columns, as ukb_icd_empirical_p_calculations_pub.py
+# reads them
+OBS_COLS = PERM_COLS[:-3] + ['vanilla_pair', 'vanilla_dis', 'proc_time', 'date_time',
+                             'mod_version', 'icd', 'std_lev', 'p_sig', 'risk',
+                             'protect', 'effect']
+
+HEALTHY_PREGNANCY_CODES = ['O80', 'O81', 'O82', 'O83', 'O84']
+
+# 3 char ICD10 cancer codes in rolled_code.csv (127 of them like the real one)
+ROLL_CODES = [f"C{x:02d}" for x in range(98)] + [f"D{x:02d}" for x in range(29)]
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def zipf_probs(n):
+    probs = 1 / (np.arange(n) + ZIPF_OFFSET) ** ZIPF_S
+
+    return probs / probs.sum()
+
+def choose(rng, opts, size):
+    return rng.choice(list(opts.keys()), size = size, p = list(opts.values()))
+
+# Heavy tailed counts with the given mean: 1 + Lomax(tail), capped at max_n
+def heavy_tail(rng, size, mean, tail, max_n):
+    scale = (mean - 1) * (tail - 1) if tail > 1 else (mean - 1)
+    vals = 1 + np.floor(rng.pareto(tail, size) * scale)
+
+    return np.minimum(vals, max_n).astype(np.int64)
+
+# Sex the synthetic UKB / TNX code is restricted to, if any
+def code_sex(code):
+    if code[0] == 'O' or ('N70' <= code <= 'N98') or ('C51' <= code <= 'C58'):
+        return 'female'
+    if ('N40' <= code <= 'N53') or ('C60' <= code <= 'C63'):
+        return 'male'
+
+    return None
+
+# Numbers (or anything) as an object array of str, the fastest to add up
+def as_str(vals):
+    return np.asarray(vals).astype(str).astype(object)
+
+# Join columns (object arrays of str) into quoted CSV lines like TNX exports
+# them
+def quote_rows(cols):
+    out = '"' + cols[0]
+    for curr_col in cols[1:]:
+        out = out + '","' + curr_col
+
+    return out + '"'
+
+def to_text(lines):
+    return '\n'.join(lines) + '\n' if len(lines) else ''
+
+# Split lines (already sorted by key) into one text block per key value
+def split_by(lines, keys):
+    if len(keys) == 0:
+        return {}
+
+    uniq, starts = np.unique(keys, return_index = True)
+    ends = np.append(starts[1:], len(keys))
+
+    return {k : to_text(lines[s:e]) for k, s, e in zip(uniq, starts, ends)}
+
+def append_text(out_fn, text):
+    with open(out_fn, 'a') as out_file:
+        out_file.write(text)
+
+# Codes, LOINCs and Phecodes shared by every chunk
+def build_tables(args):
+    rng = np.random.default_rng(np.random.SeedSequence(args['seed'], spawn_key = (0,)))
+
+    # 3 char ICD10 codes the TNX diagnoses are drawn from, more common first
+    all_icd10 = np.array([f"{x}{y:02d}" for x in string.ascii_uppercase for y in range(100)])
+    icd10 = all_icd10[rng.permutation(len(all_icd10))][:args['n_icds']]
+
+    n_icd9 = min(999, max(1, args['n_icds'] // 2))
+    icd9 = np.array([f"{x:03d}" for x in rng.permutation(np.arange(1, 1000))[:n_icd9]])
+
+    # Every 3 char code (ICD10 then ICD9) gets 11 full codes: no sub code and
+    # .0 - .9, a full code's id is 3 char index * 11 + variant.
+    three_str = np.concatenate([icd10, icd9]).astype(object)
+    full_str = np.array([x if y == 0 else f"{x}.{y - 1}" for x in three_str for y in range(11)],
+                        dtype = object)
+
+    # Rank of each full code in sort order, for sorting rows without strings
+    full_rank = np.empty(len(full_str), dtype = np.int64)
+    full_rank[np.argsort(full_str.astype(str), kind = 'stable')] = np.arange(len(full_str))
+
+    # Phecodes look like 008, 250.2 or 411.41; each 3 char code maps to one
+    # (or none)
+    phe_cands = np.array([f"{x:03d}" if y == 0 else f"{x:03d}.{y}"
+                          for x in range(8, 1000) for y in range(10)])
+    phecodes = np.sort(rng.choice(phe_cands, min(args['n_phecodes'], len(phe_cands)),
+                                  replace = False))
+    phe_map = rng.integers(0, len(phecodes), len(three_str))
+    phe_map[rng.random(len(three_str)) < 0.1] = -1
+
+    # LOINC codes (NNNNN-N) and what we know about each test
+    n_loincs = args['n_loincs']
+    loinc_nums = rng.choice(np.arange(100, 100000), n_loincs, replace = False)
+    loincs = np.array([f"{x}-{rng.integers(0, 10)}" for x in loinc_nums], dtype = object)
+    loinc_cat = rng.random(n_loincs) < 0.8
+    lab_info = pd.DataFrame({'loinc'      : loincs,
+                             'good'       : np.where(rng.random(n_loincs) < 0.9, 'y', 'n'),
+                             'src'        : rng.choice(sorted(set(x[1] for x in ANTIGENS)), n_loincs),
+                             'final_type' : np.where(loinc_cat, 'cat', 'num'),
+                             'SCALE_TYP'  : np.where(loinc_cat, 'Ord', 'Qn'),
+                             'unit'       : np.where(loinc_cat, '', '[IU]/mL')})
+    lab_info['COMPONENT'] = lab_info['src'] + ' Ab (synthetic)'
+
+    day_strs = np.datetime_as_string(np.arange(FIRST_DAY, LAST_DAY + 1), unit = 'D')
+
+    return {'params'    : args,
+            'n_icd10'   : len(icd10),
+            'n_icd9'    : n_icd9,
+            'p_icd10'   : zipf_probs(len(icd10)),
+            'p_icd9'    : zipf_probs(n_icd9),
+            'three_str' : three_str,
+            'full_str'  : full_str,
+            'full_rank' : full_rank,
+            'phecodes'  : phecodes,
+            'phe_map'   : phe_map,
+            'loincs'    : loincs,
+            'p_loinc'   : zipf_probs(n_loincs),
+            'loinc_cat' : loinc_cat,
+            'loinc_pos' : rng.beta(1, 4, n_loincs),
+            'loinc_unit': lab_info['unit'].to_numpy(object),
+            'lab_info'  : lab_info,
+            'day_strs'  : np.char.replace(day_strs, '-', '').astype(object)}
+
+############################################
+#                                          #
+#           TNX chunk generation           #
+#                                          #
+############################################
+
+TABLES = None
+
+def init_worker(tables):
+    global TABLES
+    TABLES = tables
+
+# Patients (patient.csv rows) for a chunk, with the first day each could be
+# seen (after birth, in days from FIRST_DAY)
+def gen_patients(rng, pat_ids, n_days):
+    n = len(pat_ids)
+
+    age = np.clip(np.round(rng.normal(46.4, 17.5, n)), 0, 91)
+    yob = CURR_YEAR - age
+
+    # Deaths as YYYYMM, the same float-ish column TNX has
+    dead = rng.random(n) < 0.05
+    death_yr = np.maximum(yob, 2000) + np.floor(rng.random(n) * (CURR_YEAR - np.maximum(yob, 2000)))
+    death = np.where(dead, death_yr * 100 + rng.integers(1, 13, n), np.nan)
+
+    pats = pd.DataFrame({'patient_id'                : pat_ids,
+                         'sex'                       : choose(rng, SEXES, n),
+                         'race'                      : choose(rng, RACES, n),
+                         'ethnicity'                 : choose(rng, ETHNICITIES, n),
+                         'marital_status'            : rng.choice(['Married', 'Single', 'Unknown'], n),
+                         'year_of_birth'             : yob,
+                         'patient_regional_location' : rng.choice(['Northeast', 'Midwest', 'South',
+                                                                   'West', 'Unknown'], n),
+                         'month_year_death'          : death},
+                        columns = PATIENT_COLS)
+
+    first_ok = np.clip((yob - 2000) * 365.25, 0, n_days - 1)
+
+    # Some patients have no year of birth (86K of 12M)
+    pats.loc[rng.random(n) < 0.007, 'year_of_birth'] = np.nan
+
+    return pats, first_ok
+
+def gen_chunk(chunk_idx, start, end):
+    tab = TABLES
+    p = tab['params']
+    rng = np.random.default_rng(np.random.SeedSequence(p['seed'], spawn_key = (1, chunk_idx)))
+
+    n = end - start
+    pat_ids = np.array([f"{PAT_PREFIX}{x:09d}" for x in range(start, end)], dtype = object)
+    day_strs = tab['day_strs']
+    n_days = len(day_strs)
+
+    pats, first_ok = gen_patients(rng, pat_ids, n_days)
+
+    covs = derive_covs(pats)
+    covs['imp_age'] = covs['age'].fillna(covs['age'].mean())
+    covs['age'] = covs['age'] / 10
+    covs['imp_age'] = covs['imp_age'] / 10
+
+    # Encounters, each patient is seen over a window of a few years
+    n_enc = heavy_tail(rng, n, p['enc_mean'], p['enc_tail'], p['max_enc'])
+    enc_start = np.cumsum(n_enc) - n_enc
+    first = first_ok + rng.random(n) * (n_days - 1 - first_ok)
+    span = np.minimum(n_days - 1 - first, rng.exponential(5 * 365, n))
+
+    enc_pat = np.repeat(np.arange(n), n_enc)
+    enc_day = (first[enc_pat] + rng.random(len(enc_pat)) * span[enc_pat]).astype(np.int64)
+    enc_ids = pat_ids[enc_pat] + '-' + as_str(np.arange(len(enc_pat)) - enc_start[enc_pat])
+
+    # Diagnoses, a mix of each patient's chronic codes and one offs
+    n_diag = 1 + rng.poisson(max(p['diag_per_enc'] - 1, 0), len(enc_pat))
+    d_enc = np.repeat(np.arange(len(enc_pat)), n_diag)
+    d_pat = enc_pat[d_enc]
+    d_day = enc_day[d_enc]
+    nd = len(d_enc)
+
+    n10 = tab['n_icd10']
+    chron10 = rng.choice(n10, (n, N_CHRONIC), p = tab['p_icd10'])
+    chron9 = rng.choice(tab['n_icd9'], (n, N_CHRONIC), p = tab['p_icd9'])
+
+    use_chron = rng.random(nd) < CHRONIC_FRAC
+    slot = rng.integers(0, N_CHRONIC, nd)
+    three10 = np.where(use_chron, chron10[d_pat, slot], rng.choice(n10, nd, p = tab['p_icd10']))
+    three9 = np.where(use_chron, chron9[d_pat, slot], rng.choice(tab['n_icd9'], nd, p = tab['p_icd9']))
+
+    is9 = rng.random(nd) < p['icd9_frac']
+    three = np.where(is9, n10 + three9, three10)
+    variant = np.where(rng.random(nd) < NO_DOT_FRAC, 0, rng.integers(1, 11, nd))
+    code_id = three * 11 + variant
+
+    ehr = 1 - p['ehr_frac']
+    src = rng.choice(np.array(['EHR', 'NLP', 'TriNetX'], dtype = object), nd,
+                     p = [p['ehr_frac'], ehr * 0.7, ehr * 0.3])
+    is_ehr = src == 'EHR'
+
+    vocab = np.where(is9, 'ICD-9-CM', 'ICD-10-CM').astype(object)
+    princ = np.where(rng.random(nd) < 0.3, 'Y', 'N').astype(object)
+    admit = np.where(rng.random(nd) < 0.1, 'Y', 'N').astype(object)
+    derived = np.where(src == 'TriNetX', 'Y', 'N').astype(object)
+
+    # The 10 columns of diagnosis.csv for rows idx
+    def diag_cols(idx):
+        return [pat_ids[d_pat[idx]], enc_ids[d_enc[idx]], vocab[idx],
+                tab['full_str'][code_id[idx]], princ[idx], admit[idx],
+                np.full(len(idx), 'N', dtype = object), day_strs[d_day[idx]],
+                derived[idx], src[idx]]
+
+    res = {'n_pats' : n, 'n_enc' : len(enc_pat), 'n_diag' : nd}
+
+    # Raw diagnosis.csv rows in the order they were made
+    if p['raw_diags']:
+        res['raw'] = to_text(quote_rows(diag_cols(np.arange(nd))))
+
+    # EHR only 4 column file, sorted by patient, code, date
+    idx = np.flatnonzero(is_ehr)
+    idx = idx[np.lexsort((d_day[idx], tab['full_rank'][code_id[idx]], d_pat[idx]))]
+    res['diag4'] = to_text(quote_rows([pat_ids[d_pat[idx]], vocab[idx],
+                                       tab['full_str'][code_id[idx]], day_strs[d_day[idx]]]))
+    res['n_diag4'] = len(idx)
+
+    # Per ICD10 code files (all sources) with the awk split 3 char code
+    # tacked on: "E11.9" -> "E11,9" and "E11" -> "E11",
+    idx = np.flatnonzero(~is9)
+    idx = idx[np.lexsort((d_day[idx], d_pat[idx], three[idx]))]
+    three_idx = tab['three_str'][three[idx]]
+    split_col = np.where(variant[idx] == 0, '"' + three_idx + '",',
+                         '"' + three_idx + ',' + as_str(variant[idx] - 1) + '"')
+    lines = quote_rows(diag_cols(idx)) + ',' + split_col
+    res['icd'] = split_by(lines, three[idx])
+
+    # Phecode slices: patients with at least one EHR code mapping to it
+    idx = np.flatnonzero(is_ehr & (tab['phe_map'][three] >= 0))
+    keys = np.unique(tab['phe_map'][three[idx]] * n + d_pat[idx])
+    phe_idx, phe_pat = keys // n, keys % n
+    res['phe'] = split_by(pat_ids[phe_pat] + '\tTrue', phe_idx)
+
+    # Labs, drawn at the patient's encounters. Some rows carry a longer code
+    # that contains the LOINC (26587-6 for 587-6) as the grep extraction
+    # picked those up too.
+    n_lab = rng.poisson(p['lab_per_enc'] * n_enc)
+    l_pat = np.repeat(np.arange(n), n_lab)
+    nl = len(l_pat)
+    l_enc = enc_start[l_pat] + (rng.random(nl) * n_enc[l_pat]).astype(np.int64)
+    l_loinc = rng.choice(len(tab['loincs']), nl, p = tab['p_loinc'])
+
+    is_fp = rng.random(nl) < p['fp_frac']
+    code = tab['loincs'][l_loinc]
+    code[is_fp] = as_str(rng.integers(1, FP_MAX_PREFIX + 1, nl)[is_fp]) + code[is_fp]
+
+    is_cat = tab['loinc_cat'][l_loinc]
+    u = rng.random(nl)
+    text = np.where(~is_cat, '', np.where(u < LAB_UNKNOWN_FRAC, 'Unknown',
+                    np.where(u < LAB_UNKNOWN_FRAC + (1 - LAB_UNKNOWN_FRAC) * tab['loinc_pos'][l_loinc],
+                             'Positive', 'Negative'))).astype(object)
+    num = as_str(np.round(rng.lognormal(3, 1.5, nl), 2))
+    num[is_cat] = ''
+
+    lines = quote_rows([pat_ids[l_pat], enc_ids[l_enc], np.full(nl, 'LOINC', dtype = object),
+                        code, day_strs[enc_day[l_enc]], num, text, tab['loinc_unit'][l_loinc],
+                        np.full(nl, 'N', dtype = object), np.full(nl, 'EHR', dtype = object)])
+    order = np.argsort(l_loinc, kind = 'stable')
+    res['labs'] = split_by(lines[order], l_loinc[order])
+
+    # Patients per LOINC (real codes only) for clean_loinc_counts
+    keys = np.unique(l_loinc[~is_fp] * n + l_pat[~is_fp])
+    res['lab_pats'] = np.bincount(keys // n, minlength = len(tab['loincs']))
+    res['n_lab'] = nl
+
+    res['pats'] = pats.to_csv(header = False, index = False)
+    res['covs'] = covs[COVS_COLS].to_csv(sep = '\t', header = False, index = False)
+
+    return res
+
+# Generate chunks, in order, keeping at most a couple per worker in flight
+def run_chunks(chunks, tables, workers):
+    if workers <= 1:
+        init_worker(tables)
+        for curr_chunk in chunks:
+            yield gen_chunk(*curr_chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker,
+                             initargs = (tables,)) as pool:
+        pending = deque()
+        for curr_chunk in chunks:
+            pending.append(pool.submit(gen_chunk, *curr_chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def write_tnx(out_dir, tables, args):
+    tnx_dir = f"{out_dir}/trinetx"
+    icd_dir = f"{tnx_dir}/icd_data"
+    lab_dir = f"{tnx_dir}/lab_data"
+    phe_dir = f"{out_dir}/phecode/tnx/tnx_procd/mcc1"
+    raw_dir = f"{out_dir}/phecode/tnx/tnx_raw"
+
+    for curr_dir in [f"{tnx_dir}/procd", f"{tnx_dir}/procd_data", icd_dir, lab_dir,
+                     phe_dir, raw_dir]:
+        os.makedirs(curr_dir, exist_ok = True)
+
+    diag4_fn = f"{tnx_dir}/procd/diagnosis_ehr_only_4_cols_sorted.csv"
+    raw_fn = f"{tnx_dir}/diagnosis.csv"
+    pats_fn = f"{tnx_dir}/patient.csv"
+    covs_fn = f"{tnx_dir}/procd_data/procd_covs.tsv"
+
+    icd_fns = [f"{icd_dir}/{x}_only.csv" for x in tables['three_str'][:tables['n_icd10']]]
+    lab_fns = [f"{lab_dir}/{x}_only_single_thread.csv" for x in tables['loincs']]
+    phe_fns = [f"{phe_dir}/mcc1_{x}.tsv" for x in tables['phecodes']]
+
+    # Start every file fresh, codes nobody has still get an (empty) file
+    for curr_fn in [diag4_fn] + icd_fns + lab_fns + ([raw_fn] if args['raw_diags'] else []):
+        open(curr_fn, 'w').close()
+
+    for curr_fn, curr_phe in zip(phe_fns, tables['phecodes']):
+        with open(curr_fn, 'w') as out_file:
+            out_file.write(f"id\t{curr_phe}\n")
+
+    with open(pats_fn, 'w') as out_file:
+        out_file.write(','.join(PATIENT_COLS) + '\n')
+    with open(covs_fn, 'w') as out_file:
+        out_file.write('\t'.join(COVS_COLS) + '\n')
+
+    link_fn = f"{raw_dir}/diagnosis_ehr_only_4_cols_sorted.csv"
+    if os.path.lexists(link_fn):
+        os.remove(link_fn)
+    os.symlink(os.path.relpath(diag4_fn, raw_dir), link_fn)
+
+    n_pats = args['n_pats']
+    chunks = [(i, x, min(x + args['chunk_size'], n_pats))
+              for i, x in enumerate(range(0, n_pats, args['chunk_size']))]
+
+    totals = {'n_pats' : 0, 'n_enc' : 0, 'n_diag' : 0, 'n_diag4' : 0, 'n_lab' : 0}
+    lab_pats = np.zeros(len(tables['loincs']), dtype = np.int64)
+
+    for i, res in enumerate(run_chunks(chunks, tables, args['workers'])):
+        append_text(diag4_fn, res['diag4'])
+        if args['raw_diags']:
+            append_text(raw_fn, res['raw'])
+        for curr_idx, curr_text in res['icd'].items():
+            append_text(icd_fns[curr_idx], curr_text)
+        for curr_idx, curr_text in res['labs'].items():
+            append_text(lab_fns[curr_idx], curr_text)
+        for curr_idx, curr_text in res['phe'].items():
+            append_text(phe_fns[curr_idx], curr_text)
+        append_text(pats_fn, res['pats'])
+        append_text(covs_fn, res['covs'])
+
+        for curr_key in totals:
+            totals[curr_key] += res[curr_key]
+        lab_pats += res['lab_pats']
+
+        print(f"Chunk {i + 1}/{len(chunks)}: {totals['n_pats']:,} patients, "
+              f"{totals['n_diag']:,} diagnoses, {totals['n_lab']:,} labs")
+
+    # LOINC metadata the pair generators read
+    lab_info = tables['lab_info'].copy()
+    lab_info['count'] = lab_pats
+    lab_info[['loinc', 'count', 'COMPONENT', 'SCALE_TYP', 'unit']].to_csv(
+        f"{tnx_dir}/clean_loinc_counts.tsv", sep = '\t', index = False)
+    # The pair generators look every listed LOINC up in the reviewed sheet,
+    # so like the real list this only has tests that passed review
+    is_listed = (lab_info['count'] > 0) & (lab_info['good'] == 'y')
+    lab_info.loc[is_listed, ['loinc', 'count']].to_csv(
+        f"{tnx_dir}/loincs_with_more_than_0_res_new_version.txt", sep = '\t', index = False)
+    lab_info[['loinc', 'good', 'src', 'final_type']].to_excel(
+        f"{tnx_dir}/lab_test_data_analysis_latest_manual_review.xlsx", index = False)
+
+    return totals
+
+############################################
+#                                          #
+#               UKB data                   #
+#                                          #
+############################################
+
+def write_ukb(out_dir, args):
+    rng = np.random.default_rng(np.random.SeedSequence(args['seed'], spawn_key = (2,)))
+    n = args['n_ukb']
+
+    procd_dir = f"{out_dir}/procd"
+    dict_dir = f"{out_dir}/dicts"
+    os.makedirs(procd_dir, exist_ok = True)
+    os.makedirs(dict_dir, exist_ok = True)
+
+    eids = pd.Index(np.sort(rng.choice(np.arange(1000000, 6030000), n, replace = False)),
+                    name = 'eid')
+
+    # Covariates (age in decades, like s_age)
+    cov_dat = pd.DataFrame(index = eids)
+    for curr_cov, (vals, probs, na_frac) in UKB_COVS.items():
+        cov_dat[curr_cov] = rng.choice(vals, n, p = probs).astype(float)
+        cov_dat.loc[rng.random(n) < na_frac, curr_cov] = np.nan
+        if na_frac == 0:
+            cov_dat[curr_cov] = cov_dat[curr_cov].astype(int)
+
+    cov_dat.insert(1, 'age', np.round(np.clip(rng.normal(67.5, 8.1, n), 43.8, 82.6) / 10, 4))
+    cov_dat.insert(2, 'bmi', np.round(rng.normal(27.4, 4.7, n), 4))
+    cov_dat.loc[rng.random(n) < 0.003, 'bmi'] = np.nan
+    cov_dat.to_csv(f"{procd_dir}/cov_dat.csv")
+
+    # Antibody MFIs, seropositive people sit well above the negatives
+    ant_dat = pd.DataFrame(index = eids)
+    for curr_ant, _, curr_prev in ANTIGENS:
+        is_pos = rng.random(n) < curr_prev
+        ant_dat[f"{curr_ant}_init"] = np.maximum(np.round(np.where(is_pos, rng.lognormal(7.5, 1.0, n),
+                                                        rng.lognormal(3.5, 1.0, n))), 1)
+    ant_dat.to_csv(f"{procd_dir}/clean_antigen_data.csv")
+
+    ant_dict = pd.DataFrame({'Antigen'        : [x[0] for x in ANTIGENS],
+                             'Abbrev'         : [x[1] for x in ANTIGENS],
+                             'Clean Ant Name' : [x[0].split(' antigen for')[0] for x in ANTIGENS],
+                             'Organism'       : [x[0].split('antigen for ')[1] for x in ANTIGENS]})
+    ant_dict.to_excel(f"{dict_dir}/viral_dict.xlsx", index = False)
+
+    # Non-cancer first occurrences and rolled up cancer codes, sex specific
+    # codes are only ever true for that sex
+    non_can = np.array([f"{x}{y:02d}" for x in string.ascii_uppercase for y in range(100)
+                        if not ((x == 'C') or ((x == 'D') and (y < 49)))])
+    non_can = [x for x in non_can[rng.permutation(len(non_can))] if x not in HEALTHY_PREGNANCY_CODES]
+    dis_codes = sorted(HEALTHY_PREGNANCY_CODES + non_can[:max(args['n_ukb_dis'] - 5, 0)])
+
+    sex_ls = []
+    def status_df(codes, desc, prev_b):
+        status = {}
+        for curr_code in codes:
+            curr_sex = code_sex(curr_code)
+            curr_dis = rng.random(n) < rng.beta(0.5, prev_b)
+            if curr_sex is not None:
+                curr_dis &= cov_dat['sex'].to_numpy() == (0 if curr_sex == 'female' else 1)
+                sex_ls.append([curr_code, f"{desc} {curr_code}", curr_sex])
+            status[f"{desc} {curr_code}[{curr_code}]"] = curr_dis
+
+        return pd.DataFrame(status, index = eids)
+
+    status_df(dis_codes, 'synthetic condition', 60).to_csv(f"{procd_dir}/dis_dat.csv")
+    status_df(ROLL_CODES, 'synthetic neoplasm', 150).to_csv(f"{procd_dir}/rolled_code.csv")
+
+    pd.DataFrame(sex_ls, columns = ['icd_code', 'disease', 'sex']).to_csv(
+        f"{dict_dir}/sex_specific_codes.txt", sep = '\t', index = False)
+
+    return {'n_ukb' : n, 'n_ukb_dis' : len(dis_codes), 'n_roll' : len(ROLL_CODES)}
+
+############################################
+#                                          #
+#         UKB permutation results          #
+#                                          #
+############################################
+
+# Observed results for every disease x antibody pair and a null distribution
+# file per disease for the empirical p-value step. Diseases come from the
+# dis_dat.csv the UKB part wrote.
+def write_perms(out_dir, args):
+    rng = np.random.default_rng(np.random.SeedSequence(args['seed'], spawn_key = (3,)))
+
+    dis_cols = pd.read_csv(f"{out_dir}/procd/dis_dat.csv", nrows = 0).columns[1:]
+    dis_codes = [x.split('[')[1].rstrip(']') for x in dis_cols]
+    dis_names = [x.split('[')[0] for x in dis_cols]
+
+    res_dir = f"{out_dir}/results"
+    perm_dir = f"{res_dir}/perm_p_sims/final"
+    os.makedirs(perm_dir, exist_ok = True)
+    os.makedirs(f"{res_dir}/perm_p_sims/emp_calcs", exist_ok = True)
+
+    ant_names = [x[0].split(' antigen for')[0] for x in ANTIGENS]
+    raw_names = [x[0] for x in ANTIGENS]
+    ant_orgs = [x[1] for x in ANTIGENS]
+    n_ant = len(ANTIGENS)
+    n_obs = len(dis_codes) * n_ant
+
+    obs = pd.DataFrame(np.nan, index = range(n_obs), columns = OBS_COLS, dtype = object)
+    obs['Unparsed_Disease'] = np.repeat(dis_cols, n_ant)
+    obs['Disease'] = np.repeat(dis_names, n_ant)
+    obs['icd'] = np.repeat(dis_codes, n_ant)
+    obs['ICD10_Cat'] = obs['icd'].str[0]
+    obs['ICD10_Site'] = obs['icd']
+    obs['Antigen'] = np.tile(ant_names, len(dis_codes))
+    obs['organism'] = np.tile(ant_orgs, len(dis_codes))
+    obs['nCase'] = rng.integers(1, 2000, n_obs)
+    obs['nControl'] = args['n_ukb'] - obs['nCase']
+    obs['p_val'] = rng.beta(0.8, 1, n_obs)
+    obs['anti_OR'] = np.round(rng.lognormal(0, 0.2, n_obs), 4)
+    obs['model'] = 'glm'
+    obs['mod_version'] = 3
+    obs.to_csv(f"{res_dir}/ukb_mod_results_01_17_2023.csv", index = False)
+
+    # The permutation scripts write the UKB antigen column name (minus _init)
+    # to Antigen, the clean name only shows up in the _perm_counts.tsv file
+    perm_icds = dis_codes[:args['n_perm_dis']]
+    n_perm = args['n_perms'] * n_ant
+    for curr_icd in perm_icds:
+        perms = pd.DataFrame(np.nan, index = range(n_perm), columns = PERM_COLS, dtype = object)
+        perms['Disease'] = curr_icd
+        perms['Antigen'] = np.tile(raw_names, args['n_perms'])
+        perms['organism'] = np.tile(ant_orgs, args['n_perms'])
+        perms['p_val'] = rng.random(n_perm)
+        perms['perm_n'] = np.repeat(np.arange(args['n_perms']), n_ant)
+
+        perm_fn = f"{perm_dir}/{curr_icd}_perms_{args['n_perms']}_pid_0_synthetic_result.tsv"
+        perms.to_csv(perm_fn, sep = '\t', index = False)
+
+        obs_p = obs.loc[obs['icd'] == curr_icd, 'p_val'].values
+        n_lt = (perms['p_val'].values.reshape(args['n_perms'], n_ant) <= obs_p).sum(axis = 0)
+        cnts = pd.DataFrame({'Antigen'        : raw_names,
+                             'clean_ant_name' : ant_names,
+                             'organism'       : ant_orgs,
+                             'obs_p'          : obs_p,
+                             'perms_run'      : args['n_perms'],
+                             'perms_lt_obs_p' : n_lt,
+                             'stopped_early'  : 'FALSE'})
+        cnts.to_csv(perm_fn.replace('_result.tsv', '_perm_counts.tsv'), sep = '\t', index = False)
+
+    return {'n_obs_res' : n_obs, 'perm_icds' : perm_icds}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Seeded synthetic TNX/UKB inputs in the layouts our scripts read')
+    parser.add_argument('--out_dir', default = OUT_DIR, help = 'Base directory to write to (mirrors HOME_DIR)')
+    parser.add_argument('--seed', type = int, default = OUR_SEED, help = 'RNG seed')
+    parser.add_argument('--parts', nargs = '+', default = ['tnx', 'ukb'],
+                        choices = ['tnx', 'ukb', 'perms'],
+                        help = 'Which data sets to write')
+    parser.add_argument('--n_pats', type = int, default = 100000, help = 'TNX patients')
+    parser.add_argument('--enc_mean', type = float, default = 20, help = 'Mean encounters per patient')
+    parser.add_argument('--enc_tail', type = float, default = 1.5,
+                        help = 'Tail index of encounters per patient (smaller is heavier)')
+    parser.add_argument('--max_enc', type = int, default = 10000, help = 'Cap on encounters per patient')
+    parser.add_argument('--diag_per_enc', type = float, default = 3, help = 'Mean diagnoses per encounter')
+    parser.add_argument('--lab_per_enc', type = float, default = 0.1,
+                        help = 'Mean lab results (of the LOINCs we pull) per encounter')
+    parser.add_argument('--icd9_frac', type = float, default = 0.3, help = 'Fraction of ICD9 diagnoses')
+    parser.add_argument('--ehr_frac', type = float, default = 0.8, help = 'Fraction of diagnoses from the EHR')
+    parser.add_argument('--fp_frac', type = float, default = 0.05,
+                        help = 'Fraction of lab rows with a longer code containing the LOINC')
+    parser.add_argument('--n_icds', type = int, default = 1000, help = '3 char ICD10 codes (max 2,600)')
+    parser.add_argument('--n_loincs', type = int, default = 300, help = 'LOINC codes')
+    parser.add_argument('--n_phecodes', type = int, default = 1800, help = 'Phecodes')
+    parser.add_argument('--n_ukb', type = int, default = 9429, help = 'UKB participants')
+    parser.add_argument('--n_ukb_dis', type = int, default = 1127, help = 'UKB non-cancer diseases')
+    parser.add_argument('--n_perms', type = int, default = 10000, help = 'Permutations per perm file')
+    parser.add_argument('--n_perm_dis', type = int, default = 1, help = 'Diseases to write perm files for')
+    parser.add_argument('--raw_diags', action = 'store_true', help = 'Also write the raw diagnosis.csv')
+    parser.add_argument('--chunk_size', type = int, default = 20000, help = 'Patients per chunk')
+    parser.add_argument('--workers', type = int, default = 1, help = 'Chunks to generate at once')
+    args = vars(parser.parse_args())
+
+    os.makedirs(args['out_dir'], exist_ok = True)
+
+    start = time.time()
+    counts = {}
+    if 'tnx' in args['parts']:
+        counts.update(write_tnx(args['out_dir'], build_tables(args), args))
+    if 'ukb' in args['parts']:
+        counts.update(write_ukb(args['out_dir'], args))
+    if 'perms' in args['parts']:
+        counts.update(write_perms(args['out_dir'], args))
+
+    counts['elapsed_s'] = round(time.time() - start, 1)
+
+    with open(f"{args['out_dir']}/synth_params.json", 'w') as out_file:
+        json.dump({'args' : args, 'counts' : counts}, out_file, indent = 1)
+
+    print(f"Done in {counts['elapsed_s']}s: {counts}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+# Name:     test_phecode_translation_engine_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Runs phecode_translation_engine_pub.py on a hand-built TNX chunk with tiny
+#   Phecode reference files and checks the createPhenotypes rules we have to
+#   match: sex restricted Phecodes are NA for everyone of the other sex
+#   (restrictPhecodesBySex), and the wide output has a row for every patient in
+#   the chunk, including ones whose codes don't map to any Phecode.
+#
+#   The UKB side is checked against ukb_phecode_raw_data_proc.ipynb: its
+#   fix_icd10/fix_icd9 and Read v2/CTV3 merge cells are pulled out of the .ipynb
+#   and run on a few codes, and translating raw codes plus GP records has to
+#   give the same Phecodes as translating what the notebook would have written.
+#
+#   Usage:
+#       python -m pytest -q data_prep_code/tests
+#
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+DATA_PREP_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/.."
+sys.path.append(DATA_PREP_DIR)
+
+import phecode_translation_engine_pub as pte
+
+NB_FN = f"{DATA_PREP_DIR}/ukb_phecode_raw_data_proc.ipynb"
+
+# vocabulary_id, code, phecode
+VOCAB = [['ICD10CM', 'N40', '600'],
+         ['ICD10CM', 'N81', '618'],
+         ['ICD10CM', 'E11', '250.2'],
+         ['ICD10CM', 'E10', '250.1']]
+
+# code, phecode_unrolled
+ROLLUP = [['600', '600'], ['618', '618'],
+          ['250.2', '250.2'], ['250.2', '250'],
+          ['250.1', '250.1'], ['250.1', '250'], ['250', '250'],
+          ['555', '555'], ['555.1', '555.1'], ['555.1', '555']]
+
+# code, exclusion_criteria
+EXCL = [['250.2', '250.1']]
+
+# phecode, male_only, female_only
+SEX_SPEC = [['600', 'TRUE', 'FALSE'],
+            ['618', 'FALSE', 'TRUE']]
+
+SEX = [['m1', 'M'], ['m2', 'M'], ['f1', 'F'], ['f2', 'F'], ['f3', 'F'],
+       ['u1', 'Unknown']]
+
+# id, vocabulary_id, code, index. f3 only has a code that doesn't map.
+DIAGS = [['m1', 'ICD10CM', 'N40', '100'],
+         ['m1', 'ICD10CM', 'N40', '200'],
+         ['m2', 'ICD10CM', 'N81', '100'],
+         ['f1', 'ICD10CM', 'N40', '150'],
+         ['f2', 'ICD10CM', 'E11', '100'],
+         ['f3', 'ICD10CM', 'Z99', '100'],
+         ['u1', 'ICD10CM', 'N40', '300']]
+
+# UKB vocabulary (vocabulary_id, code, phecode), ICD10 with periods like the
+# UKB map, ICD9 as ICD9CM
+UKB_VOCAB = [['ICD10', 'K50', '555'],
+             ['ICD10', 'K50.9', '555.1'],
+             ['ICD10', 'E11.9', '250.2'],
+             ['ICD10', 'N40', '600'],
+             ['ICD9CM', '250.00', '250.2'],
+             ['ICD9CM', '555.1', '555.1'],
+             ['ICD9CM', 'E880.9', '250'],
+             ['ICD9CM', '600', '600']]
+
+# Denaxas tables: read code, ICD10, Phecode. X30Bd maps to two ICD10s.
+READ2 = [['C10F.', 'E11.9', '250.2'],
+         ['J40..', 'K50.9', '555.1']]
+READ3 = [['XaFm8', 'E11.9', '250.2'],
+         ['X30Bd', 'K50.9', '555.1'],
+         ['X30Bd', 'K50',   '555']]
+
+# eid, event_dt, read_2, read_3: Read v2 only, CTV3 only (one to many), both
+# (Read v2 wins), neither maps, and no codes at all
+GP = [['1001', '2010-01-01', 'C10F.', np.nan],
+      ['1001', '2011-05-05', np.nan,  'X30Bd'],
+      ['1002', '2012-03-03', 'J40..', 'XaFm8'],
+      ['1002', '2013-01-01', '7L1H6', 'Y1234'],
+      ['1003', '2014-01-01', np.nan,  np.nan]]
+
+# eid, vocab, icd_code, diag_date as UKB stores the codes (no periods)
+UKB_DIAGS = [['1001', 'ICD10', 'K509',  '2009-02-02'],
+             ['1001', 'ICD9',  '25000', '1995-01-01'],
+             ['1002', 'ICD9',  'E8809', '1996-01-01'],
+             ['1002', 'ICD10', 'N40',   '2015-01-01'],
+             ['1003', 'ICD9',  '600',   '1990-01-01'],
+             ['1003', 'ICD9',  '5551',  '1991-01-01']]
+
+UKB_SEX = [['1001', 0], ['1002', 1], ['1003', 1]]
+
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Source of the first notebook code cell that contains marker
+def nb_cell(marker):
+    with open(NB_FN, 'r') as in_file:
+        nb = json.load(in_file)
+
+    for cell in nb['cells']:
+        src = ''.join(cell['source'])
+        if (cell['cell_type'] == 'code') and (marker in src):
+            return src
+
+    raise KeyError(f"No notebook cell with {marker!r}")
+
+# fix_icd10 and fix_icd9 from the notebook
+def nb_fixers():
+    ns = {}
+    exec(nb_cell("def fix_icd10"), ns)
+
+    return ns['fix_icd10'], ns['fix_icd9']
+
+# The notebook's Read v2/CTV3 merge cell on gp, giving clean_gp
+def nb_read_merge(gp, v2, v3):
+    ns = {'pd' : pd, 'np' : np, 'gp' : gp.copy(), 'v2' : v2.copy(), 'v3' : v3.copy(),
+          'pat_ls' : gp['eid'].unique().tolist()}
+    exec(nb_cell("gp['fin_icd'] = np.where"), ns)
+
+    return ns['clean_gp']
+
+# Point the engine at tiny rollup, exclusion and sex restriction files
+def write_ref_files(tmp_path, monkeypatch):
+    ref_files = {'PHE_ROLLUP_FN'   : (ROLLUP, ['code', 'phecode_unrolled']),
+                 'PHE_EXCL_FN'     : (EXCL, ['code', 'exclusion_criteria']),
+                 'PHE_SEX_SPEC_FN' : (SEX_SPEC, ['phecode', 'male_only', 'female_only'])}
+
+    for curr_const, (curr_rows, curr_cols) in ref_files.items():
+        curr_fn = f"{tmp_path}/{curr_const}.csv"
+        pd.DataFrame(curr_rows, columns = curr_cols).to_csv(curr_fn, index = False)
+        monkeypatch.setattr(pte, curr_const, curr_fn)
+
+def read_tab(rows, cols):
+    return pd.DataFrame(rows, columns = cols).astype(object)
+
+
+@pytest.fixture
+def translated(tmp_path, monkeypatch):
+    write_ref_files(tmp_path, monkeypatch)
+
+    vocab_fn = f"{tmp_path}/vocab.csv"
+    pd.DataFrame(VOCAB, columns = ['vocabulary_id', 'code', 'phecode']).to_csv(vocab_fn, index = False)
+
+    sex_fn = f"{tmp_path}/sex.tsv"
+    pd.DataFrame(SEX, columns = ['id', 'sex']).to_csv(sex_fn, sep = '\t', index = False)
+
+    diag_fn = f"{tmp_path}/chunk_0.csv"
+    pd.DataFrame(DIAGS).to_csv(diag_fn, header = False, index = False)
+
+    pte.init_worker(pte.load_maps(vocab_fn), pte.load_sex('tnx', sex_fn))
+    pte.translate_file(diag_fn, 'tnx', str(tmp_path), 2, True, None)
+
+    read_out = lambda x : pd.read_csv(f"{tmp_path}/chunk_0_one_min_code_cnt_phecode_{x}.tsv",
+                                      sep = '\t', dtype = str, keep_default_na = False)
+
+    return read_out('long'), read_out('translation').set_index('id')
+
+
+def test_wide_has_everyone_in_chunk(translated):
+    _, wide = translated
+
+    assert sorted(wide.index) == ['f1', 'f2', 'f3', 'm1', 'm2', 'u1']
+    assert (wide.loc['f3', ['250', '250.1', '250.2']] == 'False').all()
+
+def test_sex_restriction_whole_column(translated):
+    _, wide = translated
+
+    # Male only: every female is NA, coded or not, unknown sex isn't restricted
+    assert wide['600'].to_dict() == {'f1' : 'NA', 'f2' : 'NA', 'f3' : 'NA',
+                                     'm1' : 'True', 'm2' : 'False', 'u1' : 'True'}
+
+    # Female only: every male is NA
+    assert wide['618'].to_dict() == {'f1' : 'False', 'f2' : 'False', 'f3' : 'False',
+                                     'm1' : 'NA', 'm2' : 'NA', 'u1' : 'False'}
+
+def test_exclusions_and_rollup(translated):
+    _, wide = translated
+
+    assert wide.loc['f2', '250.2'] == 'True'
+    assert wide.loc['f2', '250'] == 'True'
+    assert wide.loc['f2', '250.1'] == 'NA'
+    assert wide.loc['m1', '250.1'] == 'False'
+
+def test_long_matches_wide(translated):
+    long, wide = translated
+
+    # Listed entries agree with the wide table, and sex restricted codes a
+    # person does have are NA in the long output too
+    for _, curr_row in long.iterrows():
+        assert wide.loc[curr_row['id'], curr_row['phecode']] == curr_row['status']
+
+    assert long.loc[(long['id'] == 'f1') & (long['phecode'] == '600'), 'status'].tolist() == ['NA']
+
+def test_norm_icd_matches_notebook():
+    fix_icd10, fix_icd9 = nb_fixers()
+
+    icd10 = ['K509', 'K50', 'E119', 'C3490', 'N40']
+    icd9 = ['25000', '5551', '600', 'V5867', 'E8809', '250.00', 'E880.9', '55.1']
+
+    assert pte.norm_icd10(icd10).tolist() == [fix_icd10(x) for x in icd10]
+    assert pte.norm_icd9(icd9).tolist() == [fix_icd9(x) for x in icd9]
+
+    # Codes already in the period convention come back the same
+    assert pte.norm_icd10(['K50.9', 'C34.90', 'K50']).tolist() == ['K50.9', 'C34.90', 'K50']
+    assert pte.norm_icd9(['250.00', 'E880.9', '600']).tolist() == ['250.00', 'E880.9', '600']
+
+def test_translate_read_matches_notebook(tmp_path):
+    v2 = read_tab(READ2, ['read_code', 'icd10_code', 'phecode'])
+    v3 = read_tab(READ3, ['read_code', 'icd10_code', 'phecode'])
+    gp = read_tab(GP, ['eid', 'event_dt', 'read_2', 'read_3'])
+
+    v2.to_csv(f"{tmp_path}/read2.csv", index = False)
+    v3.to_csv(f"{tmp_path}/ctv3.csv", index = False)
+    read_maps = pte.load_read_maps(f"{tmp_path}/read2.csv", f"{tmp_path}/ctv3.csv")
+
+    sort_cols = ['eid', 'event_dt', 'fin_icd']
+    nb_gp = nb_read_merge(gp, v2, v3).sort_values(sort_cols).reset_index(drop = True)
+    py_gp = pte.translate_read(gp, read_maps).sort_values(sort_cols).reset_index(drop = True)
+
+    assert py_gp.values.tolist() == nb_gp.values.tolist()
+    assert sorted(py_gp['fin_icd']) == ['E11.9', 'K50', 'K50.9', 'K50.9']
+
+def test_ukb_gp_path_matches_notebook(tmp_path, monkeypatch):
+    write_ref_files(tmp_path, monkeypatch)
+    fix_icd10, fix_icd9 = nb_fixers()
+
+    vocab_fn = f"{tmp_path}/ukb_vocab.csv"
+    read_tab(UKB_VOCAB, ['vocabulary_id', 'code', 'phecode']).to_csv(vocab_fn, index = False)
+
+    v2 = read_tab(READ2, ['read_code', 'icd10_code', 'phecode'])
+    v3 = read_tab(READ3, ['read_code', 'icd10_code', 'phecode'])
+    v2.to_csv(f"{tmp_path}/read2.csv", index = False)
+    v3.to_csv(f"{tmp_path}/ctv3.csv", index = False)
+
+    gp = read_tab(GP, ['eid', 'event_dt', 'read_2', 'read_3'])
+    gp_fn = f"{tmp_path}/gp_clin.tsv"
+    gp.to_csv(gp_fn, sep = '\t', index = False)
+
+    diag_cols = ['eid', 'vocab', 'icd_code', 'diag_date']
+    raw = read_tab(UKB_DIAGS, diag_cols)
+    os.makedirs(f"{tmp_path}/raw")
+    raw_fn = f"{tmp_path}/raw/all_ukb_prepped_for_phecode.tsv"
+    raw.to_csv(raw_fn, sep = '\t', index = False)
+
+    # What the notebook would have written: fixed up codes plus clean_gp
+    nb = raw.copy()
+    nb['icd_code'] = [fix_icd10(x) if y == 'ICD10' else fix_icd9(x)
+                      for x, y in zip(nb['icd_code'], nb['vocab'])]
+    clean_gp = nb_read_merge(gp, v2, v3)
+    nb = pd.concat([nb, pd.DataFrame({'eid' : clean_gp['eid'], 'vocab' : 'ICD10',
+                                      'icd_code' : clean_gp['fin_icd'],
+                                      'diag_date' : clean_gp['event_dt']})], ignore_index = True)
+    os.makedirs(f"{tmp_path}/nb")
+    nb_fn = f"{tmp_path}/nb/all_ukb_prepped_for_phecode.tsv"
+    nb.to_csv(nb_fn, sep = '\t', index = False)
+
+    sex_fn = f"{tmp_path}/cov_dat.csv"
+    pd.DataFrame(UKB_SEX, columns = ['eid', 'sex']).to_csv(sex_fn, index = False)
+    sex = pte.load_sex('ukb', sex_fn)
+
+    maps = pte.load_maps(vocab_fn)
+    maps['read'] = pte.load_read_maps(f"{tmp_path}/read2.csv", f"{tmp_path}/ctv3.csv")
+    pte.init_worker(maps, sex)
+
+    pop_ids = sex.index.tolist()
+    pte.translate_file(raw_fn, 'ukb', f"{tmp_path}/raw", 2, True, pop_ids, gp_fn)
+    pte.translate_file(nb_fn, 'ukb', f"{tmp_path}/nb", 2, True, pop_ids)
+
+    read_out = lambda x, y : pd.read_csv(f"{tmp_path}/{x}/all_ukb_one_min_code_cnt_phecode_{y}.tsv",
+                                         sep = '\t', dtype = str, keep_default_na = False)
+
+    for curr_out in ['long', 'translation']:
+        assert read_out('raw', curr_out).equals(read_out('nb', curr_out))
+
+    wide = read_out('raw', 'translation').set_index('id')
+    assert wide.loc['1001', ['250.2', '555.1', '555']].tolist() == ['True', 'True', 'True']
+    assert wide.loc['1002', ['250', '600']].tolist() == ['True', 'True']
+    assert wide.loc['1003', ['555.1', '600']].tolist() == ['True', 'True']
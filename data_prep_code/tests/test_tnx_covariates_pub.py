@@ -0,0 +1,153 @@
+# Name:     test_tnx_covariates_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Checks tnx_covariates_pub.py against the covariate cells of
+#   tnx_icd_data_cleaning_pub.ipynb. The notebook cells are pulled straight out
+#   of the .ipynb and run on a small hand-built patient frame, so if either
+#   side changes the two have to agree again.
+#
+#   Usage:
+#       python -m pytest -q data_prep_code/tests
+#
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+DATA_PREP_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/.."
+sys.path.append(DATA_PREP_DIR)
+
+import tnx_covariates_pub as tc
+
+NB_FN = f"{DATA_PREP_DIR}/tnx_icd_data_cleaning_pub.ipynb"
+
+# Same column layout as TNX patient.csv (year_of_birth and month_year_death
+# are where calc_curr_age expects them). Covers no death date, deaths either
+# side of the June round up, death dates read in as floats, missing year of
+# birth and the race x ethnicity combinations that fall through to 'other'
+# or 'blank'.
+PATS = pd.DataFrame(
+    [['p00', 'F',       'White',                                     'Not Hispanic or Latino', 1950.0, np.nan],
+     ['p01', 'M',       'White',                                     'Unknown',                1950.0, 201705.0],
+     ['p02', 'M',       'Asian',                                     'Not Hispanic or Latino', 1950.0, 201706.0],
+     ['p03', 'F',       'Black or African American',                 'Unknown',                1999.0, 202012.0],
+     ['p04', 'Unknown', 'American Indian or Alaska Native',          'Not Hispanic or Latino', 2023.0, np.nan],
+     ['p05', 'F',       'Native Hawaiian or Other Pacific Islander', 'Unknown',                1980.0, 202001.0],
+     ['p06', 'M',       'Unknown',                                   'Unknown',                1975.0, np.nan],
+     ['p07', 'F',       'Unknown',                                   'Hispanic or Latino',     1975.0, np.nan],
+     ['p08', 'M',       'Asian',                                     'Hispanic or Latino',     np.nan, np.nan],
+     ['p09', 'F',       np.nan,                                      'Hispanic or Latino',     1960.0, np.nan],
+     ['p10', 'M',       np.nan,                                      np.nan,                   1960.0, np.nan],
+     ['p11', 'F',       'White',                                     np.nan,                   np.nan, 200006.0],
+     ['p12', 'M',       'Other',                                     'Not Hispanic or Latino', 1988.0, np.nan]],
+    columns = ['patient_id', 'sex', 'race', 'ethnicity', 'year_of_birth',
+               'month_year_death'])
+
+# Put marital_status and patient_regional_location back in so the year of
+# birth and death columns are at the same positions as in patient.csv
+PATS.insert(4, 'marital_status', 'Single')
+PATS.insert(6, 'patient_regional_location', 'West')
+
+# Text columns as object, like read_csv gives the notebook (newer pandas would
+# make them str, which the notebook's in place sex recode can't write ints to)
+TEXT_COLS = ['patient_id', 'sex', 'race', 'ethnicity', 'marital_status',
+             'patient_regional_location']
+PATS[TEXT_COLS] = PATS[TEXT_COLS].astype(object)
+
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Source of the first notebook code cell that contains marker
+def nb_cell(marker):
+    with open(NB_FN, 'r') as in_file:
+        nb = json.load(in_file)
+
+    for cell in nb['cells']:
+        src = ''.join(cell['source'])
+        if (cell['cell_type'] == 'code') and (marker in src):
+            return src
+
+    raise KeyError(f"No notebook cell with {marker!r}")
+
+# Run the notebook's sex, age and race/ethnicity cells on pats
+def run_notebook(pats):
+    ns = {'pd' : pd, 'pats' : pats.copy()}
+
+    exec(nb_cell("pats.loc[:, 'sex'] = pats.loc[:, 'sex'].replace"), ns)
+    exec(nb_cell("def calc_curr_age"), ns)
+
+    # The notebook does this with tqdm's progress_apply. calc_curr_age indexes
+    # the row by position (row[5]), so give it a positional index to make that
+    # work the same on every pandas version.
+    ns['pats']['age'] = ns['pats'].apply(
+        lambda row: ns['calc_curr_age'](row.reset_index(drop = True)), axis = 1)
+
+    exec(nb_cell("pats['s_age'] = pats['age']/10"), ns)
+    exec(nb_cell("pats['fin_race'] = 'blank'"), ns)
+    exec(nb_cell("pats['ethnic'] = pats.loc[:, 'fin_race'].replace"), ns)
+
+    return ns['pats']
+
+
+@pytest.fixture(scope = 'module')
+def nb_pats():
+    return run_notebook(PATS)
+
+@pytest.fixture(scope = 'module')
+def vec_pats():
+    return tc.derive_covs(PATS)
+
+
+@pytest.mark.parametrize('col', ['sex', 'age', 's_age', 'fin_race', 'ethnic'])
+def test_derive_covs_matches_notebook(nb_pats, vec_pats, col):
+    nb_vals = nb_pats[col].tolist()
+    vec_vals = vec_pats[col].tolist()
+
+    for curr_id, nb_val, vec_val in zip(PATS['patient_id'], nb_vals, vec_vals):
+        if pd.isnull(nb_val):
+            assert pd.isnull(vec_val), curr_id
+        else:
+            assert nb_val == vec_val, curr_id
+
+def test_age_edge_cases(vec_pats):
+    age = dict(zip(vec_pats['patient_id'], vec_pats['age']))
+
+    # Alive, no death date
+    assert age['p00'] == 2023 - 1950
+    # Died May, no round up
+    assert age['p01'] == 2017 - 1950
+    # Died June, rounds up to the next year
+    assert age['p02'] == 2018 - 1950
+    # Born the year the data was released
+    assert age['p04'] == 0
+    # No year of birth, dead or alive
+    assert np.isnan(age['p08'])
+    assert np.isnan(age['p11'])
+
+    assert vec_pats.loc[vec_pats['patient_id'] == 'p05', 's_age'].iloc[0] == 4.0
+    assert vec_pats.loc[vec_pats['patient_id'] == 'p06', 's_age'].iloc[0] == 4.8
+
+def test_race_edge_cases(vec_pats):
+    fin_race = dict(zip(vec_pats['patient_id'], vec_pats['fin_race']))
+
+    assert fin_race['p06'] == 'other'
+    assert fin_race['p07'] == 'hispanic'
+    assert fin_race['p08'] == 'hispanic'
+    assert fin_race['p09'] == 'hispanic'
+    assert fin_race['p10'] == 'blank'
+    assert fin_race['p11'] == 'blank'
+    assert fin_race['p12'] == 'blank'
+
+def test_check_equal(capsys):
+    assert tc.check_equal(PATS)
+    assert 'MISMATCH' not in capsys.readouterr().out
@@ -0,0 +1,203 @@
+# Name:     tnx_covariates_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Patient covariate derivation for TNX (sex, age and race/ethnicity) pulled
+#   out of tnx_icd_data_cleaning_pub.ipynb so it can be imported or run
+#   without the notebook. Age and race/ethnicity are done over whole columns
+#   (year arithmetic on numpy arrays, and a race x ethnicity lookup table)
+#   instead of the notebook's row-wise progress_apply and chain of .loc masks.
+#
+#   The notebook versions are kept here (calc_curr_age, code_fin_race_masks)
+#   and --check runs both on the patient file (or a sample of it) and fails
+#   if they disagree anywhere.
+#
+#   Usage:
+#       python tnx_covariates_pub.py --out pats_covs.tsv
+#       python tnx_covariates_pub.py --check 1000000
+#
+
+import argparse
+import sys
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = "/data/pathogen_ncd/trinetx"
+
+# TriNetX data was made available on Feb 13, 2023, see calc_curr_age.
+CURR_YEAR = 2023
+
+# Positions of the year of birth and month/year of death columns in
+# patient.csv (same positions the notebook's calc_curr_age uses)
+YOB_IDX = 5
+DEATH_IDX = 7
+
+# Encode like UKB (F = 0)
+SEX_CODES = {'F' : 0, 'M' : 1, 'Unknown' : 2}
+
+# UKB variable is called 'ethnic' so let's use that for final code
+ETHNIC_CODES = {'white'    : 0,
+                'asian'    : 1,
+                'black'    : 2,
+                'hispanic' : 3,
+                'ai_an'    : 4,
+                'nh_opi'   : 5,
+                'other'    : 6}
+
+# race -> fin_race for anyone that isn't Hispanic or Latino, if ethnicity is
+# unknown you are classified to race response.
+RACE_MAP = {'White'                                     : 'white',
+            'Asian'                                     : 'asian',
+            'Black or African American'                 : 'black',
+            'American Indian or Alaska Native'          : 'ai_an',
+            'Native Hawaiian or Other Pacific Islander' : 'nh_opi',
+            'Unknown'                                   : 'other'}
+
+NON_HISP = ['Not Hispanic or Latino', 'Unknown']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Notebook version of age: age at death (death year rounded up if died in
+# June or later) if dead, otherwise age in CURR_YEAR. Applied row-wise.
+def calc_curr_age(curr_pat_row):
+    curr_yob = curr_pat_row.iloc[YOB_IDX]
+    curr_death_str = curr_pat_row.iloc[DEATH_IDX]
+
+    is_dead = pd.notnull(curr_death_str)
+
+    if is_dead:
+        # Remove trailing decimal (got added at some point)
+        curr_death_str = str(int(curr_death_str))
+
+        curr_death = dt.strptime(str(curr_death_str), '%Y%m')
+
+        # Round to next year
+        if curr_death.month >= 6:
+            death_yr = curr_death.year + 1
+        else:
+            death_yr = curr_death.year
+
+        curr_age = death_yr - curr_yob
+
+    # Still alive
+    else:
+        curr_age = CURR_YEAR - curr_yob
+
+    return curr_age
+
+# Vectorized calc_curr_age over the year of birth and YYYYMM death columns.
+def calc_age(yob, death):
+    yob = pd.to_numeric(yob, errors = 'coerce').to_numpy(dtype = float)
+    death = pd.to_numeric(death, errors = 'coerce').to_numpy(dtype = float)
+
+    is_dead = ~np.isnan(death)
+
+    # YYYYMM -> year and month (trunc like int() does)
+    death_int = np.trunc(np.where(is_dead, death, 0)).astype(np.int64)
+    death_yr = (death_int // 100) + ((death_int % 100) >= 6)
+
+    return np.where(is_dead, death_yr - yob, CURR_YEAR - yob)
+
+# Notebook version of fin_race: one .loc mask per race, then Hispanic or
+# Latino overrides.
+def code_fin_race_masks(pats):
+    fin_race = pd.Series('blank', index = pats.index)
+
+    for curr_race, curr_code in RACE_MAP.items():
+        fin_race.loc[((pats['race'] == curr_race) &
+                      ((pats['ethnicity'] == 'Not Hispanic or Latino') |
+                       (pats['ethnicity'] == 'Unknown')))] = curr_code
+
+    fin_race.loc[pats['ethnicity'] == 'Hispanic or Latino'] = 'hispanic'
+
+    return fin_race
+
+# Vectorized fin_race: build the race x ethnicity lookup table once and index
+# into it with the category codes of each column.
+def code_fin_race(race, ethnicity):
+    race = pd.Categorical(race)
+    ethnicity = pd.Categorical(ethnicity)
+
+    # Extra last row/col for NA (code -1)
+    lut = np.full((len(race.categories) + 1, len(ethnicity.categories) + 1),
+                  'blank', dtype = object)
+
+    for i, curr_race in enumerate(race.categories):
+        for j, curr_eth in enumerate(ethnicity.categories):
+            if curr_eth == 'Hispanic or Latino':
+                lut[i, j] = 'hispanic'
+            elif (curr_eth in NON_HISP) and (curr_race in RACE_MAP):
+                lut[i, j] = RACE_MAP[curr_race]
+
+    for j, curr_eth in enumerate(ethnicity.categories):
+        if curr_eth == 'Hispanic or Latino':
+            lut[-1, j] = 'hispanic'
+
+    return lut[race.codes, ethnicity.codes]
+
+# Derive all of the covariates the notebook does ahead of imputation:
+# sex, age, s_age (age / 10), fin_race and ethnic.
+def derive_covs(pats):
+    pats = pats.copy()
+
+    pats['sex'] = pats['sex'].replace(SEX_CODES)
+    pats['age'] = calc_age(pats.iloc[:, YOB_IDX], pats.iloc[:, DEATH_IDX])
+    pats['s_age'] = pats['age'] / 10
+    pats['fin_race'] = code_fin_race(pats['race'], pats['ethnicity'])
+    pats['ethnic'] = pats['fin_race'].replace(ETHNIC_CODES)
+
+    return pats
+
+# Run the notebook implementations and the vectorized ones on the same
+# patients and report any disagreement. Returns True if they all match.
+def check_equal(pats):
+    ref_age = pats.apply(calc_curr_age, axis = 1).to_numpy(dtype = float)
+    vec_age = calc_age(pats.iloc[:, YOB_IDX], pats.iloc[:, DEATH_IDX])
+
+    age_ok = np.array_equal(ref_age, vec_age, equal_nan = True)
+    print(f"Age:      {'OK' if age_ok else 'MISMATCH'} "
+          f"({np.sum(~((ref_age == vec_age) | (np.isnan(ref_age) & np.isnan(vec_age))))} differ)")
+
+    ref_race = code_fin_race_masks(pats).to_numpy()
+    vec_race = code_fin_race(pats['race'], pats['ethnicity'])
+
+    race_ok = np.array_equal(ref_race, vec_race)
+    print(f"fin_race: {'OK' if race_ok else 'MISMATCH'} "
+          f"({np.sum(ref_race != vec_race)} differ)")
+
+    return age_ok and race_ok
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Derive TNX patient covariates')
+    parser.add_argument('--pats', default = f"{BASE_DIR}/patient.csv",
+                        help = 'TNX patient.csv')
+    parser.add_argument('--out', help = 'Where to write the derived covariates (tsv)')
+    parser.add_argument('--check', type = int, nargs = '?', const = 0, default = None,
+                        help = 'Compare against the notebook implementations on a '
+                               'random sample of this many patients (0 = all) and exit')
+    args = vars(parser.parse_args())
+
+    pats = pd.read_csv(args['pats'], sep = ",")
+
+    if args['check'] is not None:
+        if (args['check'] > 0) and (args['check'] < len(pats)):
+            pats = pats.sample(n = args['check'], random_state = 5)
+
+        print(f"Checking {len(pats):,} patients against notebook versions")
+        sys.exit(0 if check_equal(pats) else 1)
+
+    pats = derive_covs(pats)
+
+    if args['out'] is not None:
+        pats.to_csv(args['out'], sep = "\t", index = False)
+        print(f"Wrote {len(pats):,} patients to {args['out']}")
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,22 @@
 #   code in their EHR. It writes out a single TSV file per disease-LOINC pair as
 #   well as a summary document that collects information on all LOINC tests
 #   examined for this ICD code.
+#
+#   With --with-covs each pair file also gets the patients' covariates (sex,
+#   ethnic and age) joined on, compactly encoded as integer codes (age as
+#   int16, age * 10 so the R side just divides by 10, NA for missing). These
+#   come from a patient dimension table of numpy arrays built once from
+#   procd_covs.tsv and memory-mapped by every run, so the R analysis (run with
+#   --prejoined) no longer has to read and join the 12M row covariate file for
+#   every ICD code.
+#
+#   With --profile every step of the per-LOINC loop is timed (see
+#   pair_profiler_pub.py): the summary TSV gets per-stage seconds, row counts
+#   after each filter and peak memory for each lab file as extra columns, and
+#   the job totals per stage go to {icd}_profile.json next to it.
+#
+#   If PATHOGEN_NCD_LEDGER is set the run (inputs, timings, rows in and out)
+#   is recorded in the pipeline run ledger (pipeline_code/run_ledger_pub.py).
 
 # Import required libraries
 import csv
@@ -21,23 +37,107 @@ import argparse
 import os
 import sys
 
+from pair_profiler_pub import StageProfiler
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../pipeline_code")
+from run_ledger_pub import start_run
+
 import warnings
 warnings.simplefilter(action ='ignore', category=FutureWarning)
 
 # Get ICD code to work on from the command line from command line
 parser = argparse.ArgumentParser(description = 'Script to generate TriNetX cohorts for dis-org pairs')
 parser.add_argument('-i','--icd', help='Single ICD10 code to find pairs for', required = True)
+parser.add_argument('--with-covs', action = 'store_true',
+                    help='Join compactly encoded covariates onto each pair file')
+parser.add_argument('--profile', action = 'store_true',
+                    help='Time each stage and add the timings to the summary file')
 args = vars(parser.parse_args())
 
 curr_icd = args['icd']
+WITH_COVS = args['with_covs']
+PROFILE = args['profile']
+prof = StageProfiler(enabled = PROFILE)
 print(f"Starting work on {curr_icd}")
 
 # Setup the environment
-BASE_DIR = "/data/pathogen_ncd/trinetx"
+# PATHOGEN_NCD_HOME swaps in another copy of the data (e.g. synthetic)
+HOME_DIR = os.environ.get('PATHOGEN_NCD_HOME', "/data/pathogen_ncd")
+BASE_DIR = f"{HOME_DIR}/trinetx"
 meta_dir = BASE_DIR
 icd_dir = f"{BASE_DIR}/icd_data"
 lab_dir = f"{BASE_DIR}/lab_data"
 pair_dir = f"{BASE_DIR}/pair_data/{curr_icd}"
+cov_fn = f"{BASE_DIR}/procd_data/procd_covs.tsv"
+pat_dim_dir = f"{BASE_DIR}/procd_data/pat_dim"
+
+# Columns (and numpy dtypes) of the patient dimension table
+PAT_DIM_COLS = {'sex' : np.int8, 'ethnic' : np.int8, 'age_x10' : np.int16}
+PAT_DIM_NA = -1
+
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+# Build the patient dimension table: procd_covs.tsv sorted by patient id and 
+# stored as one .npy per column so runs can memory-map it. Rebuilt whenever
+# procd_covs.tsv is newer than the table.
+def build_pat_dim(cov_fn, out_dir):
+    id_fn = f"{out_dir}/patient_id.npy"
+
+    if (os.path.exists(id_fn) and 
+        (os.path.getmtime(id_fn) >= os.path.getmtime(cov_fn))):
+        return
+
+    print(f"Building patient dimension table in {out_dir}")
+    os.makedirs(out_dir, exist_ok = True)
+
+    covs = pd.read_csv(cov_fn, sep = '\t', usecols = ['patient_id', 'sex', 
+                                                     'ethnic', 'age'],
+                       dtype = {'patient_id' : str})
+    covs = covs.sort_values('patient_id')
+
+    # Age is already scaled (/10) in procd_covs, store it as int16 * 10
+    covs['age_x10'] = (covs['age'] * 10).round()
+
+    # Write to temp names and rename into place so a parallel run never
+    # memory-maps a half written table
+    pid = os.getpid()
+    cols = {'patient_id' : covs['patient_id'].to_numpy(dtype = 'S')}
+    for curr_col, curr_type in PAT_DIM_COLS.items():
+        cols[curr_col] = covs[curr_col].fillna(PAT_DIM_NA).to_numpy(dtype = curr_type)
+
+    for curr_col, curr_arr in cols.items():
+        np.save(f"{out_dir}/{curr_col}.{pid}.tmp.npy", curr_arr)
+
+    # patient_id goes last as it marks the table as done
+    for curr_col in list(PAT_DIM_COLS.keys()) + ['patient_id']:
+        os.replace(f"{out_dir}/{curr_col}.{pid}.tmp.npy", 
+                   f"{out_dir}/{curr_col}.npy")
+
+# Memory-map the patient dimension table.
+def load_pat_dim(out_dir):
+    return({curr_col : np.load(f"{out_dir}/{curr_col}.npy", mmap_mode = 'r') 
+            for curr_col in ['patient_id'] + list(PAT_DIM_COLS.keys())})
+
+# Look up the covariates for each patient in pat_ids, returning a df of nullable
+# integer columns (NA for patients not in the table or missing a value).
+def join_pat_dim(pat_dim, pat_ids):
+    dim_ids = pat_dim['patient_id']
+    qry = np.asarray(pat_ids, dtype = 'S')
+
+    idx = np.searchsorted(dim_ids, qry)
+    idx[idx == len(dim_ids)] = 0
+    found = dim_ids[idx] == qry
+
+    res = {}
+    for curr_col in PAT_DIM_COLS:
+        vals = np.asarray(pat_dim[curr_col][idx])
+        res[curr_col] = pd.Series(vals, dtype = 'Int16').mask(~found | (vals == PAT_DIM_NA))
+
+    return(pd.DataFrame(res))
 
 # Only consider labs we have more than 0 results for after our pre-processing steps
 loincs = pd.read_csv(f"{meta_dir}/loincs_with_more_than_0_res_new_version.txt", sep = "\t")
@@ -71,7 +171,8 @@ lab_cols = ['pat_id', 'enc_id', 'code_system', 'code',
             'derived_by_TriNetX', 'source_id']
 
 # Read in the labs data we need.
-fin_labs = pd.read_excel(f"{BASE_DIR}/lab_test_data_analysis_latest_manual_review.xlsx")
+with prof.stage('read_meta'):
+    fin_labs = pd.read_excel(f"{BASE_DIR}/lab_test_data_analysis_latest_manual_review.xlsx")
 fin_labs = fin_labs.loc[fin_labs['good'] == 'y', :]
 
 # Read in the labs data we need.
@@ -93,10 +194,18 @@ print(f"Loading files...")
 # Assemble the path for the user-provided ICD code's diagnoses file.
 curr_fn = f"{icd_dir}/{curr_icd}_only.csv"
 
+run = start_run('tnx_icd_gen_pairs', key = curr_icd, params = args,
+                inputs = [curr_fn, lab_dir] + ([cov_fn] if WITH_COVS else []))
+
 # Read in the diagnoses
-curr_dat = pd.read_csv(curr_fn, names=diag_cols, dtype=dtype_dict)
-curr_dat.loc[:, 'date'] = pd.to_datetime(curr_dat.loc[:, 'date'], format="%Y%m%d")
+with prof.stage('read_diags'):
+    curr_dat = pd.read_csv(curr_fn, names=diag_cols, dtype=dtype_dict)
+with prof.stage('diag_to_datetime'):
+    curr_dat.loc[:, 'date'] = pd.to_datetime(curr_dat.loc[:, 'date'], format="%Y%m%d")
 curr_dat = curr_dat.loc[curr_dat['source_id'] == 'EHR', :]
+prof.rows('diags_ehr', len(curr_dat))
+run.rows_in = len(curr_dat)
+run.rows_out = 0
 
 # If we have no disease data for ICD10 code write error message out to file and 
 # exit
@@ -135,10 +244,12 @@ if sum(curr_dat.loc[:, 'icd_3_char'].str.contains(',')) > 0:
 
 
 # Sorts oldest diagnosis at top so we can just drop dupes at that point
-curr_dat = curr_dat.sort_values(['pat_id', 'icd_3_char', 'date'], ascending = [True, True, True])
+with prof.stage('diag_sort_dedupe'):
+    curr_dat = curr_dat.sort_values(['pat_id', 'icd_3_char', 'date'], ascending = [True, True, True])
 
-# For now we just care about the 3-char diagnosis.
-de_dupe = curr_dat.drop_duplicates(['pat_id', 'icd_3_char'], keep='first')
+    # For now we just care about the 3-char diagnosis.
+    de_dupe = curr_dat.drop_duplicates(['pat_id', 'icd_3_char'], keep='first')
+prof.rows('diag_pats', len(de_dupe))
 de_dupe = de_dupe.drop('enc_id', axis=1)
 
 curr_dis = de_dupe.copy(deep=True)
@@ -151,6 +262,11 @@ curr_dis = curr_dis.rename(columns={'vocab': 'diag_vocab',
                                     'source_id': 'diag_source_id'
                                     })
 
+# Memory-map the patient covariates if we are joining them onto the pairs
+if WITH_COVS:
+    build_pat_dim(cov_fn, pat_dim_dir)
+    pat_dim = load_pat_dim(pat_dim_dir)
+
 # Update the user on the status
 print(f"Starting to look for pairs, summary data is in\n\t{summary_fn}")
 
@@ -159,7 +275,12 @@ pbar = tqdm(loinc_ls, total=len(loinc_ls))
 for curr_loinc in pbar:
 
     # Could be multiple files for this LOINC code so process them both
-    for curr_lab_fn in glob.glob(f"{lab_dir}/{curr_loinc}*"):
+    prof.end_item()
+    with prof.stage('glob'):
+        lab_fn_ls = glob.glob(f"{lab_dir}/{curr_loinc}*")
+
+    for curr_lab_fn in lab_fn_ls:
+        prof.new_item()
         src_org = fin_labs.loc[fin_labs['loinc'] == curr_loinc, 'src'].to_list()[0]
         pbar.set_description(f"{curr_icd} | {curr_loinc} | {src_org}")
 
@@ -170,8 +291,11 @@ for curr_loinc in pbar:
         else:
             suffix = 'single_thread'
 
-        curr_lab = pd.read_csv(curr_lab_fn, names=lab_cols, index_col=False,
-                               quoting=csv.QUOTE_NONE)
+        with prof.stage('read_csv'):
+            curr_lab = pd.read_csv(curr_lab_fn, names=lab_cols, index_col=False,
+                                   quoting=csv.QUOTE_NONE)
+        prof.rows('lab_read', len(curr_lab))
+        run.rows_in += len(curr_lab)
 
         # If we have no lab tests for that LOINC code, write results out and 
         # move on
@@ -198,9 +322,11 @@ for curr_loinc in pbar:
 
             continue
 
-        curr_lab = curr_lab.applymap(lambda x: str(x).lstrip('"').rstrip('"'))
+        with prof.stage('applymap'):
+            curr_lab = curr_lab.applymap(lambda x: str(x).lstrip('"').rstrip('"'))
 
-        curr_lab.loc[:, 'lab_date'] = pd.to_datetime(curr_lab.loc[:, 'lab_date'], format="%Y%m%d")
+        with prof.stage('to_datetime'):
+            curr_lab.loc[:, 'lab_date'] = pd.to_datetime(curr_lab.loc[:, 'lab_date'], format="%Y%m%d")
 
         # Rename some cols to prep for merging with diags
         curr_lab = curr_lab.rename(columns={'code': 'lab_code',
@@ -212,22 +338,28 @@ for curr_loinc in pbar:
         # Grep commands to pull each LOINC weren't perfect, so when pulling
         # 587-6 it also picked up 26587-6 and 42587-6. So here filter all
         # the wrong ones out.
-        curr_lab = curr_lab.loc[curr_lab['lab_code'] == curr_loinc, :]
+        with prof.stage('filter'):
+            curr_lab = curr_lab.loc[curr_lab['lab_code'] == curr_loinc, :]
+        prof.rows('lab_code', len(curr_lab))
 
         # Apply some filters to the data
         is_cat = fin_labs.loc[fin_labs['loinc'] == curr_loinc, 'final_type'].iloc[0] == 'cat'
 
         # For cat limit to Positive and Negative (drop Unknown and other odd 
         # responses)
-        curr_lab = curr_lab.loc[((curr_lab['lab_result_text'] == 'Negative') |
-                                 (curr_lab['lab_result_text'] == 'Positive')), :]
+        with prof.stage('filter'):
+            curr_lab = curr_lab.loc[((curr_lab['lab_result_text'] == 'Negative') |
+                                     (curr_lab['lab_result_text'] == 'Positive')), :]
+        prof.rows('lab_pos_neg', len(curr_lab))
 
 
         # Merge in diagnosis information for each lab test
         # Mix where 'diag_date' (diagnosis date) is NA are controls!
         # Mix where 'lab_date' is before 'diag_date' is useful case
         # Mix where no 'lab_date' before 'diag_date' not useful
-        mix = curr_lab.merge(curr_dis, on='pat_id', how='left')
+        with prof.stage('merge'):
+            mix = curr_lab.merge(curr_dis, on='pat_id', how='left')
+        prof.rows('mix', len(mix))
 
         # Don't process further if we don't have anybody with a diagnosis and 
         # this lab test
@@ -258,36 +390,39 @@ for curr_loinc in pbar:
 
         # Keep processing we still have people with a diagnosis and this lab 
         # test
-        mix = mix.sort_values('pat_id')
+        with prof.stage('sort_dedupe'):
+            mix = mix.sort_values('pat_id')
 
-        # People with no diagnosis - controls
-        cons = mix.loc[mix['diag_date'].isna(), :]
+            # People with no diagnosis - controls
+            cons = mix.loc[mix['diag_date'].isna(), :]
 
-        # Take the latest test result
-        cons = cons.sort_values(['pat_id', 'lab_date'],
-                                ascending=[False, False]).drop_duplicates(['pat_id'])
+            # Take the latest test result
+            cons = cons.sort_values(['pat_id', 'lab_date'],
+                                    ascending=[False, False]).drop_duplicates(['pat_id'])
 
-        # Grab the cases (the ones that have a valid 'date' which is the diag date)
-        cases = mix.loc[~mix['diag_date'].isna(), :]
+            # Grab the cases (the ones that have a valid 'date' which is the diag date)
+            cases = mix.loc[~mix['diag_date'].isna(), :]
 
-        # List of all people with a diagnosis!
-        all_case_ls = cases['pat_id'].unique().tolist()
+            # List of all people with a diagnosis!
+            all_case_ls = cases['pat_id'].unique().tolist()
 
-        # Only grab cases that have a lab test encounter before diagnosis date
-        # And only keep those lab test encounters earlier than diagnosis date
-        cases = cases.loc[cases['lab_date'] < cases['diag_date'], :]
+            # Only grab cases that have a lab test encounter before diagnosis date
+            # And only keep those lab test encounters earlier than diagnosis date
+            cases = cases.loc[cases['lab_date'] < cases['diag_date'], :]
 
-        # List of people with test result before diagnosis
-        good_case_ls = cases['pat_id'].unique().tolist()
+            # List of people with test result before diagnosis
+            good_case_ls = cases['pat_id'].unique().tolist()
 
-        # People that don't have a test result before diag
-        bad_case_ls = list(set(all_case_ls).difference(set(good_case_ls)))
+            # People that don't have a test result before diag
+            bad_case_ls = list(set(all_case_ls).difference(set(good_case_ls)))
 
-        # Sort within each patient so the latest test (closest to diag) is at top
-        cases = cases.sort_values(['pat_id', 'lab_date'], ascending=[False, False])
+            # Sort within each patient so the latest test (closest to diag) is at top
+            cases = cases.sort_values(['pat_id', 'lab_date'], ascending=[False, False])
 
-        # Now drop all dupes leaving only the latest test result before the diag
-        cases = cases.drop_duplicates(['pat_id'], keep='first')
+            # Now drop all dupes leaving only the latest test result before the diag
+            cases = cases.drop_duplicates(['pat_id'], keep='first')
+        prof.rows('cases', len(cases))
+        prof.rows('cons', len(cons))
 
         cons['use'] = True
         cons['is_case'] = False
@@ -309,6 +444,7 @@ for curr_loinc in pbar:
 
         # Bring cases and controls back together
         fin_mix = pd.concat([cases, cons])
+        prof.rows('fin', len(fin_mix))
 
         # If we went through that processing and have no results, write out warning message and move on
         if len(fin_mix) == 0:
@@ -357,9 +493,18 @@ for curr_loinc in pbar:
                             case_n, con_n, test_type_dict,  n_cat_with_value, 
                             curr_val_con])
 
+        # Join on the covariates (sex, ethnic, age_x10) if requested
+        if WITH_COVS:
+            with prof.stage('join_covs'):
+                fin_mix = fin_mix.reset_index(drop = True)
+                fin_mix = pd.concat([fin_mix, join_pat_dim(pat_dim, fin_mix['pat_id'])], 
+                                    axis = 1)
+
         # Save the pair data out to file for later analysis
         out_fn = f"{pair_dir}/{curr_icd}_{src_org}_{curr_loinc}_{suffix}.tsv"
-        fin_mix.to_csv(out_fn, index=False, sep="\t")
+        with prof.stage('to_csv'):
+            fin_mix.to_csv(out_fn, index=False, sep="\t")
+        run.rows_out += len(fin_mix)
 
 # Collect the summary data for all LOINC tests and write out to a file
 new_meas = pd.DataFrame(meas_sum_ls)
@@ -367,4 +512,14 @@ new_meas = pd.DataFrame(meas_sum_ls)
 new_meas.columns = ['dis', 'loinc_test', 'lab_suffix', 'org', 'nrow', 'uniq_pats', 'n_to_use', 'n_to_skip',
                     'case_n', 'con_n', 'test_type',
                     'cat_n_values', 'cat_values']
+
+# One row of stage timings, row counts and peak memory per lab file
+if PROFILE:
+    new_meas = pd.concat([new_meas, prof.item_df()], axis = 1)
+
 new_meas.to_csv(summary_fn, sep='\t', index = False)
+
+prof.dump(f"{pair_dir}/{curr_icd}_profile.json",
+          {'icd' : curr_icd, 'n_loincs' : len(loinc_ls), 'with_covs' : WITH_COVS})
+
+run.finish(outputs = [pair_dir])
@@ -0,0 +1,206 @@
+# Name:     tnx_loinc_count_scan_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Counts results per LOINC code across all of the per-LOINC lab files
+#   (lab_data/{loinc}_only_single_thread.csv) made by break_labs_new.sh in
+#   tnx_icd_data_cleaning_pub.ipynb, and writes new versions of the two files
+#   the pair generators read to --out_dir:
+#       clean_loinc_counts.tsv
+#       loincs_with_more_than_0_res_new_version.txt
+#   The curated clean_loinc_counts.tsv in the TNX dir is only ever read (as
+#   --meta), never written over.
+#
+#   Files are scanned in a process pool, each one streamed in chunks, so no
+#   lab file is ever fully in memory. Per-file results are cached in
+#   loinc_scan_cache.tsv keyed by the file's size and mtime, so after a partial
+#   refresh of lab_data only the files that changed are rescanned.
+#
+#   count in clean_loinc_counts.tsv is the number of unique patients with a
+#   result for that LOINC (what REQ_LAB_NUM is checked against). Any other
+#   columns in --meta (SCALE_TYP, unit, ...) are carried over, and LOINCs that
+#   are only in --meta (no lab file) are kept with counts of 0.
+#
+#   Usage:
+#       python tnx_loinc_count_scan_pub.py --workers 16 --out_dir /data/pathogen_ncd/trinetx/loinc_scan
+#
+
+import argparse
+import csv
+import glob
+import multiprocessing as mp
+import os
+
+import pandas as pd
+from tqdm import tqdm
+
+BASE_DIR = "/data/pathogen_ncd/trinetx"
+meta_dir = BASE_DIR
+lab_dir = f"{BASE_DIR}/lab_data"
+
+COUNTS_FN = f"{meta_dir}/clean_loinc_counts.tsv"
+CACHE_FN = f"{meta_dir}/loinc_scan_cache.tsv"
+OUT_DIR = f"{meta_dir}/loinc_scan"
+
+# Output file names (in --out_dir)
+COUNTS_OUT = "clean_loinc_counts.tsv"
+WITH_N_OUT = "loincs_with_more_than_0_res_new_version.txt"
+
+# Minimum number of patients with results to analyze a lab
+REQ_LAB_NUM = 20
+
+LAB_COLS = ['pat_id', 'enc_id', 'LOINC', 'code', 'date', 'num_value',
+            'text_value', 'units', 'Tri_deriv', 'src_id']
+
+CHUNK_SIZE = 2_000_000
+
+# Columns we fill in for each file
+SCAN_COLS = ['lab_fn', 'size', 'mtime_ns', 'loinc', 'count', 'nrow',
+             'n_num', 'n_text']
+
+# Per LOINC totals
+COUNT_COLS = ['count', 'nrow', 'n_num', 'n_text']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Stream one lab file and count its results for the LOINC in its file name:
+# rows, unique patients, rows with a numeric and with a text value.
+def scan_file(lab_fn):
+    st = os.stat(lab_fn)
+    fn_loinc = os.path.basename(lab_fn).split('_')[0]
+
+    pats = set()
+    nrow = 0
+    n_num = 0
+    n_text = 0
+
+    for chunk in pd.read_csv(lab_fn, sep = ',', names = LAB_COLS, dtype = str,
+                             index_col = False, quoting = csv.QUOTE_NONE,
+                             chunksize = CHUNK_SIZE):
+        # The files are quoted but read without quoting, strip them off
+        for curr_col in ['pat_id', 'code', 'num_value', 'text_value']:
+            chunk[curr_col] = chunk[curr_col].str.strip('"')
+
+        chunk = chunk.loc[chunk['code'] == fn_loinc, :]
+
+        nrow += len(chunk)
+        pats.update(chunk['pat_id'].unique())
+        n_num += ((chunk['num_value'].notnull()) & (chunk['num_value'] != '')).sum()
+        n_text += ((chunk['text_value'].notnull()) & (chunk['text_value'] != '')).sum()
+
+    return {'lab_fn' : os.path.basename(lab_fn), 'size' : st.st_size,
+            'mtime_ns' : st.st_mtime_ns, 'loinc' : fn_loinc,
+            'count' : len(pats), 'nrow' : nrow, 'n_num' : int(n_num),
+            'n_text' : int(n_text)}
+
+# Previous scan results, or an empty table if we don't have any yet
+def load_cache(cache_fn):
+    if not os.path.exists(cache_fn):
+        return pd.DataFrame(columns = SCAN_COLS)
+
+    return pd.read_csv(cache_fn, sep = '\t', dtype = {'lab_fn' : str, 'loinc' : str})
+
+# Lab files that are new or changed since they were cached.
+def get_stale(lab_files, cache):
+    cached = {row.lab_fn : (row.size, row.mtime_ns) for row in cache.itertuples()}
+
+    stale = []
+    for curr_fn in lab_files:
+        st = os.stat(curr_fn)
+        if cached.get(os.path.basename(curr_fn)) != (st.st_size, st.st_mtime_ns):
+            stale.append(curr_fn)
+
+    return stale
+
+# Scan anything stale and return the up to date per-file table (files no
+# longer in lab_data are dropped).
+def scan_labs(lab_files, cache_fn = CACHE_FN, workers = 1):
+    cache = load_cache(cache_fn)
+    stale = get_stale(lab_files, cache)
+
+    print(f"{len(lab_files):,} lab files, {len(stale):,} new or changed")
+
+    res_ls = []
+    if workers > 1:
+        with mp.Pool(workers) as pool:
+            for curr_res in tqdm(pool.imap_unordered(scan_file, stale), total = len(stale)):
+                res_ls.append(curr_res)
+    else:
+        for curr_fn in tqdm(stale):
+            res_ls.append(scan_file(curr_fn))
+
+    keep = set(os.path.basename(x) for x in lab_files)
+    rescanned = set(x['lab_fn'] for x in res_ls)
+
+    scan = cache.loc[cache['lab_fn'].isin(keep) & ~cache['lab_fn'].isin(rescanned), :]
+    scan = pd.concat([scan, pd.DataFrame(res_ls, columns = SCAN_COLS)], ignore_index = True)
+    scan = scan.sort_values('lab_fn').reset_index(drop = True)
+    scan = scan.astype({curr_col : 'int64' for curr_col in SCAN_COLS
+                        if curr_col not in ['lab_fn', 'loinc']})
+
+    tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+    scan.to_csv(tmp_fn, sep = '\t', index = False)
+    os.replace(tmp_fn, cache_fn)
+
+    return scan
+
+# Per LOINC counts, with the other columns of meta_fn carried over. LOINCs
+# only in meta_fn (no lab file) are kept with counts of 0.
+def build_counts(scan, meta_fn = COUNTS_FN):
+    counts = scan.groupby('loinc', as_index = False).agg({x : 'sum' for x in COUNT_COLS})
+
+    if (meta_fn is not None) and os.path.exists(meta_fn):
+        meta = pd.read_csv(meta_fn, sep = '\t', dtype = {'loinc' : str})
+        meta = meta.loc[:, [x for x in meta.columns
+                            if (x == 'loinc') or (x not in COUNT_COLS + ['meets_req'])]]
+        counts = counts.merge(meta.drop_duplicates('loinc'), on = 'loinc', how = 'outer')
+        counts[COUNT_COLS] = counts[COUNT_COLS].fillna(0).astype('int64')
+
+    counts.insert(len(COUNT_COLS) + 1, 'meets_req', counts['count'] >= REQ_LAB_NUM)
+
+    return counts.sort_values('loinc').reset_index(drop = True)
+
+# Write a table to fn through a temp file, so a failed run never leaves a half
+# written file behind.
+def write_tsv(df, fn):
+    tmp_fn = f"{fn}.{os.getpid()}.tmp"
+    df.to_csv(tmp_fn, sep = '\t', index = False)
+    os.replace(tmp_fn, fn)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Count TNX lab results per LOINC code')
+    parser.add_argument('--lab_dir', default = lab_dir, help = 'Directory of per-LOINC lab files')
+    parser.add_argument('--meta', default = COUNTS_FN,
+                        help = 'Curated clean_loinc_counts.tsv to carry LOINC info over from (read only)')
+    parser.add_argument('--out_dir', default = OUT_DIR,
+                        help = f'Where to write {COUNTS_OUT} and {WITH_N_OUT}')
+    parser.add_argument('--workers', type = int, default = 1, help = 'Files to scan at once')
+    parser.add_argument('--cache', default = CACHE_FN, help = 'Per-file scan cache')
+    args = vars(parser.parse_args())
+
+    counts_fn = f"{args['out_dir']}/{COUNTS_OUT}"
+    with_n_fn = f"{args['out_dir']}/{WITH_N_OUT}"
+
+    if (args['meta'] is not None) and (os.path.realpath(args['meta']) == os.path.realpath(counts_fn)):
+        parser.error(f"--out_dir would write over --meta ({args['meta']}), pick another --out_dir")
+
+    lab_files = sorted(glob.glob(f"{args['lab_dir']}/*.csv"))
+
+    scan = scan_labs(lab_files, args['cache'], args['workers'])
+    counts = build_counts(scan, args['meta'])
+
+    os.makedirs(args['out_dir'], exist_ok = True)
+    write_tsv(counts, counts_fn)
+    write_tsv(counts.loc[counts['count'] > 0, ['loinc']], with_n_fn)
+
+    print(f"{len(counts):,} LOINCs, {(counts['count'] > 0).sum():,} with results, "
+          f"{counts['meets_req'].sum():,} with at least {REQ_LAB_NUM} patients")
+    print(f"Wrote {counts_fn} and {with_n_fn}")
+
+if __name__ == '__main__':
+    main()
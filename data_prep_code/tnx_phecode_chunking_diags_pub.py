@@ -8,6 +8,9 @@
 #   since I couldn't think of anywhere else to put it. After that is a 
 #   parallel python script that chunks the diagnosis data into chunks small
 #   enough to be processed by the PheWAS library's functions, ~ 2.5 GB.
+#
+#   The run is recorded in the pipeline run ledger if PATHOGEN_NCD_LEDGER is
+#   set (pipeline_code/run_ledger_pub.py).
 
 
 
@@ -46,6 +49,10 @@ from tqdm import tqdm
 import csv
 from datetime import datetime
 import pytz
+import sys
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../pipeline_code")
+from run_ledger_pub import start_run
 
 # Simple function to get a datetime stamp for logging 
 def dt():
@@ -65,14 +72,14 @@ def process_patient_ids(df, patient_ids, chunk_lim, output_dir, proc_num,
 	patient_data = df[df['pat_id'].isin(patient_ids)]
 	
   # Create a Pandas groupby object that we will loop over using the patient ID
-  grouped = patient_data.groupby('pat_id')
+	grouped = patient_data.groupby('pat_id')
 	
 	# Keeping track of all diagnoses collected for this patient chunk
-  curr_chunk = []
+	curr_chunk = []
 	
   # Monitor the current size of the chunk file to know when we should write out
   # to file and start saving diagnoses for the next chunk  
-  curr_size = 0
+	curr_size = 0
 
   # Essentially a file counter so we incremenent after writing out a file, so 
 	# we have a new filename for the next chunk.
@@ -95,7 +102,7 @@ def process_patient_ids(df, patient_ids, chunk_lim, output_dir, proc_num,
 															 f'chunk_{proc_num}_{file_index}.csv')
 
 				# Output all of the collected diagnoses in curr_chunk out to a CSV
-        pd.concat(curr_chunk).to_csv(output_file, index = False, header = False, 
+				pd.concat(curr_chunk).to_csv(output_file, index = False, header = False, 
 																		 quoting = csv.QUOTE_ALL)
 				
         # Calculate filesize of file we just saved and log that.
@@ -125,7 +132,7 @@ def process_patient_ids(df, patient_ids, chunk_lim, output_dir, proc_num,
 															f'chunk_{proc_num}_{file_index}.csv')
 			
       # And write it out just like we did all the other chunks.
-      pd.concat(curr_chunk).to_csv(output_file, index = False, header = False, 
+			pd.concat(curr_chunk).to_csv(output_file, index = False, header = False, 
 																	 quoting = csv.QUOTE_ALL)
 			
       # Again calculate the filesize and log it out
@@ -166,7 +173,8 @@ def listener_func(queue, log_file):
 
 if __name__ == '__main__':
 
-	BASE_DIR = '/data/pathogen_ncd'
+	# Override with PATHOGEN_NCD_HOME to run on another copy of the data
+	BASE_DIR = os.environ.get('PATHOGEN_NCD_HOME', '/data/pathogen_ncd')
 
 	# The big diagnosis file (144 GB)
 	DIAG_FN = f'{BASE_DIR}/phecode/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv'
@@ -178,6 +186,9 @@ if __name__ == '__main__':
 	# ~ number of encounters for 2.5 GB file
 	n_enc_chunk_lim = 48000000  
 
+	run = start_run('tnx_phecode_chunking_diags', inputs = [DIAG_FN],
+									params = {'n_enc_chunk_lim' : n_enc_chunk_lim})
+
 	# Setup logging process and kick it off
 	log_queue = mp.Queue()
 	listener = mp.Process(target = listener_func, args=(log_queue, LOG_FILE))
@@ -194,11 +205,12 @@ if __name__ == '__main__':
 	diags = pd.read_csv(DIAG_FN, names = ['pat_id', 'vocab', 'code', 'date'],
 					   					engine = 'pyarrow', dtype = types)
 	
-  log_queue.put('CSV file loaded into memory.')
+	log_queue.put('CSV file loaded into memory.')
+	run.rows_in = len(diags)
 
 	# Put all the patient IDs in a list then generate patient ID chunks based on
 	# how many cores we have access to.
-    pat_id_ls = diags['pat_id'].unique().tolist()
+	pat_id_ls = diags['pat_id'].unique().tolist()
 	num_cores = 55  
 	pat_id_chunks = [pat_id_ls[i::num_cores] for i in range(num_cores)]
 
@@ -224,3 +236,5 @@ if __name__ == '__main__':
 	log_queue.put('All processes completed.')
 	log_queue.put(None)
 	listener.join()
+
+	run.finish(rows_out = len(diags), outputs = [OUTPUT_DIR])
@@ -7,6 +7,14 @@
 #   to test it with. It will use submitArrayJobs 
 # (https://github.com/ernstki/submitArrayJobs) which will handle running this 
 # code for each individual Phecode.
+#
+#   --profile times each step of the per-LOINC loop (pair_profiler_pub.py),
+#   adding per-stage seconds, row counts after each filter and peak memory
+#   per lab file to the summary TSV, and writes the job's per-stage totals to
+#   summaries/phe_{mcc}_{phecode}_profile.json.
+#
+#   With PATHOGEN_NCD_LEDGER set each run is also recorded in the pipeline
+#   run ledger (pipeline_code/run_ledger_pub.py).
 #         
 
 import csv
@@ -21,6 +29,11 @@ from datetime import datetime
 import pytz
 from pytz import timezone 
 
+from pair_profiler_pub import StageProfiler
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../pipeline_code")
+from run_ledger_pub import start_run
+
 import warnings
 warnings.simplefilter(action ='ignore', category=FutureWarning)
 
@@ -53,15 +66,19 @@ def main():
 	# Get Phecode
 	parser = argparse.ArgumentParser(description = 'Script to generate TriNetX cohorts for phecode-org pairs')
 	parser.add_argument('-p','--phe', help='Single Phecode code to find pairs for', required = True)
+	parser.add_argument('--profile', action = 'store_true',
+											help='Time each stage and add the timings to the summary file')
 	args = vars(parser.parse_args())
 
 	curr_phe = args['phe']
+	prof = StageProfiler(enabled = args['profile'])
 	curr_mcc_str = "mcc1"
 
 
 	print(f"Starting work on {curr_mcc_str}: {curr_phe}")
 
-	BASE_DIR = "/data/pathogen_ncd"
+	# Base dir can be overridden, e.g. synthetic data for benchmarking
+	BASE_DIR = os.environ.get('PATHOGEN_NCD_HOME', "/data/pathogen_ncd")
 
 	# Setup our environment
 	TNX_FN = "trinetx"
@@ -88,6 +105,7 @@ def main():
 
 	SUMMARY_FN = f"summaries/phe_{curr_mcc_str}_{curr_phe}_pair_summary.tsv"
 	SUMMARY_FP = f"{WORK_FP}/{SUMMARY_FN}"
+	PROFILE_FP = SUMMARY_FP.replace('_pair_summary.tsv', '_profile.json')
 	SUMMARY_STR = f"{WORK_FN}/{SUMMARY_FN}"
 	SUMMARY_DIR = f"{WORK_FP}/out/{curr_mcc_str}/summaries"
 
@@ -139,6 +157,9 @@ def main():
 	else:
 		print(f"Using existing output directory: {SUMMARY_DIR}")
 
+	# The pair summary itself is written to WORK_FP/summaries
+	os.makedirs(os.path.dirname(SUMMARY_FP), exist_ok = True)
+
 	if not os.path.exists(LOG_DIR):
 		print(f"Creating output directory: {LOG_DIR}")
 		os.makedirs(LOG_DIR, exist_ok = True)
@@ -173,7 +194,8 @@ def main():
 	loinc_ls = loincs['loinc'].drop_duplicates().tolist()
 
 	# Read in the manual review info for all the labs and only keep the good ones
-	man_rev_labs = pd.read_excel(MAN_REV_LAB_FP)
+	with prof.stage('read_meta'):
+		man_rev_labs = pd.read_excel(MAN_REV_LAB_FP)
 	man_rev_labs = man_rev_labs.loc[man_rev_labs['good'] == 'y', :]
 
 	# Read in the lab count information
@@ -193,8 +215,12 @@ def main():
 	# Run all with merge ####
 	curr_fn = f"{PHE_FP}/{curr_mcc_str}_{curr_phe}.tsv"
 
+	run = start_run('tnx_phecode_generating_pairs', key = f"{curr_mcc_str}_{curr_phe}",
+									params = args, inputs = [curr_fn, LAB_FP])
+
 	# Read in the Phecode data
-	curr_dat = pd.read_csv(curr_fn, sep='\t', dtype=str)
+	with prof.stage('read_phecodes'):
+		curr_dat = pd.read_csv(curr_fn, sep='\t', dtype=str)
 
 	###########################################
 	#     If no patients for Phecode BAIL     #
@@ -225,7 +251,11 @@ def main():
 
 	# For now we just care about the patient ID because there will be different 
 	# Phecodes codes in the file but the patient should only show up once.
-	de_dupe = curr_dat.drop_duplicates(['pat_id'], keep='first')
+	with prof.stage('phe_dedupe'):
+		de_dupe = curr_dat.drop_duplicates(['pat_id'], keep='first')
+	prof.rows('phe_pats', len(de_dupe))
+	run.rows_in = len(curr_dat)
+	run.rows_out = 0
 
 	curr_dis = de_dupe.copy(deep=True)
 
@@ -234,8 +264,11 @@ def main():
 	for curr_loinc in pbar:
 
 			# Could be multiple files for this LOINC code so process them both
-			file_ls = glob.glob(f"{LAB_FP}/{curr_loinc}*")
+			prof.end_item()
+			with prof.stage('glob'):
+				file_ls = glob.glob(f"{LAB_FP}/{curr_loinc}*")
 			for curr_lab_fn in file_ls:
+					prof.new_item()
 					src_org = man_rev_labs.loc[man_rev_labs['loinc'] == curr_loinc, 
 																'src'].to_list()[0]
 					
@@ -244,8 +277,11 @@ def main():
 					suffix = 'single_thread'
 
 					# Read in the lab data
-					curr_lab = pd.read_csv(curr_lab_fn, names = LAB_COLS, 
-														index_col = False, quoting = csv.QUOTE_NONE)
+					with prof.stage('read_csv'):
+						curr_lab = pd.read_csv(curr_lab_fn, names = LAB_COLS, 
+															index_col = False, quoting = csv.QUOTE_NONE)
+					prof.rows('lab_read', len(curr_lab))
+					run.rows_in += len(curr_lab)
 
 	###########################################
 	#  If no lab results for LOINC code BAIL  #
@@ -281,11 +317,13 @@ def main():
 
 							continue
 
-					curr_lab = curr_lab.applymap(lambda x: str(x).lstrip('"').rstrip('"'))
+					with prof.stage('applymap'):
+						curr_lab = curr_lab.applymap(lambda x: str(x).lstrip('"').rstrip('"'))
 
-					curr_lab.loc[:, 'lab_date'] = pd.to_datetime(curr_lab.loc[:, 
-																															 'lab_date'], 
-																															 format="%Y%m%d")
+					with prof.stage('to_datetime'):
+						curr_lab.loc[:, 'lab_date'] = pd.to_datetime(curr_lab.loc[:, 
+																																 'lab_date'], 
+																																 format="%Y%m%d")
 
 					# Rename some cols to prep for merging with diags
 					curr_lab = curr_lab.rename(columns={'code': 'lab_code',
@@ -297,11 +335,15 @@ def main():
 					# Grep commands to pull each LOINC weren't perfect, so when pulling
 					# 587-6 it also picked up 26587-6 and 42587-6. So here filter all
 					# the wrong ones out.
-					curr_lab = curr_lab.loc[curr_lab['lab_code'] == curr_loinc, :]
+					with prof.stage('filter'):
+						curr_lab = curr_lab.loc[curr_lab['lab_code'] == curr_loinc, :]
+					prof.rows('lab_code', len(curr_lab))
 
 					# For cat limit to Positive and Negative (drop Unknown and other odd responses)
-					curr_lab = curr_lab.loc[((curr_lab['lab_result_text'] == 'Negative') |
-																	(curr_lab['lab_result_text'] == 'Positive')), :]
+					with prof.stage('filter'):
+						curr_lab = curr_lab.loc[((curr_lab['lab_result_text'] == 'Negative') |
+																		(curr_lab['lab_result_text'] == 'Positive')), :]
+					prof.rows('lab_pos_neg', len(curr_lab))
 
 					# Merge in diagnosis information for each lab test
 					# Mix where 'diag_date' (diagnosis date) is NA are controls!
@@ -311,7 +353,9 @@ def main():
 					# so controls are not in curr_dis. However, upon this merge
 					# all the non-cases (controls) have a NA for diag_date
 					# So it still works.
-					mix = curr_lab.merge(curr_dis, on='pat_id', how='left')
+					with prof.stage('merge'):
+						mix = curr_lab.merge(curr_dis, on='pat_id', how='left')
+					prof.rows('mix', len(mix))
 
 	##############################################
 	#  If no patients with both lab and phecode  #
@@ -350,37 +394,40 @@ def main():
 
 
 
-					mix = mix.sort_values('pat_id')
+					with prof.stage('sort_dedupe'):
+						mix = mix.sort_values('pat_id')
 
-					# People with no Phecode 
-					cons = mix.loc[mix['status'].isna(), :]
+						# People with no Phecode 
+						cons = mix.loc[mix['status'].isna(), :]
 
-					# Take the latest test result
-					cons = cons.sort_values(['pat_id', 'lab_date'],
-																	ascending=[False, False]).drop_duplicates(
-																		['pat_id'])
+						# Take the latest test result
+						cons = cons.sort_values(['pat_id', 'lab_date'],
+																		ascending=[False, False]).drop_duplicates(
+																			['pat_id'])
 
-					# Grab the cases (the ones that have a valid 'date' which is the 
-					# diag date)
-					cases = mix.loc[~mix['status'].isna(), :]
+						# Grab the cases (the ones that have a valid 'date' which is the 
+						# diag date)
+						cases = mix.loc[~mix['status'].isna(), :]
 
-					# List of all people with the Phecode!
-					all_case_ls = cases['pat_id'].unique().tolist()
+						# List of all people with the Phecode!
+						all_case_ls = cases['pat_id'].unique().tolist()
 
-					# List of people with test result before diagnosis
-					good_case_ls = cases['pat_id'].unique().tolist()
+						# List of people with test result before diagnosis
+						good_case_ls = cases['pat_id'].unique().tolist()
 
-					# People that don't have a test result before diag
-					bad_case_ls = list(set(all_case_ls).difference(set(good_case_ls)))
+						# People that don't have a test result before diag
+						bad_case_ls = list(set(all_case_ls).difference(set(good_case_ls)))
 
-					# Sort within each patient so the latest test (closest to diag) is at 
-					# top
-					cases = cases.sort_values(['pat_id', 'lab_date'], 
-															 ascending=[False, False])
+						# Sort within each patient so the latest test (closest to diag) is at 
+						# top
+						cases = cases.sort_values(['pat_id', 'lab_date'], 
+																 ascending=[False, False])
 
-					# Now drop all dupes leaving only the latest test (before diagnosis) 
-					# result
-					cases = cases.drop_duplicates(['pat_id'], keep='first')
+						# Now drop all dupes leaving only the latest test (before diagnosis) 
+						# result
+						cases = cases.drop_duplicates(['pat_id'], keep='first')
+					prof.rows('cases', len(cases))
+					prof.rows('cons', len(cons))
 
 					cons['use'] = True
 					cons['is_case'] = False
@@ -401,6 +448,7 @@ def main():
 													 'code_system']]
 
 					fin_mix = pd.concat([cases, cons])
+					prof.rows('fin', len(fin_mix))
 
 	######################################################
 	#  If no cases or controls (shouldn't hit here) BAIL #
@@ -477,7 +525,9 @@ def main():
 
 					fin_mix['phecode'] = curr_phe
 					out_fn = f"{PAIR_DIR}/phe_{curr_phe}_{src_org}_{curr_loinc}_{suffix}.tsv"
-					fin_mix.to_csv(out_fn, index=False, sep="\t")
+					with prof.stage('to_csv'):
+						fin_mix.to_csv(out_fn, index=False, sep="\t")
+					run.rows_out += len(fin_mix)
 
 	new_meas = pd.DataFrame(meas_sum_ls)
 
@@ -487,9 +537,18 @@ def main():
 											'n_val_0', 'n_vals_non_0',
 											'num_unique', 'num_values',
 											'cat_n_values', 'cat_values']
+
+	# One row of stage timings, row counts and peak memory per lab file
+	if args['profile']:
+		new_meas = pd.concat([new_meas, prof.item_df()], axis = 1)
 	
 	new_meas.to_csv(SUMMARY_FP, sep='\t', index = False)
 
+	prof.dump(PROFILE_FP, {'phecode' : curr_phe, 'mcc' : curr_mcc_str,
+											 'n_loincs' : len(loinc_ls)})
+
+	run.finish(outputs = [PAIR_DIR, SUMMARY_FP])
+
 
 	log_message(f'{dt()} Finished processing Phecode: {curr_phe}', LOG_FP)
 
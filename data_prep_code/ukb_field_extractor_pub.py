@@ -0,0 +1,379 @@
+# Name:     ukb_field_extractor_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Column-projected reader for the UKB RAP extract (base_data.tsv, 859
+#   columns) used in ukb_phecode_raw_data_proc.ipynb. Instead of loading every
+#   column and then slicing by source (death, cancer, hospital, self-report),
+#   you ask for UKB fields by ID or pattern (e.g. p40000_i*, p20002*) and only
+#   those columns are parsed (usecols). Field IDs are checked against
+#   data_dict.tsv. Each projection is cached as Parquet, keyed by the columns,
+#   the participant list and the size/mtime of base_data.tsv, so repeated
+#   notebook runs just read the cache.
+#
+#   On top of that it builds the same long-format diagnosis tables the notebook
+#   writes out (*_prepped_for_phecode.tsv) with melts instead of looping over
+#   every person:
+#       death_long:  eid, date_of_death, age_at_death, code, cause_level,
+#                    primary_encoding, secondary_encoding
+#       cancer_long: eid, date_of_diag, age_at_diag, diag_code, diag_encoding
+#       hosp_long:   eid, date_of_diag, diag_code, diag_encoding
+#       sr_long:     eid, curr_icd, date, encoding
+#
+#   Usage:
+#       from ukb_field_extractor_pub import extract_source
+#       death_clean = extract_source('death', pat_ls)
+#
+#       python ukb_field_extractor_pub.py --source all
+#
+
+import argparse
+import ast
+import fnmatch
+import hashlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    HAVE_ARROW = True
+except ImportError:
+    HAVE_ARROW = False
+
+HOME_DIR = "/data/pathogen_ncd"
+UKB_RAW_DIR = f'{HOME_DIR}/phecode/ukb/ukb_raw'
+OUT_DIR = f'{HOME_DIR}/phecode/ukb/ukb_proc'
+CACHE_DIR = f'{OUT_DIR}/field_cache'
+
+BASE_FN = f'{UKB_RAW_DIR}/base_data.tsv'
+DD_FN = f'{UKB_RAW_DIR}/data_dict.tsv'
+
+# UKB fields needed for each diagnosis source
+#   Death:       40000 date, 40001 primary cause, 40002 secondary causes,
+#                40007 age
+#   Cancer:      40005 date, 40006 ICD10, 40008 age, 40013 ICD9
+#   Hospital:    41270 ICD10 diags (41280 dates), 41271 ICD9 diags (41281 dates)
+#   Self-report: 20002 non-cancer code, 20008 interpolated year
+SOURCE_FIELDS = {'death'  : ['p40000_i*', 'p40001_i*', 'p40002_i*', 'p40007_i*'],
+                 'cancer' : ['p40005_i*', 'p40006_i*', 'p40008_i*', 'p40013_i*'],
+                 'hosp'   : ['p41270', 'p41271', 'p41280_a*', 'p41281_a*'],
+                 'sr'     : ['p20002_i*', 'p20008_i*']}
+
+# Where the notebook writes each source's long table
+SOURCE_OUT = {'death'  : f'{OUT_DIR}/death/death_prepped_for_phecode.tsv',
+              'cancer' : f'{OUT_DIR}/cancer/cancer_prepped_for_phecode.tsv',
+              'hosp'   : f'{OUT_DIR}/hosp/hosp_prepped_for_phecode.tsv',
+              'sr'     : f'{OUT_DIR}/sr/sr_prepped_for_phecode.tsv'}
+
+# Diagnosis code fields, read as strings so ICD9 codes like 1749 stay 1749
+CODE_FIELDS = ['40001', '40002', '40006', '40013', '41270', '41271']
+
+# p<field>[_i<instance>][_a<array index>]
+FIELD_RE = re.compile(r'^p(\d+)(?:_i(\d+))?(?:_a(\d+))?$')
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Simple function specific to ICD10 codes to convert how UKB stores ICD codes
+# (no period) to the normal convention, with a period.
+def fix_icd10(curr_icd):
+    if len(curr_icd) > 3:
+        new_icd = f"{curr_icd[:3]}.{curr_icd[3:]}"
+    else:
+        new_icd = curr_icd
+
+    return new_icd
+
+# A bit more complicated function specific to ICD9 to convert how UKB stores ICD
+# codes (no period) to the normal convention, with a period.
+def fix_icd9(curr_icd):
+    curr_icd = str(curr_icd)
+
+    # We need a decimal point!
+    if len(curr_icd) > 3:
+        # Need to deal with special E or V ICD9 codes, for these we need to do
+        # 4 chars, the letter and then the 3 numbers before period.
+        new_icd = curr_icd.replace('.', '')
+        if (('E' in curr_icd) or ('V' in curr_icd)):
+            new_icd = f"{new_icd[:4]}.{new_icd[4:]}"
+        else:
+            new_icd = f"{new_icd[:3]}.{new_icd[3:]}"
+
+    else:
+        new_icd = curr_icd.replace('.', '')
+        print(f"Non-standard ICD9 code found: {curr_icd}  --> Setting to {new_icd}")
+
+    return new_icd
+
+# Convert float (fractional) years to YYYY-MM-DD, using 365.25 for leap years.
+def fl_to_dt(in_float):
+    in_float = pd.Series(in_float, dtype = float)
+    yr = np.floor(in_float).astype(int)
+    days = 365.25 * (in_float - yr)
+
+    dates = pd.to_datetime(yr.astype(str), format = '%Y') + \
+        pd.to_timedelta(days, unit = 'D')
+
+    return dates.dt.strftime('%Y-%m-%d').to_numpy()
+
+# Resolve field IDs/patterns to the actual base_data.tsv columns (in file
+# order). Patterns are checked against data_dict.tsv too when we have it so a
+# typo'd field ID fails loudly instead of silently returning nothing.
+def get_fields(patterns, base_fn = BASE_FN, dd_fn = DD_FN):
+    header = pd.read_csv(base_fn, sep = '\t', nrows = 0).columns.tolist()
+
+    known = set(header)
+    if (dd_fn is not None) and os.path.exists(dd_fn):
+        dd = pd.read_csv(dd_fn, sep = '\t')
+        if 'name' in dd.columns:
+            known = known & set(dd['name'].astype(str))
+
+    cols = []
+    for curr_pat in patterns:
+        matches = [x for x in header if (x in known) and fnmatch.fnmatchcase(x, curr_pat)]
+        if len(matches) == 0:
+            raise ValueError(f"No UKB fields in {base_fn} match {curr_pat}")
+        cols.extend(x for x in matches if x not in cols)
+
+    # Keep file order
+    return [x for x in header if x in cols]
+
+# Read just the requested fields (plus eid) from base_data.tsv, limited to
+# pat_ls if given, using (and filling) the Parquet cache when we can.
+def read_fields(patterns, pat_ls = None, base_fn = BASE_FN, dd_fn = DD_FN,
+                cache_dir = CACHE_DIR, use_cache = True):
+    cols = ['eid'] + get_fields(patterns, base_fn, dd_fn)
+
+    # Parquet needs pyarrow
+    use_cache = use_cache and HAVE_ARROW
+
+    if use_cache:
+        st = os.stat(base_fn)
+        key = hashlib.md5()
+        key.update(','.join(cols).encode())
+        if pat_ls is not None:
+            key.update(','.join(str(x) for x in sorted(set(pat_ls))).encode())
+        key.update(f"{os.path.abspath(base_fn)}|{st.st_size}|{st.st_mtime_ns}".encode())
+        cache_fn = f"{cache_dir}/base_data_{key.hexdigest()[:16]}.parquet"
+
+        if os.path.exists(cache_fn):
+            return pd.read_parquet(cache_fn)
+
+    dtypes = {x : str for x in cols if (FIELD_RE.match(x) is not None) and
+              (FIELD_RE.match(x).group(1) in CODE_FIELDS)}
+    wide = pd.read_csv(base_fn, sep = '\t', usecols = cols, dtype = dtypes,
+                       low_memory = False)
+    wide = wide.loc[:, cols]
+
+    if pat_ls is not None:
+        wide = wide.loc[wide['eid'].isin(pat_ls), :].reset_index(drop = True)
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+        wide.to_parquet(tmp_fn, index = False)
+        os.replace(tmp_fn, cache_fn)
+
+    return wide
+
+# Melt all columns of one UKB field to long format: eid, col, inst, arr, val,
+# plus the person's row and column position so we can keep the notebook's
+# row order. NA values are dropped.
+def melt_field(wide, field):
+    cols = [x for x in wide.columns if (FIELD_RE.match(x) is not None) and
+            (FIELD_RE.match(x).group(1) == str(field))]
+
+    long = wide.loc[:, ['eid'] + cols].copy()
+    long['row_pos'] = np.arange(len(long))
+    long = long.melt(id_vars = ['eid', 'row_pos'], value_vars = cols,
+                     var_name = 'col', value_name = 'val')
+    long = long.loc[long['val'].notna(), :]
+
+    parts = long['col'].str.extract(FIELD_RE)
+    long['inst'] = pd.to_numeric(parts[1]).fillna(0).astype(int)
+    long['arr'] = pd.to_numeric(parts[2]).fillna(0).astype(int)
+    long['col_pos'] = long['col'].map({x : i for i, x in enumerate(cols)})
+
+    return long
+
+# Per person (one value) lookup of a single-instance field, e.g. date of death
+# in p40000_i0.
+def get_col(wide, col, default):
+    if col in wide.columns:
+        return wide.set_index('eid')[col]
+    return pd.Series(default, index = wide['eid'])
+
+# Death registry: one row per primary/secondary cause of death.
+def death_long(wide):
+    dod = get_col(wide, 'p40000_i0', np.nan)
+    age = get_col(wide, 'p40007_i0', np.nan)
+
+    prim = melt_field(wide, 40001)
+    prim['cause_level'] = 'primary'
+    sec = melt_field(wide, 40002)
+    sec['cause_level'] = 'secondary'
+
+    long = pd.concat([prim, sec])
+    long['level_pos'] = (long['cause_level'] == 'secondary').astype(int)
+    long = long.sort_values(['row_pos', 'level_pos', 'col_pos'], kind = 'stable')
+
+    # No date or age of death listed -> '' and -99 like the notebook
+    long['date_of_death'] = long['eid'].map(dod).fillna('')
+    long['age_at_death'] = long['eid'].map(age).fillna(-99)
+    long['code'] = long['val'].astype(str).map(fix_icd10)
+    long['primary_encoding'] = 'ICD10'
+    long['secondary_encoding'] = 'ICD10'
+
+    return long.loc[:, ['eid', 'date_of_death', 'age_at_death', 'code',
+                        'cause_level', 'primary_encoding',
+                        'secondary_encoding']].reset_index(drop = True)
+
+# Cancer registry: one row per registry instance with a diagnosis date,
+# ICD10 code if we have one otherwise ICD9.
+def cancer_long(wide):
+    dates = melt_field(wide, 40005)
+
+    key = ['eid', 'inst']
+    ages = melt_field(wide, 40008).loc[:, key + ['val']].rename(columns = {'val' : 'age_at_diag'})
+    icd10 = melt_field(wide, 40006).loc[:, key + ['val']].rename(columns = {'val' : 'icd10'})
+    icd9 = melt_field(wide, 40013).loc[:, key + ['val']].rename(columns = {'val' : 'icd9'})
+
+    long = dates.merge(ages, on = key, how = 'left')
+    long = long.merge(icd10, on = key, how = 'left').merge(icd9, on = key, how = 'left')
+    long = long.sort_values(['row_pos', 'col_pos'], kind = 'stable')
+
+    for curr_row in long.loc[long['icd10'].isna() & long['icd9'].isna(), :].itertuples():
+        print(f'{curr_row.eid}: inst_{curr_row.inst}_ent_0 not in 9 or 10 data')
+    long = long.loc[long['icd10'].notna() | long['icd9'].notna(), :].copy()
+
+    is_10 = long['icd10'].notna()
+    long['diag_code'] = ''
+    long.loc[is_10, 'diag_code'] = long.loc[is_10, 'icd10'].astype(str).map(fix_icd10)
+    long.loc[~is_10, 'diag_code'] = long.loc[~is_10, 'icd9'].astype(str).map(fix_icd9)
+    long['diag_encoding'] = np.where(is_10, 'ICD10', 'ICD9')
+    long = long.rename(columns = {'val' : 'date_of_diag'})
+
+    return long.loc[:, ['eid', 'date_of_diag', 'age_at_diag', 'diag_code',
+                        'diag_encoding']].reset_index(drop = True)
+
+# Hospital inpatient: 41270/41271 hold each person's list of diagnoses, with
+# the date of the n-th diagnosis in array index n of 41280/41281.
+def hosp_long(wide):
+    res_ls = []
+    for diag_col, date_field, enc, fix_fun in [('p41270', 41280, 'ICD10', fix_icd10),
+                                               ('p41271', 41281, 'ICD9', fix_icd9)]:
+        if diag_col not in wide.columns:
+            continue
+
+        diags = wide.loc[:, ['eid', diag_col]].copy()
+        diags['row_pos'] = np.arange(len(diags))
+        diags = diags.loc[diags[diag_col].notna(), :]
+
+        # Stored as a python list literal
+        diags['diag_code'] = diags[diag_col].map(ast.literal_eval)
+        diags = diags.explode('diag_code')
+        diags = diags.loc[diags['diag_code'].notna(), :]
+        diags['arr'] = diags.groupby('eid').cumcount()
+
+        dates = melt_field(wide, date_field).loc[:, ['eid', 'arr', 'val']]
+        diags = diags.merge(dates, on = ['eid', 'arr'], how = 'left')
+
+        diags['diag_code'] = diags['diag_code'].astype(str).map(fix_fun)
+        diags['diag_encoding'] = enc
+        diags['enc_pos'] = 0 if enc == 'ICD10' else 1
+        res_ls.append(diags.rename(columns = {'val' : 'date_of_diag'}))
+
+    long = pd.concat(res_ls)
+
+    # The notebook only gets to the ICD9 list for people that also have ICD10
+    # diagnoses, keep that so the tables match.
+    has_10 = set(long.loc[long['diag_encoding'] == 'ICD10', 'eid'])
+    long = long.loc[long['eid'].isin(has_10), :]
+
+    long = long.sort_values(['row_pos', 'enc_pos', 'arr'], kind = 'stable')
+
+    return long.loc[:, ['eid', 'date_of_diag', 'diag_code',
+                        'diag_encoding']].reset_index(drop = True)
+
+# UKB non-cancer self-report coding -> 3 char ICD10 lookup, same merge as the
+# notebook.
+def load_sr_map(raw_dir = UKB_RAW_DIR):
+    sr_non_map = pd.read_csv(f'{raw_dir}/sr_noncancer_encoding.tsv', sep = '\t')
+    sr_to_icd10_3char = pd.read_csv(f'{raw_dir}/sr_code_to_icd10_3char.tsv', sep = '\t')
+
+    sr_to_icd10_3char.columns = ['coding', '3char_ICD10_on_code']
+    sr_non_map = sr_non_map.merge(sr_to_icd10_3char, how = 'left', on = 'coding')
+
+    return sr_non_map.drop_duplicates('coding').set_index('coding')['3char_ICD10_on_code']
+
+# Self-report (non-cancer): code in 20002 and interpolated year in 20008 for
+# the same instance/array index. Drops codes with no ICD10 and dates that are
+# -1, -3 or before 1930 (per UKB first occurrence docs).
+def sr_long(wide, sr_map):
+    codes = melt_field(wide, 20002)
+    dates = melt_field(wide, 20008).loc[:, ['eid', 'inst', 'arr', 'val']]
+    dates = dates.rename(columns = {'val' : 'yr'})
+
+    long = codes.merge(dates, on = ['eid', 'inst', 'arr'], how = 'inner')
+    long = long.sort_values(['row_pos', 'col_pos'], kind = 'stable')
+
+    long['curr_icd'] = long['val'].astype(float).astype(int).map(sr_map)
+    long = long.loc[long['curr_icd'].notna(), :]
+
+    yr = long['yr'].astype(float)
+    long = long.loc[~(np.isclose(yr, -1) | np.isclose(yr, -3) | (yr < 1930)), :].copy()
+
+    long['date'] = fl_to_dt(long['yr'])
+    long['encoding'] = 'ICD10'
+
+    return long.loc[:, ['eid', 'curr_icd', 'date', 'encoding']].reset_index(drop = True)
+
+# Read the fields for one diagnosis source and return its long table.
+def extract_source(source, pat_ls = None, base_fn = BASE_FN, dd_fn = DD_FN,
+                   cache_dir = CACHE_DIR, use_cache = True):
+    wide = read_fields(SOURCE_FIELDS[source], pat_ls, base_fn, dd_fn,
+                       cache_dir, use_cache)
+
+    if source == 'death':
+        return death_long(wide)
+    elif source == 'cancer':
+        return cancer_long(wide)
+    elif source == 'hosp':
+        return hosp_long(wide)
+    elif source == 'sr':
+        return sr_long(wide, load_sr_map(os.path.dirname(base_fn)))
+
+    raise ValueError(f"Unknown source {source}")
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Extract UKB diagnosis sources from base_data.tsv')
+    parser.add_argument('--source', default = 'all',
+                        choices = ['all'] + list(SOURCE_FIELDS.keys()),
+                        help = 'Diagnosis source to extract')
+    parser.add_argument('--covs', default = f'{HOME_DIR}/procd/cov_dat.csv',
+                        help = 'Covariate file listing the participants (eid) to keep')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = "Don't read/write the Parquet cache")
+    args = vars(parser.parse_args())
+
+    # Extact the people with titer data
+    covs = pd.read_csv(args['covs'], sep = ',')
+    pat_ls = covs['eid'].unique().tolist()
+
+    src_ls = list(SOURCE_FIELDS.keys()) if args['source'] == 'all' else [args['source']]
+    for curr_src in src_ls:
+        res = extract_source(curr_src, pat_ls, use_cache = not args['no_cache'])
+
+        os.makedirs(os.path.dirname(SOURCE_OUT[curr_src]), exist_ok = True)
+        res.to_csv(SOURCE_OUT[curr_src], sep = '\t', index = False)
+        print(f"{curr_src}: {len(res):,} rows -> {SOURCE_OUT[curr_src]}")
+
+if __name__ == '__main__':
+    main()
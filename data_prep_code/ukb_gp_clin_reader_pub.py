@@ -0,0 +1,151 @@
+# Name:     ukb_gp_clin_reader_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Streaming reader for the UKB primary care data (gp_clin.tsv, 3.8 GB, ~118M
+#   rows) used in ukb_phecode_raw_data_proc.ipynb. Instead of reading the whole
+#   file into pandas and then keeping only the 9,429 participants with titer
+#   data, the eid filter and column projection are applied while parsing
+#   (pyarrow dataset scan with a filter, or chunked pandas reads if pyarrow
+#   isn't installed), so only the reduced rows are ever held in memory.
+#
+#   The reduced frame is cached as Parquet, keyed by the participant list,
+#   the columns requested and the size/mtime of gp_clin.tsv, so re-running the
+#   notebook just reads the cache.
+#
+#   In the notebook, replace:
+#       gp  = pd.read_csv(f'{UKB_RAW_DIR}/gp_clin.tsv', sep = '\t')
+#       ...
+#       gp = gp.loc[gp['eid'].isin(pat_ls), :]
+#   with:
+#       from ukb_gp_clin_reader_pub import read_gp_clin
+#       gp = read_gp_clin(f'{UKB_RAW_DIR}/gp_clin.tsv', pat_ls)
+#
+#   Or from the command line to just build the cache:
+#       python ukb_gp_clin_reader_pub.py
+#
+
+import argparse
+import hashlib
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+    HAVE_ARROW = True
+except ImportError:
+    HAVE_ARROW = False
+
+HOME_DIR = "/data/pathogen_ncd"
+UKB_RAW_DIR = f'{HOME_DIR}/phecode/ukb/ukb_raw'
+CACHE_DIR = f'{HOME_DIR}/phecode/ukb/ukb_proc/gp/cache'
+
+# Columns the Read v2/CTV3 -> ICD10 translation needs
+GP_COLS = ['eid', 'event_dt', 'read_2', 'read_3']
+
+# Read codes look numeric sometimes (e.g. 12345), keep them as strings
+STR_COLS = ['event_dt', 'read_2', 'read_3', 'value1', 'value2', 'value3']
+
+CHUNK_SIZE = 5_000_000
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Cache file name for this participant list, column selection and version of
+# gp_clin.tsv.
+def get_cache_fn(gp_fn, pat_ls, cols, cache_dir):
+    st = os.stat(gp_fn)
+
+    key = hashlib.md5()
+    key.update(','.join(str(x) for x in sorted(set(pat_ls))).encode())
+    key.update(','.join(cols).encode())
+    key.update(f"{os.path.abspath(gp_fn)}|{st.st_size}|{st.st_mtime_ns}".encode())
+
+    return f"{cache_dir}/gp_clin_{key.hexdigest()[:16]}.parquet"
+
+# pyarrow dataset scan, the filter and projection are pushed into the scan so
+# record batches are reduced as the file is parsed.
+def scan_arrow(gp_fn, pat_ls, cols):
+    col_types = {curr_col : pa.string() for curr_col in STR_COLS}
+    col_types['eid'] = pa.int64()
+
+    fmt = ds.CsvFileFormat(parse_options = pa_csv.ParseOptions(delimiter = '\t'),
+                           convert_options = pa_csv.ConvertOptions(column_types = col_types))
+
+    dset = ds.dataset(gp_fn, format = fmt)
+    tab = dset.to_table(columns = cols,
+                        filter = ds.field('eid').isin(pa.array(sorted(set(pat_ls)),
+                                                               type = pa.int64())))
+
+    return tab.to_pandas()
+
+# Chunked pandas fallback, only the filtered rows of each chunk are kept.
+def scan_chunks(gp_fn, pat_ls, cols):
+    pat_set = set(pat_ls)
+    dtypes = {curr_col : str for curr_col in STR_COLS if curr_col in cols}
+
+    keep_ls = []
+    for chunk in pd.read_csv(gp_fn, sep = '\t', usecols = cols, dtype = dtypes,
+                             chunksize = CHUNK_SIZE):
+        keep_ls.append(chunk.loc[chunk['eid'].isin(pat_set), :])
+
+    return pd.concat(keep_ls, ignore_index = True)
+
+# Read gp_clin.tsv limited to the participants in pat_ls and the columns in
+# cols, using (and filling) the Parquet cache when we can.
+def read_gp_clin(gp_fn, pat_ls, cols = GP_COLS, cache_dir = CACHE_DIR,
+                 use_cache = True):
+    # Always need eid for the filter
+    cols = ['eid'] + [curr_col for curr_col in cols if curr_col != 'eid']
+
+    # Parquet needs pyarrow
+    use_cache = use_cache and HAVE_ARROW
+
+    if use_cache:
+        cache_fn = get_cache_fn(gp_fn, pat_ls, cols, cache_dir)
+
+        if os.path.exists(cache_fn):
+            print(f"Loading cached gp_clin: {cache_fn}")
+            return pd.read_parquet(cache_fn)
+
+    print(f"Scanning {gp_fn} for {len(set(pat_ls)):,} participants")
+    if HAVE_ARROW:
+        gp = scan_arrow(gp_fn, pat_ls, cols)
+    else:
+        gp = scan_chunks(gp_fn, pat_ls, cols)
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+        gp.to_parquet(tmp_fn, index = False)
+        os.replace(tmp_fn, cache_fn)
+        print(f"Cached gp_clin: {cache_fn}")
+
+    return gp
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Filter gp_clin.tsv to participants with titer data')
+    parser.add_argument('--gp', default = f'{UKB_RAW_DIR}/gp_clin.tsv',
+                        help = 'Path to gp_clin.tsv')
+    parser.add_argument('--covs', default = f'{HOME_DIR}/procd/cov_dat.csv',
+                        help = 'Covariate file listing the participants (eid) to keep')
+    parser.add_argument('--cache-dir', default = CACHE_DIR,
+                        help = 'Where to write the Parquet cache')
+    args = vars(parser.parse_args())
+
+    # Extact the people with titer data
+    covs = pd.read_csv(args['covs'], sep = ',')
+    pat_ls = covs['eid'].unique().tolist()
+
+    gp = read_gp_clin(args['gp'], pat_ls, cache_dir = args['cache_dir'])
+    print(f"{len(gp):,} rows for {gp['eid'].nunique():,} participants")
+
+if __name__ == '__main__':
+    main()
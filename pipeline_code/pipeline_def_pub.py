@@ -0,0 +1,316 @@
+# Name:     pipeline_def_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   The whole analysis pipeline written down as stages for pipeline_runner_pub.py,
+#   in place of running each step by hand off the flow diagrams in
+#   flow_diagram_of_code/. Each stage is a dict:
+#
+#       name        Stage name
+#       cmd         Shell command to run
+#       inputs      Files/directories the stage reads (globs are fine). The
+#                   scripts themselves go in here too so code changes re-run
+#                   the stage.
+#       outputs     Files/directories the stage writes (globs are fine)
+#       optional_outputs
+#                   Outputs a run may not write for some keys, a run without
+#                   them still counts as done (default none)
+#       keys        Optional, makes this an array stage run once per key:
+#                       ['A', 'B']                          a list
+#                       '{TNX}/icd_data/{key}_only.csv'     keys found by glob
+#                       {'file' : fn, 'col' : 'icd'}        a column of a csv
+#                                                           (or one key per line
+#                                                           without 'col')
+#       cores       Cores one run of the stage uses (default 1)
+#       after       Stages to wait for that don't show up through inputs and
+#                   outputs (default none)
+#       clean       Remove the outputs before running (default False), for
+#                   stages that add to their outputs rather than replace them
+#       cwd         Where to run (default {HOME})
+#
+#   {HOME}, {CODE}, {TNX}, {PHE}, {RES}, {PY}, {R} and {NB} below are filled in
+#   from VARS, {key} with the current key and {cores} with the stage's cores.
+#   Stages run after the stages writing their inputs.
+#
+#   Steps done by hand (or in the cleaning notebooks) in the original flow have
+#   no stage, what they make is treated as raw input:
+#       UKB:    procd/*.csv (ukb_icd_data_cleaning_pub.ipynb),
+#               phecode/ukb/ukb_proc/all_ukb_prepped_for_phecode.tsv
+#               (ukb_phecode_raw_data_proc.ipynb), the hand curated
+#               phecode/ukb/path_analysis/*_with_std_lev.xlsx
+#       TNX:    icd_data/{icd}_only.csv, lab_data/, procd_data/ lookups
+#               (tnx_icd_data_cleaning_pub.ipynb), the per Phecode
+#               tnx_procd/mcc1/mcc1_{phecode}.tsv files and the collected
+#               phecode_collected_res_12_5.tsv
+#
+#   Set PATHOGEN_NCD_HOME to point the pipeline at another copy of the data.
+#   The R scripts source their helpers from {HOME}/code/analysis, so those
+#   copies are what is listed as their inputs.
+#
+
+import os
+import sys
+
+HOME = os.environ.get('PATHOGEN_NCD_HOME', "/data/pathogen_ncd")
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VARS = {'HOME' : HOME,
+        'CODE' : CODE,
+        'TNX'  : f"{HOME}/trinetx",
+        'PHE'  : f"{HOME}/phecode",
+        'RES'  : f"{HOME}/results",
+        'PY'   : sys.executable,
+        'R'    : 'Rscript',
+        'NB'   : f"jupyter nbconvert --to notebook --execute --output-dir {HOME}/executed_notebooks"}
+
+# Shared by the R analyses
+R_HELPERS = ['{HOME}/code/analysis/helper_functions_pub.R',
+             '{HOME}/code/analysis/analysis_functions_pub.R']
+
+UKB_PROCD = ['{HOME}/procd/cov_dat.csv',
+             '{HOME}/procd/clean_antigen_data.csv',
+             '{HOME}/procd/dis_dat.csv',
+             '{HOME}/procd/rolled_code.csv',
+             '{HOME}/dicts/viral_dict.xlsx',
+             '{HOME}/dicts/sex_specific_codes.txt']
+
+TNX_LAB_META = ['{TNX}/lab_data',
+                '{TNX}/lab_test_data_analysis_latest_manual_review.xlsx',
+                '{TNX}/clean_loinc_counts.tsv',
+                '{TNX}/loincs_with_more_than_0_res_new_version.txt']
+
+STAGES = [
+
+    ############################################
+    #                 UKB ICD                  #
+    ############################################
+
+    # ukb_icd_analysis_pub.R writes its final results to {HOME}, the
+    # permutation and empirical p scripts read them from {RES}
+    {'name'    : 'ukb_icd_analysis',
+     'cmd'     : ('{R} {CODE}/analysis_code/ukb_icd_analysis_pub.R --workers {cores} && '
+                  'cp {HOME}/ukb_mod_results_01_17_2023.csv {RES}/ukb_mod_results_01_17_2023.csv'),
+     'inputs'  : (['{CODE}/analysis_code/ukb_icd_analysis_pub.R'] + R_HELPERS + UKB_PROCD),
+     'outputs' : ['{RES}/ukb_mod_results_01_17_2023.csv',
+                  '{HOME}/ukb_mod_results_01_17_2023.xlsx'],
+     'cores'   : 8},
+
+    # Each run adds a {icd}_perms_10000_pid_{pid}_... file, clear out the
+    # last set first so the empirical p values only count this one
+    {'name'    : 'ukb_icd_permutations',
+     'cmd'     : '{PY} {CODE}/analysis_code/ukb_icd_permutation_engine_pub.py --icd {key} --perm 10000',
+     'keys'    : {'file' : '{RES}/ukb_mod_results_01_17_2023.csv', 'col' : 'icd'},
+     'inputs'  : (['{CODE}/analysis_code/ukb_icd_permutation_engine_pub.py',
+                   '{RES}/ukb_mod_results_01_17_2023.csv'] + UKB_PROCD),
+     'outputs' : ['{RES}/perm_p_sims/final/{key}_perms_10000_pid_*_01_17_2023_result.tsv'],
+     'clean'   : True},
+
+    {'name'    : 'ukb_icd_empirical_p',
+     'cmd'     : '{PY} {CODE}/analysis_code/ukb_icd_empirical_p_calculations_pub.py --icd {key}',
+     'keys'    : '{RES}/perm_p_sims/final/{key}_perms_*_result.tsv',
+     'inputs'  : ['{CODE}/analysis_code/ukb_icd_empirical_p_calculations_pub.py',
+                  '{RES}/ukb_mod_results_01_17_2023.csv',
+                  '{RES}/perm_p_sims/final/{key}_perms_*_result.tsv'],
+     'outputs' : ['{RES}/perm_p_sims/emp_calcs/{key}_emp_p_results.tsv']},
+
+    # Stack the per ICD results, keeping the first header
+    {'name'    : 'ukb_icd_emp_results',
+     'cmd'     : ("awk 'FNR > 1 || NR == 1' {RES}/perm_p_sims/emp_calcs/*_emp_p_results.tsv "
+                  "> {RES}/emp_results_01_17_2023.tsv"),
+     'inputs'  : ['{RES}/perm_p_sims/emp_calcs'],
+     'outputs' : ['{RES}/emp_results_01_17_2023.tsv']},
+
+    ############################################
+    #               UKB Phecode                #
+    ############################################
+
+    {'name'    : 'ukb_field_extractor',
+     'cmd'     : '{PY} {CODE}/data_prep_code/ukb_field_extractor_pub.py --source all',
+     'inputs'  : ['{CODE}/data_prep_code/ukb_field_extractor_pub.py',
+                  '{PHE}/ukb/ukb_raw/base_data.tsv',
+                  '{PHE}/ukb/ukb_raw/data_dict.tsv',
+                  '{HOME}/procd/cov_dat.csv'],
+     'outputs' : ['{PHE}/ukb/ukb_proc/death/death_prepped_for_phecode.tsv',
+                  '{PHE}/ukb/ukb_proc/cancer/cancer_prepped_for_phecode.tsv',
+                  '{PHE}/ukb/ukb_proc/hosp/hosp_prepped_for_phecode.tsv',
+                  '{PHE}/ukb/ukb_proc/sr/sr_prepped_for_phecode.tsv']},
+
+    {'name'    : 'ukb_phecode_translation',
+     'cmd'     : '{PY} {CODE}/data_prep_code/phecode_translation_engine_pub.py --src ukb --wide',
+     'inputs'  : ['{CODE}/data_prep_code/phecode_translation_engine_pub.py',
+                  '{PHE}/ukb/ukb_proc/all_ukb_prepped_for_phecode.tsv',
+                  '{PHE}/ref_files',
+                  '{HOME}/procd/cov_dat.csv'],
+     'outputs' : ['{PHE}/phecode_results/ukb/translation/all_ukb_one_min_code_cnt_phecode_long.tsv',
+                  '{PHE}/phecode_results/ukb/translation/all_ukb_one_min_code_cnt_phecode_translation.tsv']},
+
+    # Needs the ICD level results (supplemental dataset 2) to compare against
+    {'name'    : 'ukb_phecode_analysis',
+     'cmd'     : '{R} {CODE}/analysis_code/ukb_phecode_analysis_pub.R --workers {cores}',
+     'inputs'  : (['{CODE}/analysis_code/ukb_phecode_analysis_pub.R',
+                   '{PHE}/phecode_results/ukb/translation/all_ukb_one_min_code_cnt_phecode_translation.tsv',
+                   '{PHE}/ref_files',
+                   '{HOME}/manuscript/supplemental_datasets/supplemental_dataset_2.xlsx'] +
+                  R_HELPERS + UKB_PROCD),
+     'outputs' : ['{PHE}/ukb/ab_analysis/ukb_phecode_results_MCC_of_ONE_*.csv'],
+     'cores'   : 8},
+
+    ############################################
+    #                 TNX ICD                  #
+    ############################################
+
+    {'name'    : 'tnx_covariates',
+     'cmd'     : ('{PY} {CODE}/data_prep_code/tnx_covariates_pub.py --pats {TNX}/patient.csv '
+                  '--out {TNX}/procd_data/procd_covs.tsv'),
+     'inputs'  : ['{CODE}/data_prep_code/tnx_covariates_pub.py',
+                  '{TNX}/patient.csv'],
+     'outputs' : ['{TNX}/procd_data/procd_covs.tsv']},
+
+    # Recounts the lab files against the curated clean_loinc_counts.tsv the
+    # pair stages use, writing to loinc_scan/ so the curated copy is left alone
+    {'name'    : 'tnx_loinc_count_scan',
+     'cmd'     : ('{PY} {CODE}/data_prep_code/tnx_loinc_count_scan_pub.py --lab_dir {TNX}/lab_data '
+                  '--meta {TNX}/clean_loinc_counts.tsv --out_dir {TNX}/loinc_scan --workers {cores}'),
+     'inputs'  : ['{CODE}/data_prep_code/tnx_loinc_count_scan_pub.py',
+                  '{TNX}/lab_data',
+                  '{TNX}/clean_loinc_counts.tsv'],
+     'outputs' : ['{TNX}/loinc_scan/clean_loinc_counts.tsv',
+                  '{TNX}/loinc_scan/loincs_with_more_than_0_res_new_version.txt'],
+     'cores'   : 16},
+
+    # Pair files carry the covariates (--with-covs), so the R analysis can
+    # skip joining them (--prejoined). Stale per LOINC files would be picked
+    # up by the analysis, so each ICD's pair directory starts empty.
+    {'name'    : 'tnx_icd_gen_pairs',
+     'cmd'     : '{PY} {CODE}/data_prep_code/tnx_icd_gen_pairs_pub.py --icd {key} --with-covs',
+     'keys'    : '{TNX}/icd_data/{key}_only.csv',
+     'inputs'  : (['{CODE}/data_prep_code/tnx_icd_gen_pairs_pub.py',
+                   '{CODE}/data_prep_code/pair_profiler_pub.py',
+                   '{TNX}/icd_data/{key}_only.csv',
+                   '{TNX}/procd_data/procd_covs.tsv'] + TNX_LAB_META),
+     'outputs' : ['{TNX}/pair_data/{key}'],
+     'clean'   : True},
+
+    {'name'    : 'tnx_icd_analysis',
+     'cmd'     : '{R} {CODE}/analysis_code/tnx_icd_analysis_pub.R --icd {key} --prejoined',
+     'keys'    : '{TNX}/icd_data/{key}_only.csv',
+     'inputs'  : (['{CODE}/analysis_code/tnx_icd_analysis_pub.R',
+                   '{TNX}/pair_data/{key}',
+                   '{RES}/emp_results_01_17_2023.tsv',
+                   '{TNX}/procd_data/healthy_pregnancy_data.tsv',
+                   '{TNX}/procd_data/prev_res_to_org_test_lookup.txt',
+                   '{HOME}/dicts/sex_specific_codes.txt'] + R_HELPERS),
+     'outputs' : ['{TNX}/results/tnx_results_01_17_2023/res/{key}_results.tsv']},
+
+    {'name'    : 'tnx_results_store',
+     'cmd'     : '{PY} {CODE}/results_processing_code/tnx_results_store_pub.py',
+     'inputs'  : ['{CODE}/results_processing_code/tnx_results_store_pub.py',
+                  '{TNX}/results/tnx_results_01_17_2023/res'],
+     'outputs' : ['{TNX}/results/tnx_all_results']},
+
+    ############################################
+    #               TNX Phecode                #
+    ############################################
+
+    # The bash commands at the top of tnx_phecode_chunking_diags_pub.py: EHR
+    # diagnoses only, 4 columns, sorted by patient, code and date
+    {'name'    : 'tnx_diag_ehr_extract',
+     'cmd'     : (r"""awk -F, '$10 == "\"EHR\""' {TNX}/raw/diagnosis.csv | """
+                  r"""awk -F'","' '{print $1","$3","$4","$8}' | """
+                  r"""parsort --parallel={cores} -t ',' -k1,1 -k3,3 -k4,4 """
+                  r"""> {PHE}/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv"""),
+     'inputs'  : ['{TNX}/raw/diagnosis.csv'],
+     'outputs' : ['{PHE}/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv'],
+     'cores'   : 56},
+
+    # 55 chunking processes and the logger
+    {'name'    : 'tnx_phecode_chunking',
+     'cmd'     : '{PY} {CODE}/data_prep_code/tnx_phecode_chunking_diags_pub.py',
+     'inputs'  : ['{CODE}/data_prep_code/tnx_phecode_chunking_diags_pub.py',
+                  '{PHE}/tnx/tnx_raw/diagnosis_ehr_only_4_cols_sorted.csv'],
+     'outputs' : ['{PHE}/tnx/tnx_procd/py_diags/chunk_*.csv'],
+     'cores'   : 56,
+     'clean'   : True},
+
+    {'name'    : 'tnx_phecode_translation',
+     'cmd'     : ('{PY} {CODE}/data_prep_code/phecode_translation_engine_pub.py --src tnx '
+                  '--workers {cores} --diag_files {PHE}/tnx/tnx_procd/py_diags/chunk_*.csv'),
+     'inputs'  : ['{CODE}/data_prep_code/phecode_translation_engine_pub.py',
+                  '{PHE}/tnx/tnx_procd/py_diags/chunk_*.csv',
+                  '{PHE}/ref_files',
+                  '{PHE}/misc/tnx_sex_data_prepped.tsv'],
+     'outputs' : ['{PHE}/phecode_results/tnx/translation/chunk_*_one_min_code_cnt_phecode_long.tsv'],
+     'cores'   : 16},
+
+    # Phecodes without any diagnoses only get a note in their pair directory,
+    # no summary file, so the summary is optional
+    {'name'    : 'tnx_phecode_gen_pairs',
+     'cmd'     : '{PY} {CODE}/data_prep_code/tnx_phecode_generating_pairs_pub.py --phe {key}',
+     'keys'    : '{PHE}/tnx/tnx_procd/mcc1/mcc1_{key}.tsv',
+     'inputs'  : (['{CODE}/data_prep_code/tnx_phecode_generating_pairs_pub.py',
+                   '{CODE}/data_prep_code/pair_profiler_pub.py',
+                   '{PHE}/tnx/tnx_procd/mcc1/mcc1_{key}.tsv'] + TNX_LAB_META),
+     'outputs' : ['{PHE}/tnx/phecode_lab_pair_final/out/mcc1/{key}'],
+     'optional_outputs' : ['{PHE}/tnx/phecode_lab_pair_final/summaries/phe_mcc1_{key}_pair_summary.tsv'],
+     'clean'   : True},
+
+    # Only the Phecodes that got a pair summary, the keys are listed once
+    # tnx_phecode_gen_pairs has finished
+    {'name'    : 'tnx_phecode_analysis',
+     'cmd'     : '{R} {CODE}/analysis_code/tnx_phecode_analysis_pub.R --phecode {key}',
+     'keys'    : '{PHE}/tnx/phecode_lab_pair_final/summaries/phe_mcc1_{key}_pair_summary.tsv',
+     'inputs'  : (['{CODE}/analysis_code/tnx_phecode_analysis_pub.R',
+                   '{PHE}/tnx/phecode_lab_pair_final/out/mcc1/{key}',
+                   '{PHE}/tnx/phecode_lab_pair_final/summaries/phe_mcc1_{key}_pair_summary.tsv',
+                   '{TNX}/procd_data/procd_covs.tsv',
+                   '{TNX}/lab_test_data_analysis_latest_manual_review.xlsx',
+                   '{TNX}/collapsed_loincs_procd.xlsx',
+                   '{TNX}/procd_data/prev_res_to_org_test_lookup.txt'] + R_HELPERS),
+     'outputs' : ['{PHE}/tnx/path_analysis/res/phe_mcc1_{key}_results_test.tsv']},
+
+    ############################################
+    #          Combining and figures           #
+    ############################################
+
+    {'name'    : 'ukb_tnx_icd_combine',
+     'cmd'     : '{PY} {CODE}/results_processing_code/ukb_tnx_combine_pub.py --level icd --out {RES}/icd_org_lev_res.tsv',
+     'inputs'  : ['{CODE}/results_processing_code/ukb_tnx_combine_pub.py',
+                  '{RES}/emp_results_01_17_2023.tsv',
+                  '{TNX}/results/tnx_all_results'],
+     'outputs' : ['{RES}/icd_org_lev_res.tsv']},
+
+    {'name'    : 'ukb_tnx_phecode_combine',
+     'cmd'     : '{PY} {CODE}/results_processing_code/ukb_tnx_combine_pub.py --level phecode --out {RES}/phe_org_lev_res.tsv',
+     'inputs'  : ['{CODE}/results_processing_code/ukb_tnx_combine_pub.py',
+                  '{PHE}/ukb/path_analysis/ukb_phecode_results_MCC_of_ONE_2024_10_22_with_std_lev.xlsx',
+                  '{PHE}/tnx/path_analysis/res/phecode_collected_res_12_5.tsv'],
+     'outputs' : ['{RES}/phe_org_lev_res.tsv']},
+
+    {'name'    : 'ukb_tnx_icd_combining_nb',
+     'cmd'     : '{NB} {CODE}/results_processing_code/ukb_tnx_icd_combining_results_pub.ipynb',
+     'inputs'  : ['{CODE}/results_processing_code/ukb_tnx_icd_combining_results_pub.ipynb',
+                  '{RES}/emp_results_01_17_2023.tsv',
+                  '{TNX}/results/tnx_all_results',
+                  '{HOME}/manuscript/supplemental_datasets/supplemental_dataset_6.xlsx'],
+     'outputs' : ['{HOME}/manuscript/supplemental_datasets/supplemental_dataset_2.xlsx']},
+
+    {'name'    : 'ukb_tnx_phecode_combining_nb',
+     'cmd'     : '{NB} {CODE}/results_processing_code/ukb_tnx_phecode_combining_results_pub.ipynb',
+     'inputs'  : ['{CODE}/results_processing_code/ukb_tnx_phecode_combining_results_pub.ipynb',
+                  '{PHE}/ukb/path_analysis/ukb_phecode_results_MCC_of_ONE_2024_10_22_with_std_lev.xlsx',
+                  '{PHE}/tnx/path_analysis/res/phecode_collected_res_12_5.tsv',
+                  '{HOME}/dicts/antigen_dict.xlsx'],
+     'outputs' : ['{HOME}/manuscript/supplemental_datasets/supplemental_dataset_3.xlsx']},
+
+    # One run per figure notebook, each saves its own svg files
+    {'name'    : 'figures',
+     'cmd'     : '{NB} {CODE}/figure_code/{key}.ipynb',
+     'keys'    : ['figure_2_pub', 'figure_3_pub', 'figure_4_pub', 'Figure_S1_pub',
+                  'Figure_S2_pub', 'Figure_S3_pub', 'Figure_S4_pub', 'Figure_S5_pub'],
+     'inputs'  : ['{CODE}/figure_code/{key}.ipynb',
+                  '{RES}/emp_results_01_17_2023.tsv',
+                  '{HOME}/manuscript/supplemental_datasets/supplemental_dataset_2.xlsx',
+                  '{HOME}/manuscript/supplemental_datasets/supplemental_dataset_3.xlsx'],
+     'outputs' : ['{HOME}/executed_notebooks/{key}.ipynb']},
+]
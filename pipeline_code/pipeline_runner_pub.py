@@ -0,0 +1,631 @@
+# Name:     pipeline_runner_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Runs the pipeline defined in pipeline_def_pub.py (or --pipeline), only
+#   redoing what has changed since the last run.
+#
+#   Stages run after the stages that write their inputs (plus any 'after'
+#   stages). Array stages (one run per ICD code, Phecode, ...) become one job
+#   per key, and jobs from every stage that is ready share the --cores budget,
+#   so independent stages and keys run side by side.
+#
+#   Before a job runs we hash its command and the contents of its inputs. If
+#   that matches the last successful run and its outputs are still as that run
+#   left them, the job is skipped. Change one upstream file and only the jobs
+#   reading it re-run; a job whose new outputs come out the same as before
+#   doesn't trigger anything downstream.
+#
+#   Hashes are SHA1 of the whole file (--quick_hash: size, mtime and the ends
+#   of the file, see run_ledger_pub.fingerprint), cached by size and mtime in
+#   the state directory so unchanged files aren't read again. Directories hash
+#   all the files under them.
+#
+#   Outputs a run is allowed not to write (a script that has nothing to
+#   write for some keys) go in 'optional_outputs'. They are hashed, cleaned
+#   and followed downstream like any other output, a run just doesn't fail
+#   without them.
+#
+#   Job state (signature, output hashes, when and how it ran) is kept as one
+#   JSON file per job under --state_dir/jobs and each job's output goes to
+#   --state_dir/logs/{stage}/{key}.log. A failed job stops the stages
+#   downstream of it, everything else carries on.
+#
+#   The scripts record themselves in the run ledger if PATHOGEN_NCD_LEDGER is
+#   set (run_ledger_pub.py), the runner doesn't add anything on top.
+#
+#   Usage:
+#       python pipeline_runner_pub.py --list
+#       python pipeline_runner_pub.py --cores 56 --dry_run
+#       python pipeline_runner_pub.py --cores 56
+#       python pipeline_runner_pub.py --cores 16 --targets tnx_icd_analysis
+#       python pipeline_runner_pub.py --cores 16 --targets tnx_icd_gen_pairs --only \
+#           --force tnx_icd_gen_pairs
+#
+
+import argparse
+import csv
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from run_ledger_pub import fingerprint
+
+DEF_PIPELINE = f"{os.path.dirname(os.path.abspath(__file__))}/pipeline_def_pub.py"
+
+STAGE_DEFAULTS = {'inputs' : [], 'outputs' : [], 'optional_outputs' : [], 'keys' : None,
+                  'cores' : 1, 'after' : [], 'clean' : False, 'cwd' : '{HOME}'}
+
+HASH_CACHE_FN = 'hash_cache.json'
+
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def ds():
+    return datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+
+def log(msg):
+    print(f"{ds()} {msg}", flush = True)
+
+# Fill in {NAME} from vals, leaving anything else in braces alone (awk etc.)
+def fill(template, vals):
+    return re.sub(r'\{(\w+)\}',
+                  lambda x: str(vals[x.group(1)]) if x.group(1) in vals else x.group(0),
+                  template)
+
+# Read the pipeline definition module, fill in the defaults and check it
+def load_pipeline(pipe_fn):
+    spec = importlib.util.spec_from_file_location('pipeline_def', pipe_fn)
+    pipe = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipe)
+
+    stages = [dict(STAGE_DEFAULTS, **x) for x in pipe.STAGES]
+    names = [x['name'] for x in stages]
+
+    dups = sorted(set(x for x in names if names.count(x) > 1))
+    if dups:
+        raise ValueError(f"Stages defined more than once: {dups}")
+
+    for curr in stages:
+        missing = [x for x in curr['after'] if x not in names]
+        if missing:
+            raise ValueError(f"{curr['name']}: unknown 'after' stages {missing}")
+
+    return pipe.VARS, stages
+
+# Fixed part of a path pattern, cut back to the last whole directory when a
+# key or glob falls in the middle of it
+def fixed_prefix(path):
+    cut = re.search(r'\{key\}|[*?\[]', path)
+    if cut is None:
+        return os.path.normpath(path)
+
+    return os.path.normpath(path[:cut.start()].rsplit('/', 1)[0] or '/')
+
+def overlaps(a, b):
+    return (a == b) or a.startswith(f"{b.rstrip('/')}/") or b.startswith(f"{a.rstrip('/')}/")
+
+# Stage -> stages it waits on, from overlapping inputs and outputs and 'after'
+def build_deps(stages, vals):
+    outs = {x['name'] : [fixed_prefix(fill(y, vals)) for y in x['outputs'] + x['optional_outputs']]
+            for x in stages}
+
+    deps = {}
+    for curr in stages:
+        ins = [fixed_prefix(fill(x, vals)) for x in curr['inputs']]
+        deps[curr['name']] = set(curr['after'])
+
+        for other in stages:
+            if other['name'] == curr['name']:
+                continue
+            if any(overlaps(x, y) for x in ins for y in outs[other['name']]):
+                deps[curr['name']].add(other['name'])
+
+    return deps
+
+# Stage names in an order that runs dependencies first, keeping the order
+# they were defined in where we can
+def topo_order(stages, deps):
+    order = []
+    left = [x['name'] for x in stages]
+
+    while left:
+        ready = [x for x in left if deps[x].issubset(order)]
+        if not ready:
+            raise ValueError(f"Stages depend on each other in a loop: {left}")
+
+        order.append(ready[0])
+        left.remove(ready[0])
+
+    return order
+
+# Targets and everything upstream of them
+def upstream(targets, deps):
+    keep = set()
+    todo = list(targets)
+
+    while todo:
+        curr = todo.pop()
+        if curr not in keep:
+            keep.add(curr)
+            todo.extend(deps[curr])
+
+    return keep
+
+# Keys for an array stage, [None] for a plain one
+def stage_keys(stage, vals):
+    keys = stage['keys']
+
+    if keys is None:
+        return [None]
+
+    if isinstance(keys, (list, tuple)):
+        return [str(x) for x in keys]
+
+    if isinstance(keys, str):
+        pattern = fill(keys, vals)
+        key_re = re.compile('^' + '.*'.join(re.escape(x).replace(r'\{key\}', '(?P<key>[^/]+?)')
+                                            for x in pattern.split('*')) + '$')
+        found = []
+        for curr_fn in sorted(glob.glob(pattern.replace('{key}', '*'))):
+            match = key_re.match(curr_fn)
+            if match and (match.group('key') not in found):
+                found.append(match.group('key'))
+
+        return found
+
+    key_fn = fill(keys['file'], vals)
+    with open(key_fn, 'r', newline = '') as in_file:
+        if keys.get('col') is None:
+            found = [x.strip() for x in in_file]
+        else:
+            found = [x[keys['col']] for x in csv.DictReader(in_file, delimiter = keys.get('sep', ','))]
+
+    return list(dict.fromkeys(x for x in found if x))
+
+def expand(path):
+    if GLOB_CHARS.search(path):
+        return sorted(glob.glob(path))
+
+    return [path]
+
+def safe_key(key):
+    return '_all' if key is None else re.sub(r'[^\w.-]', '_', key)
+
+class HashCache:
+
+    def __init__(self, cache_fn, quick = False):
+        self.cache_fn = cache_fn
+        self.quick = quick
+        self.lock = threading.Lock()
+        self.dir_memo = {}
+
+        self.cache = {}
+        if os.path.exists(cache_fn):
+            with open(cache_fn, 'r') as in_file:
+                self.cache = json.load(in_file)
+
+    # Hash of one file, only read again if its size or mtime changed
+    def file_hash(self, path):
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns, self.quick]
+
+        with self.lock:
+            hit = self.cache.get(path)
+            if (hit is not None) and (hit[:3] == stamp):
+                return hit[3]
+
+        sha = fingerprint(path, full_hash = not self.quick)[2]
+
+        with self.lock:
+            self.cache[path] = stamp + [sha]
+
+        return sha
+
+    # Hash of a file or everything under a directory, None if it isn't there
+    def path_hash(self, path):
+        path = os.path.abspath(path)
+
+        if os.path.isfile(path):
+            return self.file_hash(path)
+
+        if not os.path.isdir(path):
+            return None
+
+        with self.lock:
+            if path in self.dir_memo:
+                return self.dir_memo[path]
+
+        sha = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for curr_fn in sorted(files):
+                full_fn = os.path.join(root, curr_fn)
+                sha.update(f"{os.path.relpath(full_fn, path)}:{self.file_hash(full_fn)}\n".encode())
+
+        with self.lock:
+            self.dir_memo[path] = sha.hexdigest()
+
+        return self.dir_memo[path]
+
+    # {path : hash} for a list of paths/globs, a glob with no matches is None
+    def hashes(self, paths):
+        res = {}
+        for curr in paths:
+            matched = expand(curr)
+            if not matched:
+                res[curr] = None
+            for curr_fn in matched:
+                res[curr_fn] = self.path_hash(curr_fn)
+
+        return res
+
+    # Directory hashes can't be trusted once something writes under them
+    def forget(self, paths):
+        prefixes = [fixed_prefix(os.path.abspath(x)) for x in paths]
+        with self.lock:
+            for curr in list(self.dir_memo):
+                if any(overlaps(curr, x) for x in prefixes):
+                    del self.dir_memo[curr]
+
+    def save(self):
+        with self.lock:
+            tmp_fn = f"{self.cache_fn}.{os.getpid()}.tmp"
+            with open(tmp_fn, 'w') as out_file:
+                json.dump(self.cache, out_file)
+            os.replace(tmp_fn, self.cache_fn)
+
+# One job per key of a stage, with the paths and command filled in
+def make_jobs(stage, vals, cfg):
+    budget = cfg['cores']
+    jobs = []
+
+    for key in stage_keys(stage, vals):
+        cores = min(stage['cores'], budget)
+        job_vals = dict(vals, cores = cores)
+        if key is not None:
+            job_vals['key'] = key
+
+        name = stage['name'] if key is None else f"{stage['name']}[{key}]"
+        optional = [fill(x, job_vals) for x in stage['optional_outputs']]
+        jobs.append({'name'     : name,
+                     'stage'    : stage['name'],
+                     'key'      : key,
+                     'cmd'      : fill(stage['cmd'], job_vals),
+                     'cwd'      : fill(stage['cwd'], job_vals),
+                     'inputs'   : [fill(x, job_vals) for x in stage['inputs']],
+                     'outputs'  : [fill(x, job_vals) for x in stage['outputs']] + optional,
+                     'optional' : optional,
+                     'cores'    : cores,
+                     'clean'    : stage['clean'],
+                     'state_fn' : f"{cfg['state_dir']}/jobs/{stage['name']}/{safe_key(key)}.json",
+                     'log_fn'   : f"{cfg['state_dir']}/logs/{stage['name']}/{safe_key(key)}.log"})
+
+    return jobs
+
+# Outputs a job should have written but didn't, optional ones aside (an
+# optional glob with no matches shows up under the pattern itself)
+def missing_outputs(job, out_hashes):
+    return [x for x, y in out_hashes.items() if (y is None) and (x not in job['optional'])]
+
+def load_state(state_fn):
+    if not os.path.exists(state_fn):
+        return {}
+
+    with open(state_fn, 'r') as in_file:
+        return json.load(in_file)
+
+def save_state(state_fn, state):
+    os.makedirs(os.path.dirname(state_fn), exist_ok = True)
+
+    tmp_fn = f"{state_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, 'w') as out_file:
+        json.dump(state, out_file, indent = 1)
+
+    os.replace(tmp_fn, state_fn)
+
+# Signature of a job: its command and the contents of its inputs. Returns
+# None and the missing inputs if any aren't there.
+def job_signature(job, hasher):
+    in_hashes = hasher.hashes(job['inputs'])
+    missing = [x for x, y in in_hashes.items() if y is None]
+    if missing:
+        return None, missing
+
+    sig = hashlib.sha1(json.dumps({'cmd' : job['cmd'], 'cwd' : job['cwd'],
+                                   'inputs' : in_hashes}, sort_keys = True).encode())
+
+    return sig.hexdigest(), []
+
+# Did the last successful run have this signature, and are its outputs
+# still what it left behind?
+def up_to_date(job, sig, hasher):
+    state = load_state(job['state_fn'])
+    if (state.get('status') != 'ok') or (state.get('sig') != sig):
+        return False
+
+    out_hashes = hasher.hashes(job['outputs'])
+
+    return (not missing_outputs(job, out_hashes)) and (out_hashes == state.get('outputs'))
+
+def remove_outputs(job):
+    for curr in job['outputs']:
+        for curr_fn in expand(curr):
+            if os.path.isdir(curr_fn):
+                shutil.rmtree(curr_fn)
+            elif os.path.exists(curr_fn):
+                os.remove(curr_fn)
+
+# Run one job's command, output to its log. Runs in a worker thread.
+def run_job(job, env):
+    if job['clean']:
+        remove_outputs(job)
+
+    # Scripts don't all make the directories they write into
+    for curr in job['outputs']:
+        out_dir = fixed_prefix(curr) if GLOB_CHARS.search(curr) else os.path.dirname(curr)
+        os.makedirs(out_dir, exist_ok = True)
+    os.makedirs(os.path.dirname(job['log_fn']), exist_ok = True)
+
+    start = time.time()
+    with open(job['log_fn'], 'w') as log_file:
+        log_file.write(f"{ds()} {job['cmd']}\n")
+        log_file.flush()
+
+        proc = subprocess.Popen(job['cmd'], shell = True, cwd = job['cwd'], env = env,
+                                stdout = log_file, stderr = subprocess.STDOUT)
+        proc.wait()
+
+    return proc.returncode, time.time() - start
+
+def run_pipeline(cfg, vals, stages, deps, order):
+    by_name = {x['name'] : x for x in stages}
+    hasher = HashCache(f"{cfg['state_dir']}/{HASH_CACHE_FN}", cfg['quick_hash'])
+
+    env = dict(os.environ, PATHOGEN_NCD_HOME = vals['HOME'])
+
+    # waiting -> running -> done / failed, or blocked by a failed upstream
+    status = {x : 'waiting' for x in order}
+    left = {}
+    counts = {x : {'run' : 0, 'skipped' : 0, 'failed' : 0} for x in order}
+    ready = deque()
+    futs = {}
+    free = cfg['cores']
+
+    def close_stage(name):
+        status[name] = 'failed' if counts[name]['failed'] else 'done'
+        log(f"{name}: {status[name]} ({counts[name]['run']:,} run, "
+            f"{counts[name]['skipped']:,} up to date, {counts[name]['failed']:,} failed)")
+
+    # Fail a job before it gets to run
+    def fail_job(job, error):
+        counts[job['stage']]['failed'] += 1
+        save_state(job['state_fn'], {'status' : 'failed', 'error' : error, 'ended' : ds()})
+        log(f"{job['name']}: {error}")
+
+    # Start every stage whose upstream stages have all finished
+    def open_stages():
+        for name in order:
+            if status[name] != 'waiting':
+                continue
+
+            if any(status[x] in ['failed', 'blocked'] for x in deps[name]):
+                status[name] = 'blocked'
+                log(f"{name}: not run, upstream failed")
+                continue
+
+            if any(status[x] != 'done' for x in deps[name]):
+                continue
+
+            status[name] = 'running'
+            try:
+                jobs = make_jobs(by_name[name], vals, cfg)
+            except (OSError, ValueError, KeyError) as err:
+                log(f"{name}: could not list keys: {err}")
+                status[name] = 'failed'
+                continue
+
+            to_run = []
+            for job in jobs:
+                sig, missing = job_signature(job, hasher)
+                if sig is None:
+                    fail_job(job, f"missing inputs {missing}")
+                elif (name not in cfg['force']) and up_to_date(job, sig, hasher):
+                    counts[name]['skipped'] += 1
+                else:
+                    job['sig'] = sig
+                    to_run.append(job)
+
+            left[name] = len(to_run)
+            ready.extend(to_run)
+            log(f"{name}: {len(jobs):,} job(s), {len(to_run):,} to run")
+
+            if not to_run:
+                close_stage(name)
+
+    with ThreadPoolExecutor(cfg['cores']) as pool:
+        while True:
+            open_stages()
+
+            # Start what fits in the core budget, smaller jobs can go ahead
+            # of a big one that's waiting on cores
+            for job in list(ready):
+                if job['cores'] <= free:
+                    ready.remove(job)
+                    free -= job['cores']
+                    log(f"{job['name']}: started ({job['cores']} core(s))")
+                    futs[pool.submit(run_job, job, env)] = job
+
+            if not futs:
+                break
+
+            done, _ = wait(list(futs), return_when = FIRST_COMPLETED)
+
+            for curr_fut in done:
+                job = futs.pop(curr_fut)
+                free += job['cores']
+                left[job['stage']] -= 1
+                hasher.forget(job['outputs'])
+
+                err = curr_fut.exception()
+                rc, wall = (None, 0) if err else curr_fut.result()
+                out_hashes = hasher.hashes(job['outputs']) if rc == 0 else {}
+                missing = missing_outputs(job, out_hashes)
+
+                if rc == 0 and not missing:
+                    counts[job['stage']]['run'] += 1
+                    save_state(job['state_fn'], {'status' : 'ok', 'sig' : job['sig'],
+                                                 'outputs' : out_hashes, 'cmd' : job['cmd'],
+                                                 'wall_s' : round(wall, 3), 'ended' : ds()})
+                    log(f"{job['name']}: done in {wall:,.1f}s")
+                else:
+                    if err is not None:
+                        error = f"could not run: {err}"
+                    elif rc != 0:
+                        error = f"exit code {rc}, see {job['log_fn']}"
+                    else:
+                        error = f"did not write {missing}"
+
+                    counts[job['stage']]['failed'] += 1
+                    save_state(job['state_fn'], {'status' : 'failed', 'error' : error,
+                                                 'cmd' : job['cmd'], 'wall_s' : round(wall, 3),
+                                                 'ended' : ds()})
+                    log(f"{job['name']}: failed, {error}")
+
+                if left[job['stage']] == 0:
+                    close_stage(job['stage'])
+
+            hasher.save()
+
+    hasher.save()
+
+    return status, counts
+
+# What would run, without running anything. Stages downstream of ones with
+# work to do are listed as waiting on them since their inputs will change.
+def dry_run(cfg, vals, stages, deps, order):
+    by_name = {x['name'] : x for x in stages}
+    hasher = HashCache(f"{cfg['state_dir']}/{HASH_CACHE_FN}", cfg['quick_hash'])
+    dirty = set()
+
+    for name in order:
+        ups = sorted(x for x in deps[name] if x in dirty)
+        if ups:
+            dirty.add(name)
+            print(f"{name:<32} run after {', '.join(ups)}")
+            continue
+
+        try:
+            jobs = make_jobs(by_name[name], vals, cfg)
+        except (OSError, ValueError, KeyError) as err:
+            dirty.add(name)
+            print(f"{name:<32} can't list keys yet ({err})")
+            continue
+
+        n_run = n_missing = 0
+        for job in jobs:
+            sig, missing = job_signature(job, hasher)
+            if sig is None:
+                n_missing += 1
+            elif (name in cfg['force']) or not up_to_date(job, sig, hasher):
+                n_run += 1
+
+        if n_run or n_missing:
+            dirty.add(name)
+
+        print(f"{name:<32} {len(jobs):>7,} job(s) {n_run:>7,} to run {len(jobs) - n_run - n_missing:>7,} "
+              f"up to date" + (f" {n_missing:,} missing inputs" if n_missing else ''))
+
+    hasher.save()
+
+def list_stages(vals, stages, deps, order):
+    by_name = {x['name'] : x for x in stages}
+
+    for name in order:
+        stage = by_name[name]
+        keys = stage['keys']
+        if keys is None:
+            kind = ''
+        elif isinstance(keys, (list, tuple)):
+            kind = f"  [{len(keys)} keys]"
+        elif isinstance(keys, str):
+            kind = f"  [keys: {fill(keys, vals)}]"
+        else:
+            kind = f"  [keys: {' '.join(filter(None, [fill(keys['file'], vals), keys.get('col')]))}]"
+
+        print(f"{name}{kind}  cores={stage['cores']}")
+        print(f"    after: {', '.join(sorted(deps[name])) or '-'}")
+        print(f"    cmd:   {fill(stage['cmd'], dict(vals, cores = stage['cores']))}")
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run the pipeline, skipping stages whose inputs have not changed')
+    parser.add_argument('--pipeline', default = DEF_PIPELINE, help = 'Pipeline definition (python file)')
+    parser.add_argument('--cores', type = int, default = os.cpu_count(), help = 'Cores to share between jobs')
+    parser.add_argument('--targets', nargs = '+', default = None,
+                        help = 'Stages to bring up to date (and what they need), default all')
+    parser.add_argument('--only', action = 'store_true',
+                        help = "Just the --targets, take upstream stages' outputs as they are")
+    parser.add_argument('--force', nargs = '+', default = [], help = 'Re-run these stages regardless')
+    parser.add_argument('--state_dir', default = None,
+                        help = 'Job state, hash cache and logs (default: HOME/pipeline_state)')
+    parser.add_argument('--quick_hash', action = 'store_true',
+                        help = 'Hash size, mtime and the ends of files instead of all of them')
+    parser.add_argument('--dry_run', action = 'store_true', help = 'Show what would run')
+    parser.add_argument('--list', action = 'store_true', help = 'List the stages and exit')
+    args = vars(parser.parse_args())
+
+    vals, stages = load_pipeline(args['pipeline'])
+    deps = build_deps(stages, vals)
+    order = topo_order(stages, deps)
+
+    unknown = [x for x in (args['targets'] or []) + args['force'] if x not in deps]
+    if unknown:
+        parser.error(f"Unknown stages: {unknown}")
+
+    if args['targets'] is not None:
+        keep = set(args['targets']) if args['only'] else upstream(args['targets'], deps)
+        order = [x for x in order if x in keep]
+        deps = {x : deps[x] & keep for x in order}
+
+    if args['list']:
+        list_stages(vals, stages, deps, order)
+        return
+
+    cfg = dict(args, state_dir = args['state_dir'] or f"{vals['HOME']}/pipeline_state",
+               cores = max(1, args['cores']), force = set(args['force']))
+    os.makedirs(cfg['state_dir'], exist_ok = True)
+
+    if args['dry_run']:
+        dry_run(cfg, vals, stages, deps, order)
+        return
+
+    log(f"{len(order)} stage(s), {cfg['cores']} core(s), state in {cfg['state_dir']}")
+    status, counts = run_pipeline(cfg, vals, stages, deps, order)
+
+    n_run = sum(x['run'] for x in counts.values())
+    n_skip = sum(x['skipped'] for x in counts.values())
+    bad = [x for x in order if status[x] != 'done']
+    log(f"Finished: {n_run:,} job(s) run, {n_skip:,} up to date"
+        + (f", not done: {bad}" if bad else ''))
+
+    if bad:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+# Name:     run_ledger_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Pipeline wide run ledger: one SQLite row per stage invocation with when
+#   and where it ran, its parameters, fingerprints of its input files, wall
+#   and CPU time, peak RSS, rows in/out, what it wrote and how it ended. So
+#   we can see throughput trends and catch regressions across data refreshes
+#   instead of digging through each script's own log files.
+#
+#   The ledger is opt-in: nothing is recorded unless PATHOGEN_NCD_LEDGER
+#   points at the SQLite file (created on first use). The database runs in
+#   WAL mode with a busy timeout so array jobs can write to it at once.
+#
+#   A run's row is written when it starts (status 'running') and filled in
+#   when it finishes, so jobs that were killed show up too. Python scripts
+#   that don't call finish() are closed off at exit ('failed' with the
+#   error if an exception got out, otherwise 'exited').
+#
+#   Input fingerprints are size, mtime and a SHA1 of the first and last
+#   64 KB (--full_hash / full_hash = True hashes the whole file).
+#
+#   Python:
+#       from run_ledger_pub import start_run
+#       run = start_run('tnx_icd_gen_pairs', key = curr_icd, params = args,
+#                       inputs = [curr_fn, lab_dir])
+#       ...
+#       run.finish(rows_in = n_in, rows_out = n_out, outputs = [pair_dir])
+#
+#   R / shell (the CLI reads CPU time and peak RSS of --pid from /proc):
+#       run_id=$(python run_ledger_pub.py start --stage ukb_icd_analysis \
+#                    --pid $$ --input cov_dat.csv dis_dat.csv)
+#       python run_ledger_pub.py finish $run_id --rows_out 50715 --output res.csv
+#       # or have the ledger run and measure the whole command
+#       python run_ledger_pub.py wrap --stage ukb_icd_analysis -- Rscript ukb_icd_analysis_pub.R
+#
+#   Reports:
+#       python run_ledger_pub.py report --stage tnx_icd_gen_pairs --by commit
+#       python run_ledger_pub.py runs --status failed --limit 20
+#
+
+import argparse
+import atexit
+import getpass
+import hashlib
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+LEDGER_ENV = 'PATHOGEN_NCD_LEDGER'
+
+# Bytes hashed from each end of a file for its quick fingerprint
+FP_BLOCK = 1 << 16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage       TEXT NOT NULL,
+    run_key     TEXT,
+    status      TEXT NOT NULL,
+    exit_code   INTEGER,
+    error       TEXT,
+    started_at  TEXT NOT NULL,
+    ended_at    TEXT,
+    wall_s      REAL,
+    cpu_user_s  REAL,
+    cpu_sys_s   REAL,
+    peak_rss_mb REAL,
+    rows_in     INTEGER,
+    rows_out    INTEGER,
+    bytes_out   INTEGER,
+    params      TEXT,
+    cmd         TEXT,
+    host        TEXT,
+    user        TEXT,
+    pid         INTEGER,
+    git_commit  TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_stage ON runs (stage, started_at);
+
+CREATE TABLE IF NOT EXISTS run_files (
+    run_id      INTEGER NOT NULL REFERENCES runs (run_id),
+    role        TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER,
+    mtime_ns    INTEGER,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS run_files_run ON run_files (run_id);
+CREATE INDEX IF NOT EXISTS run_files_fp ON run_files (fingerprint);
+"""
+
+RUN_COLS = ['run_id', 'stage', 'run_key', 'status', 'exit_code', 'started_at',
+            'wall_s', 'cpu_user_s', 'cpu_sys_s', 'peak_rss_mb', 'rows_in',
+            'rows_out', 'bytes_out', 'host', 'git_commit']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+def now_str():
+    return datetime.now().isoformat(timespec = 'seconds')
+
+def git_commit(path):
+    try:
+        out = subprocess.run(['git', '-C', path, 'rev-parse', '--short', 'HEAD'],
+                             capture_output = True, text = True, check = True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def connect(db_fn):
+    db_dir = os.path.dirname(os.path.abspath(db_fn))
+    os.makedirs(db_dir, exist_ok = True)
+
+    con = sqlite3.connect(db_fn, timeout = 60)
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('PRAGMA busy_timeout = 60000')
+    con.executescript(SCHEMA)
+
+    return con
+
+# Fingerprint of a file: size, mtime and a hash of its ends (or all of it)
+def fingerprint(path, full_hash = False):
+    st = os.stat(path)
+    sha = hashlib.sha1()
+
+    with open(path, 'rb') as in_file:
+        if full_hash or (st.st_size <= 2 * FP_BLOCK):
+            for block in iter(lambda: in_file.read(1 << 20), b''):
+                sha.update(block)
+        else:
+            sha.update(in_file.read(FP_BLOCK))
+            in_file.seek(-FP_BLOCK, os.SEEK_END)
+            sha.update(in_file.read(FP_BLOCK))
+
+    sha.update(f"{st.st_size}:{'' if full_hash else st.st_mtime_ns}".encode())
+
+    return st.st_size, st.st_mtime_ns, sha.hexdigest()
+
+# Rows for run_files; directories are listed one file at a time
+def file_rows(paths, role, fp = True, full_hash = False):
+    rows = []
+    for curr_path in paths or []:
+        if os.path.isdir(curr_path):
+            sub = sorted(os.path.join(root, x) for root, _, files in os.walk(curr_path)
+                         for x in files)
+        else:
+            sub = [curr_path]
+
+        for curr_fn in sub:
+            if not os.path.isfile(curr_fn):
+                rows.append((role, os.path.abspath(curr_fn), None, None, None))
+            elif fp:
+                rows.append((role, os.path.abspath(curr_fn)) + fingerprint(curr_fn, full_hash))
+            else:
+                st = os.stat(curr_fn)
+                rows.append((role, os.path.abspath(curr_fn), st.st_size, st.st_mtime_ns, None))
+
+    return rows
+
+# CPU seconds and peak RSS (MB) of another process on this host, from /proc
+def proc_usage(pid):
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as in_file:
+            fields = in_file.read().rsplit(')', 1)[1].split()
+        # utime, stime, then the same for its waited-for children
+        tick = os.sysconf('SC_CLK_TCK')
+        user_s = (int(fields[11]) + int(fields[13])) / tick
+        sys_s = (int(fields[12]) + int(fields[14])) / tick
+
+        hwm = None
+        with open(f"/proc/{pid}/status", 'r') as in_file:
+            for line in in_file:
+                if line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1]) / 1024
+
+        return user_s, sys_s, hwm
+    except (OSError, IndexError, ValueError):
+        return None, None, None
+
+def usage_self():
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return (self_ru.ru_utime + child_ru.ru_utime, self_ru.ru_stime + child_ru.ru_stime,
+            max(self_ru.ru_maxrss, child_ru.ru_maxrss) / 1024)
+
+############################################
+#                                          #
+#               Ledger                     #
+#                                          #
+############################################
+
+class Run:
+
+    def __init__(self, db_fn, stage, key = None, params = None, inputs = None,
+                 cmd = None, pid = None, full_hash = False, track_self = True):
+        self.db_fn = db_fn
+        self.pid = pid or os.getpid()
+        self.track_self = track_self
+        self.done = False
+        self.rows_in = None
+        self.rows_out = None
+
+        self.start = time.time()
+        self.cpu0 = usage_self()[:2] if track_self else (0, 0)
+
+        if cmd is None:
+            cmd = ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:])
+
+        code_dir = os.path.dirname(os.path.abspath(sys.argv[0] or '.'))
+
+        con = connect(db_fn)
+        with con:
+            cur = con.execute(
+                'INSERT INTO runs (stage, run_key, status, started_at, params, cmd, host, '
+                'user, pid, git_commit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (stage, key, 'running', now_str(), json.dumps(params or {}, default = str),
+                 cmd, platform.node(), getpass.getuser(), self.pid, git_commit(code_dir)))
+            self.run_id = cur.lastrowid
+            con.executemany('INSERT INTO run_files VALUES (?, ?, ?, ?, ?, ?)',
+                            [(self.run_id,) + x for x in file_rows(inputs, 'in', True, full_hash)])
+        con.close()
+
+    def finish(self, status = 'ok', rows_in = None, rows_out = None, outputs = None,
+               exit_code = None, error = None, wall_s = None, cpu = None, peak_rss_mb = None):
+        if self.done:
+            return
+        self.done = True
+
+        if wall_s is None:
+            wall_s = time.time() - self.start
+
+        if cpu is None:
+            if self.track_self:
+                user_s, sys_s, peak = usage_self()
+                cpu = (user_s - self.cpu0[0], sys_s - self.cpu0[1])
+            else:
+                user_s, sys_s, peak = proc_usage(self.pid)
+                cpu = (user_s, sys_s)
+            peak_rss_mb = peak if peak_rss_mb is None else peak_rss_mb
+
+        rows_in = self.rows_in if rows_in is None else rows_in
+        rows_out = self.rows_out if rows_out is None else rows_out
+
+        out_rows = file_rows(outputs, 'out', fp = False)
+        bytes_out = sum(x[2] or 0 for x in out_rows) if outputs else None
+
+        con = connect(self.db_fn)
+        with con:
+            con.execute(
+                'UPDATE runs SET status = ?, exit_code = ?, error = ?, ended_at = ?, wall_s = ?, '
+                'cpu_user_s = ?, cpu_sys_s = ?, peak_rss_mb = ?, rows_in = ?, rows_out = ?, '
+                'bytes_out = ? WHERE run_id = ?',
+                (status, exit_code, error, now_str(), round(wall_s, 3),
+                 None if cpu[0] is None else round(cpu[0], 3),
+                 None if cpu[1] is None else round(cpu[1], 3),
+                 None if peak_rss_mb is None else round(peak_rss_mb, 1),
+                 rows_in, rows_out, bytes_out, self.run_id))
+            con.executemany('INSERT INTO run_files VALUES (?, ?, ?, ?, ?, ?)',
+                            [(self.run_id,) + x for x in out_rows])
+        con.close()
+
+# Stand in when the ledger is off, so scripts can call it unconditionally
+class NullRun:
+    run_id = None
+    rows_in = None
+    rows_out = None
+
+    def finish(self, *args, **kwargs):
+        pass
+
+_LAST_ERROR = []
+
+def _excepthook(exc_type, exc, tb):
+    _LAST_ERROR.append(f"{exc_type.__name__}: {exc}")
+    sys.__excepthook__(exc_type, exc, tb)
+
+# Record the start of a run of `stage` in the ledger named by
+# PATHOGEN_NCD_LEDGER (or db_fn). Returns a NullRun if the ledger is off.
+# Runs not finished by the time python exits are closed off then.
+def start_run(stage, key = None, params = None, inputs = None, db_fn = None,
+              full_hash = False):
+    db_fn = db_fn or os.environ.get(LEDGER_ENV)
+    if not db_fn:
+        return NullRun()
+
+    run = Run(db_fn, stage, key, params, inputs, full_hash = full_hash)
+
+    if sys.excepthook is sys.__excepthook__:
+        sys.excepthook = _excepthook
+
+    def close_run():
+        if _LAST_ERROR:
+            run.finish('failed', exit_code = 1, error = _LAST_ERROR[-1])
+        else:
+            run.finish('exited')
+    atexit.register(close_run)
+
+    return run
+
+############################################
+#                                          #
+#               Reports                    #
+#                                          #
+############################################
+
+def print_rows(cols, rows):
+    widths = [max([len(str(c))] + [len('' if r[i] is None else str(r[i])) for r in rows])
+              for i, c in enumerate(cols)]
+    print('  '.join(str(c).rjust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        print('  '.join(('' if x is None else str(x)).rjust(w) for x, w in zip(r, widths)))
+
+# Throughput per stage grouped by day, commit or host
+def report(con, stage = None, by = 'day', since = None):
+    group = {'day'    : 'substr(started_at, 1, 10)',
+             'commit' : "coalesce(git_commit, '')",
+             'host'   : 'host'}[by]
+
+    where = ["status != 'running'"]
+    vals = []
+    if stage:
+        where.append('stage = ?')
+        vals.append(stage)
+    if since:
+        where.append('started_at >= ?')
+        vals.append(since)
+
+    sql = (f"SELECT stage, {group} AS grp, count(*) AS runs, "
+           "sum(status != 'ok') AS not_ok, "
+           "round(avg(wall_s), 2) AS mean_wall_s, round(max(wall_s), 2) AS max_wall_s, "
+           "round(avg(cpu_user_s + cpu_sys_s), 2) AS mean_cpu_s, "
+           "round(max(peak_rss_mb), 0) AS max_rss_mb, "
+           "sum(rows_in) AS rows_in, sum(rows_out) AS rows_out, "
+           "round(sum(rows_in) / nullif(sum(wall_s), 0), 1) AS rows_in_per_s "
+           f"FROM runs WHERE {' AND '.join(where)} "
+           "GROUP BY stage, grp ORDER BY stage, min(started_at)")
+    cur = con.execute(sql, vals)
+
+    return [x[0] for x in cur.description], cur.fetchall()
+
+def list_runs(con, stage = None, status = None, limit = 50):
+    where = []
+    vals = []
+    if stage:
+        where.append('stage = ?')
+        vals.append(stage)
+    if status:
+        where.append('status = ?')
+        vals.append(status)
+
+    sql = (f"SELECT {', '.join(RUN_COLS)} FROM runs "
+           f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+           "ORDER BY run_id DESC LIMIT ?")
+    cur = con.execute(sql, vals + [limit])
+
+    return RUN_COLS, cur.fetchall()
+
+############################################
+#                                          #
+#                 CLI                      #
+#                                          #
+############################################
+
+def parse_params(pairs):
+    res = {}
+    for curr in pairs or []:
+        key, _, val = curr.partition('=')
+        res[key] = val
+
+    return res
+
+def cmd_start(args):
+    run = Run(args['db'], args['stage'], args['key'], parse_params(args['param']),
+              args['input'], cmd = args['cmd'], pid = args['pid'],
+              full_hash = args['full_hash'], track_self = False)
+    print(run.run_id)
+
+def cmd_finish(args):
+    con = connect(args['db'])
+    row = con.execute('SELECT started_at, pid FROM runs WHERE run_id = ?',
+                      (args['run_id'],)).fetchone()
+    con.close()
+    if row is None:
+        sys.exit(f"No run {args['run_id']} in {args['db']}")
+
+    # Rebuild enough of the run to close it off
+    run = Run.__new__(Run)
+    run.db_fn = args['db']
+    run.run_id = args['run_id']
+    run.pid = row[1]
+    run.track_self = False
+    run.done = False
+    run.rows_in = None
+    run.rows_out = None
+
+    wall = (datetime.now() - datetime.fromisoformat(row[0])).total_seconds()
+    run.finish(args['status'], args['rows_in'], args['rows_out'], args['output'],
+               args['exit_code'], args['error'], wall_s = wall)
+
+def cmd_wrap(args):
+    cmd = args['command']
+    if cmd and (cmd[0] == '--'):
+        cmd = cmd[1:]
+    if not cmd:
+        sys.exit('Nothing to run, give the command after --')
+
+    run = Run(args['db'], args['stage'], args['key'], parse_params(args['param']),
+              args['input'], cmd = ' '.join(cmd), full_hash = args['full_hash'],
+              track_self = False)
+
+    start = time.time()
+    try:
+        proc = subprocess.Popen(cmd)
+        _, status, usage = os.wait4(proc.pid, 0)
+        rc = os.waitstatus_to_exitcode(status)
+        proc.returncode = rc
+    except OSError as err:
+        run.finish('failed', exit_code = 127, error = str(err), wall_s = time.time() - start,
+                   cpu = (None, None))
+        sys.exit(127)
+
+    run.finish('ok' if rc == 0 else 'failed', args['rows_in'], args['rows_out'],
+               args['output'], exit_code = rc, wall_s = time.time() - start,
+               cpu = (usage.ru_utime, usage.ru_stime), peak_rss_mb = usage.ru_maxrss / 1024)
+    sys.exit(rc)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Pipeline run ledger (SQLite)')
+    parser.add_argument('--db', default = os.environ.get(LEDGER_ENV),
+                        help = f"Ledger file (default: ${LEDGER_ENV})")
+    sub = parser.add_subparsers(dest = 'cmd_name', required = True)
+
+    def run_args(p):
+        p.add_argument('--stage', required = True, help = 'Stage name')
+        p.add_argument('--key', default = None, help = 'What this run is for, e.g. an ICD code')
+        p.add_argument('--param', nargs = '*', default = [], help = 'Parameters as key=value')
+        p.add_argument('--input', nargs = '*', default = [], help = 'Input files/directories')
+        p.add_argument('--full_hash', action = 'store_true', help = 'Hash all of each input')
+
+    start_p = sub.add_parser('start', help = 'Record the start of a run, prints its run id')
+    run_args(start_p)
+    start_p.add_argument('--pid', type = int, default = os.getppid(),
+                         help = 'Process the run is (for CPU and memory at finish)')
+    start_p.add_argument('--cmd', default = None, help = 'Command line to record')
+
+    fin_p = sub.add_parser('finish', help = 'Record the end of a run')
+    fin_p.add_argument('run_id', type = int)
+    fin_p.add_argument('--status', default = 'ok', help = 'ok, failed, ...')
+    fin_p.add_argument('--exit_code', type = int, default = None)
+    fin_p.add_argument('--error', default = None)
+    fin_p.add_argument('--rows_in', type = int, default = None)
+    fin_p.add_argument('--rows_out', type = int, default = None)
+    fin_p.add_argument('--output', nargs = '*', default = [], help = 'Output files/directories')
+
+    wrap_p = sub.add_parser('wrap', help = 'Run a command and record it')
+    run_args(wrap_p)
+    wrap_p.add_argument('--rows_in', type = int, default = None)
+    wrap_p.add_argument('--rows_out', type = int, default = None)
+    wrap_p.add_argument('--output', nargs = '*', default = [], help = 'Output files/directories')
+    wrap_p.add_argument('command', nargs = argparse.REMAINDER, help = '-- command to run')
+
+    rep_p = sub.add_parser('report', help = 'Throughput per stage over time')
+    rep_p.add_argument('--stage', default = None)
+    rep_p.add_argument('--by', default = 'day', choices = ['day', 'commit', 'host'])
+    rep_p.add_argument('--since', default = None, help = 'ISO date, e.g. 2025-01-01')
+
+    runs_p = sub.add_parser('runs', help = 'List recent runs')
+    runs_p.add_argument('--stage', default = None)
+    runs_p.add_argument('--status', default = None)
+    runs_p.add_argument('--limit', type = int, default = 50)
+
+    args = vars(parser.parse_args())
+    if not args['db']:
+        sys.exit(f"No ledger: set {LEDGER_ENV} or pass --db")
+
+    if args['cmd_name'] == 'start':
+        cmd_start(args)
+    elif args['cmd_name'] == 'finish':
+        cmd_finish(args)
+    elif args['cmd_name'] == 'wrap':
+        cmd_wrap(args)
+    else:
+        con = connect(args['db'])
+        if args['cmd_name'] == 'report':
+            cols, rows = report(con, args['stage'], args['by'], args['since'])
+        else:
+            cols, rows = list_runs(con, args['stage'], args['status'], args['limit'])
+        print_rows(cols, rows)
+
+if __name__ == '__main__':
+    main()
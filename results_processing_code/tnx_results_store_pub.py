@@ -0,0 +1,210 @@
+# Name:     tnx_results_store_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   Gathers the per-ICD TNX result files written by tnx_icd_analysis_pub.R
+#   ({icd}_results.tsv) into one typed results store, replacing the
+#   cat / grep -v header / sponge steps at the top of
+#   ukb_tnx_icd_combining_results_pub.ipynb.
+#
+#   Each result file is read with its own header and the columns cast to
+#   fixed types (counts as nullable ints, p-values/ORs/ages as floats, the
+#   rest as strings), then written to the store as its own partition
+#   (Parquet if pyarrow is installed, otherwise a pickle). A manifest keeps
+#   the size/mtime of the file each partition came from, so re-running only
+#   reads the result files that are new or changed since last time, and
+#   partitions whose result file is gone are removed.
+#
+#   load_tnx_results reads every partition back into one frame, optionally
+#   indexed on (icd, org, test_id), i.e. disease, pathogen and LOINC. An empty
+#   store gives an empty frame with the same columns and types.
+#
+#   Usage:
+#       python tnx_results_store_pub.py
+#
+#   In the combining notebook:
+#       from tnx_results_store_pub import load_tnx_results
+#       all_tnx_cat = load_tnx_results(f'{HOME_DIR}/trinetx/results/tnx_all_results')
+#
+
+import argparse
+import glob
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow
+    HAVE_ARROW = True
+except ImportError:
+    HAVE_ARROW = False
+
+HOME_DIR = "/data/pathogen_ncd"
+RES_DIR = f'{HOME_DIR}/trinetx/results/tnx_results_01_17_2023/res'
+STORE_DIR = f'{HOME_DIR}/trinetx/results/tnx_all_results'
+
+MANIFEST_FN = 'manifest.tsv'
+
+# Key identifying a single test: disease, pathogen and lab test (LOINC)
+INDEX_COLS = ['icd', 'org', 'test_id']
+
+# result_cols tnx_icd_analysis_pub.R writes out, in order
+TNX_RES_COLS = ['disease_name', 'icd', 'dis_sex', 'con_str',
+                'num_case', 'num_con', 'n_mixed',
+                'org', 'test', 'anti', 'p_val', 'OR', 'CI', 'model',
+                'mod_version', 'cov_adj', 'ukb_covs', 'cov_ps', 'cov_or',
+                'case_age', 'con_age', 'case_titer', 'con_titer',
+                'case_titer_std', 'con_titer_std', 'case_titer_med',
+                'con_titer_med',
+                'n_con_neg', 'n_con_pos', 'n_case_neg', 'n_case_pos',
+                'glm_warn_msg', 'glm_warn_bool',
+                'proc_time', 'date_time', 'test_id',
+                'test_type', 'var_types', 'mod_method', 'note_str',
+                'org_test_tag']
+
+# Types for the result columns, anything not listed is kept as a string.
+TNX_RES_DTYPES = {'num_case'       : 'Int64',
+                  'num_con'        : 'Int64',
+                  'n_mixed'        : 'Int64',
+                  'p_val'          : 'float64',
+                  'OR'             : 'float64',
+                  'case_age'       : 'float64',
+                  'con_age'        : 'float64',
+                  'case_titer'     : 'float64',
+                  'con_titer'      : 'float64',
+                  'case_titer_std' : 'float64',
+                  'con_titer_std'  : 'float64',
+                  'case_titer_med' : 'float64',
+                  'con_titer_med'  : 'float64',
+                  'n_con_neg'      : 'Int64',
+                  'n_con_pos'      : 'Int64',
+                  'n_case_neg'     : 'Int64',
+                  'n_case_pos'     : 'Int64',
+                  'glm_warn_bool'  : 'boolean',
+                  'proc_time'      : 'float64'}
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Cast a frame of result columns read in as strings to the store's types.
+def cast_res(res):
+    for curr_col in res.columns:
+        curr_type = TNX_RES_DTYPES.get(curr_col, 'string')
+
+        if curr_type == 'boolean':
+            res[curr_col] = res[curr_col].map({'TRUE' : True, 'FALSE' : False}).astype('boolean')
+        elif curr_type == 'string':
+            res[curr_col] = res[curr_col].astype('string')
+        else:
+            res[curr_col] = pd.to_numeric(res[curr_col], errors = 'coerce').astype(curr_type)
+
+    return res
+
+# Read one per-ICD result file and cast it to the store's types.
+def read_res_file(res_fn):
+    return cast_res(pd.read_csv(res_fn, sep = '\t', dtype = str))
+
+# Where a result file's partition lives in the store
+def get_part_fn(store_dir, res_fn):
+    ext = 'parquet' if HAVE_ARROW else 'pkl'
+    stub = os.path.basename(res_fn).replace('.tsv', '')
+
+    return f'{store_dir}/{stub}.{ext}'
+
+def write_part(res, part_fn):
+    tmp_fn = f'{part_fn}.{os.getpid()}.tmp'
+
+    if part_fn.endswith('.parquet'):
+        res.to_parquet(tmp_fn, index = False)
+    else:
+        res.to_pickle(tmp_fn)
+
+    os.replace(tmp_fn, part_fn)
+
+def read_part(part_fn):
+    if part_fn.endswith('.parquet'):
+        return pd.read_parquet(part_fn)
+
+    return pd.read_pickle(part_fn)
+
+def load_manifest(store_dir):
+    manifest_fn = f'{store_dir}/{MANIFEST_FN}'
+    if not os.path.exists(manifest_fn):
+        return pd.DataFrame(columns = ['res_fn', 'size', 'mtime_ns', 'part_fn', 'nrow'])
+
+    return pd.read_csv(manifest_fn, sep = '\t')
+
+# Bring the store up to date with the result files in res_dir: new or changed
+# files are (re)written, partitions of deleted files removed. Returns the
+# number of files read.
+def update_store(res_dir = RES_DIR, store_dir = STORE_DIR):
+    os.makedirs(store_dir, exist_ok = True)
+
+    manifest = load_manifest(store_dir)
+    seen = {row.res_fn : (row.size, row.mtime_ns) for row in manifest.itertuples()}
+
+    res_fns = sorted(glob.glob(f'{res_dir}/*_results.tsv'))
+
+    man_ls = []
+    n_read = 0
+    for curr_fn in res_fns:
+        st = os.stat(curr_fn)
+        part_fn = get_part_fn(store_dir, curr_fn)
+
+        if (seen.get(curr_fn) == (st.st_size, st.st_mtime_ns)) and os.path.exists(part_fn):
+            man_ls.append(manifest.loc[manifest['res_fn'] == curr_fn, :].iloc[0].tolist())
+            continue
+
+        res = read_res_file(curr_fn)
+        write_part(res, part_fn)
+        man_ls.append([curr_fn, st.st_size, st.st_mtime_ns, part_fn, len(res)])
+        n_read += 1
+
+    # Drop partitions for result files that no longer exist
+    gone = manifest.loc[~manifest['res_fn'].isin(res_fns), 'part_fn']
+    for curr_part in gone:
+        if os.path.exists(curr_part):
+            os.remove(curr_part)
+
+    manifest = pd.DataFrame(man_ls, columns = ['res_fn', 'size', 'mtime_ns', 'part_fn', 'nrow'])
+    tmp_fn = f'{store_dir}/{MANIFEST_FN}.{os.getpid()}.tmp'
+    manifest.to_csv(tmp_fn, sep = '\t', index = False)
+    os.replace(tmp_fn, f'{store_dir}/{MANIFEST_FN}')
+
+    return n_read
+
+# Load the whole store. With index = True the frame is indexed (and sorted)
+# on (icd, org, test_id) for fast lookups of a disease/pathogen/LOINC. A new or
+# empty store gives an empty frame with the store's columns and types.
+def load_tnx_results(store_dir = STORE_DIR, index = False):
+    manifest = load_manifest(store_dir)
+
+    if len(manifest) == 0:
+        res = cast_res(pd.DataFrame(columns = TNX_RES_COLS, dtype = str))
+    else:
+        res = pd.concat([read_part(curr_part) for curr_part in manifest['part_fn']],
+                        ignore_index = True)
+
+    if index:
+        res = res.set_index(INDEX_COLS, drop = False).sort_index()
+
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Collect per-ICD TNX results into a typed store')
+    parser.add_argument('--res_dir', default = RES_DIR, help = 'Directory of {icd}_results.tsv files')
+    parser.add_argument('--store_dir', default = STORE_DIR, help = 'Where the results store lives')
+    args = vars(parser.parse_args())
+
+    n_read = update_store(args['res_dir'], args['store_dir'])
+    manifest = load_manifest(args['store_dir'])
+
+    print(f"Read {n_read:,} new or changed result files, store has "
+          f"{len(manifest):,} diseases and {manifest['nrow'].sum():,} results")
+
+if __name__ == '__main__':
+    main()
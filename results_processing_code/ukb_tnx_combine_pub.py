@@ -0,0 +1,399 @@
+# Name:     ukb_tnx_combine_pub.py
+# Author:   Mike Lape
+# Date:     2025
+# Description:
+#
+#   The UKB + TNX combination and replication calling from
+#   ukb_tnx_icd_combining_results_pub.ipynb and
+#   ukb_tnx_phecode_combining_results_pub.ipynb as an importable module with a
+#   small CLI, so combination can be rerun after a data refresh without a
+#   Jupyter kernel.
+#
+#   Same steps as the notebooks, but each one is a single vectorized pass
+#   instead of a loop over diseases or disease-pathogen pairs:
+#       1) power filtering (standards kept in UKB regardless of counts)
+#       2) per-disease BH FDR of the UKB nominal p-values (groupby rank
+#          instead of calling multipletests once per disease)
+#       3) ICD only: collapse UKB from antibody to pathogen (best corr p)
+#       4) TNX limited to the UKB (disease, pathogen, antibody) triples and
+#          joined to UKB with one left join on an integer key built from the
+#          categorical codes of the triple
+#       5) per-disease BH FDR of the TNX p-values
+#       6) collapse to the best TNX test per (disease, pathogen), same
+#          direction as UKB first, with the other tests summarized in
+#          other_test_str / or_flip_tnx_tests
+#       7) replication status (replicated, did_not, could_not,
+#          did_not_attempt) and pair_is_associated
+#
+#   The metadata merges (LPF, antigen dictionary) stay in the notebooks.
+#
+#   Usage:
+#       python ukb_tnx_combine_pub.py --level icd --out icd_org_lev_res.tsv
+#       python ukb_tnx_combine_pub.py --level phecode --out phe_org_lev_res.tsv
+#
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from tnx_results_store_pub import load_tnx_results
+
+HOME_DIR = "/data/pathogen_ncd"
+
+# Statistical power requirements
+MIN_CASE_THRESH = 17
+MIN_TOT_SAMP_THRESH  = 187
+
+# Replication thresholds (per-disease BH corrected p)
+UKB_THRESH = 0.3
+TNX_THRESH = 0.01
+
+# Tier 1 phecodes (see ukb_tnx_phecode_combining_results_pub.ipynb)
+TIER_1_PHECODES = ['053', '054', '070', '070.2', '070.3', '070.9', '071', '078', '079.2']
+
+ORG_TO_TAG_DICT = {'HSV1'           : 'hsv1',
+                   'hsv_1'          : 'hsv1',
+                   'HSV2'           : 'hsv2',
+                   'hsv_2'          : 'hsv2',
+                   'VZV'            : 'vzv',
+                   'EBV'            : 'ebv',
+                   'CMV'            : 'cmv',
+                   'HHV-6'          : 'hhv6',
+                   'hhv_6'          : 'hhv6',
+                   'HHV-7'          : 'hhv7',
+                   'hhv_7'          : 'hhv7',
+                   'KSHV/HHV-8'     : 'kshv',
+                   'HBV'            : 'hbv',
+                   'HCV'            : 'hcv',
+                   'T. gondii'      : 'tox',
+                   'T.gondii'       : 'tox',
+                   't_gond'         : 'tox',
+                   'HTLV-1'         : 'htlv',
+                   'BKV'            : 'bkv',
+                   'JCV'            : 'jcv',
+                   'MCV'            : 'mcv',
+                   'HPV-16'         : 'hpv16',
+                   'hpv_16'         : 'hpv16',
+                   'HPV-18'         : 'hpv18',
+                   'hpv_18'         : 'hpv18',
+                   'C. trachomatis' : 'chlam',
+                   'C.trachomatis'  : 'chlam',
+                   'c_trach'        : 'chlam',
+                   'H.pylori'       : 'hpylori',
+                   'h_pylor'        : 'hpylori',
+                   'HIV'            : 'hiv'}
+
+# Per level settings: disease column, disease description columns, input
+# files and whether UKB is collapsed from antibody to pathogen level.
+LEVEL_INFO = {'icd'     : {'dis_col'     : 'icd',
+                           'desc_cols'   : {'ukb_Disease' : 'disease'},
+                           'ukb_fn'      : f'{HOME_DIR}/results/emp_results_01_17_2023.tsv',
+                           'tnx_fn'      : f'{HOME_DIR}/trinetx/results/tnx_all_results',
+                           'collapse_ukb': True},
+              'phecode' : {'dis_col'     : 'phecode',
+                           'desc_cols'   : {'ukb_Disease_Description' : 'Disease_Description',
+                                            'ukb_Disease_Group' : 'Disease_Group'},
+                           'ukb_fn'      : f'{HOME_DIR}/phecode/ukb/path_analysis/ukb_phecode_results_MCC_of_ONE_2024_10_22_with_std_lev.xlsx',
+                           'tnx_fn'      : f'{HOME_DIR}/phecode/tnx/path_analysis/res/phecode_collected_res_12_5.tsv',
+                           'collapse_ukb': False}}
+
+# Columns describing the TNX test, blanked out for did_not_attempt pairs
+TNX_TEST_COLS = ['tnx_test_type', 'tnx_test_id', 'tnx_test', 'tnx_mod_method',
+                 'tnx_dis_sex', 'tnx_dis_sex_str', 'tnx_num_case', 'tnx_num_con',
+                 'tnx_con_str', 'tnx_n_mixed', 'tnx_per_dis_bh_fdr_corr_p',
+                 'tnx_p_val', 'tnx_OR', 'tnx_glm_warn_msg', 'tnx_glm_warn_bool',
+                 'tnx_model', 'tnx_cov_adj', 'tnx_cov_ps', 'tnx_cov_or', 'tnx_CI',
+                 'tnx_case_age', 'tnx_con_age', 'tnx_case_titer', 'tnx_con_titer',
+                 'tnx_case_titer_std', 'tnx_con_titer_std', 'tnx_case_titer_med',
+                 'tnx_con_titer_med', 'tnx_n_con_neg', 'tnx_n_con_pos',
+                 'tnx_n_case_neg', 'tnx_n_case_pos', 'tnx_log_trans',
+                 'tnx_note_str', 'other_test_str', 'or_flip_tnx_tests']
+
+TNX_INT_COLS = ['tnx_num_case', 'tnx_num_con', 'tnx_n_mixed', 'tnx_n_con_neg',
+                'tnx_n_con_pos', 'tnx_n_case_neg', 'tnx_n_case_pos']
+
+############################################
+#                                          #
+#           Helper Functions               #
+#                                          #
+############################################
+
+# Similar to round, but if the decimal cannot be represented by the number of
+# digits we switch to sci notation with that many digits in the significand.
+def make_small(num, digits):
+    if digits < 1:
+        print("Requires positive number of digits")
+        return
+
+    dig_min_1 = digits - 1
+
+    low_bound = 1 / (10 ** (dig_min_1))
+    up_bound = 10 ** (dig_min_1)
+
+    if ((num < low_bound) | (num > up_bound)):
+        return "{:.{}e}".format(num, dig_min_1)
+
+    return round(num, digits)
+
+# Benjamini-Hochberg adjusted p-values within each group, in one pass: rank
+# within group, p * n / rank, then a running min from the largest p down.
+# Same values as multipletests(method = 'fdr_bh') per group, NaN p-values are
+# left NaN and don't count towards n.
+def bh_by_group(p_vals, groups):
+    df = pd.DataFrame({'p' : np.asarray(p_vals, dtype = float),
+                       'grp' : pd.factorize(np.asarray(groups))[0]})
+    df = df.loc[df['p'].notna(), :].sort_values(['grp', 'p'], kind = 'stable')
+
+    rank = df.groupby('grp').cumcount().to_numpy() + 1
+    n = df.groupby('grp')['p'].transform('size').to_numpy()
+
+    adj = pd.Series(df['p'].to_numpy() * n / rank, index = df.index)
+
+    # Running min from the bottom of each group up
+    adj = adj.iloc[::-1].groupby(df['grp'].iloc[::-1].to_numpy()).cummin().iloc[::-1]
+
+    res = np.full(len(p_vals), np.nan)
+    res[adj.index.to_numpy()] = np.minimum(adj.to_numpy(), 1)
+
+    return res
+
+# Load UKB results for a level and align the pathogen tags.
+def load_ukb(level, ukb_fn):
+    if level == 'icd':
+        ukb = pd.read_csv(ukb_fn, sep = '\t')
+    else:
+        ukb = pd.read_excel(ukb_fn, dtype = {'phecode' : str})
+        ukb = ukb.rename(columns = {'organism' : 'org', 'Phecode' : 'phecode',
+                                    'Antigen' : 'anti'})
+
+    ukb['num_tot_samples'] = ukb['nCase'].astype(int) + ukb['nControl'].astype(int)
+
+    # Fix some weird chars
+    ukb['org'] = ukb['org'].replace({'MCV\xa0' : 'MCV', 'H.\xa0pylori' : 'H.pylori'})
+    ukb['tag'] = ukb['org'].replace(ORG_TO_TAG_DICT)
+
+    return ukb
+
+# Load TNX results for a level (the typed store for ICD if given a directory)
+# and align the pathogen tags / disease codes with UKB.
+def load_tnx(level, tnx_fn):
+    if os.path.isdir(tnx_fn):
+        tnx = load_tnx_results(tnx_fn)
+    else:
+        tnx = pd.read_csv(tnx_fn, sep = '\t', dtype = {'phecode' : str})
+        tnx = tnx.loc[tnx['disease_name'] != 'disease_name', :] if 'disease_name' in tnx.columns else tnx
+
+    tnx['num_case'] = tnx['num_case'].astype(int)
+    tnx['num_con'] = tnx['num_con'].astype(int)
+    tnx['num_tot_samples'] = tnx['num_case'] + tnx['num_con']
+    tnx['p_val'] = tnx['p_val'].astype(float)
+
+    if level == 'icd':
+        # US uses B20 for HIV, UK uses B24
+        tnx['icd'] = tnx['icd'].replace({'B20' : 'B24'})
+        tnx['tag'] = tnx['org']
+    else:
+        tnx['org'] = tnx['org'].replace({'MCV\xa0' : 'MCV', 'H.\xa0pylori' : 'H.pylori'})
+        tnx['tag'] = tnx['org'].replace(ORG_TO_TAG_DICT)
+
+    return tnx
+
+# Standards (ICD A/B chapters, Tier 1 phecodes) are exempt from the UKB power
+# filter, but not from TNX's.
+def power_filter(ukb, tnx, level):
+    ukb_ok = ((ukb['nCase'] >= MIN_CASE_THRESH) &
+              (ukb['num_tot_samples'] >= MIN_TOT_SAMP_THRESH)).to_numpy()
+    if level == 'icd':
+        ukb_std = ukb['ICD10_Cat'].isin(['A', 'B']).to_numpy()
+    else:
+        ukb_std = ukb['phecode'].isin(TIER_1_PHECODES).to_numpy()
+
+    tnx_ok = ((tnx['num_case'] >= MIN_CASE_THRESH) &
+              (tnx['num_tot_samples'] >= MIN_TOT_SAMP_THRESH)).to_numpy()
+
+    return ukb.loc[ukb_std | ukb_ok, :], tnx.loc[tnx_ok, :]
+
+# Integer key for each (disease, tag, anti) triple, built from categorical
+# codes shared between UKB and TNX. TNX rows with a triple UKB doesn't have
+# get -1.
+def pair_keys(ukb, tnx, dis_col):
+    key_cols = [dis_col, 'tag', 'anti']
+
+    ukb_codes = []
+    tnx_codes = []
+    for curr_col in key_cols:
+        cats = pd.Index(pd.unique(ukb[curr_col].astype(str)))
+        ukb_codes.append(pd.Categorical(ukb[curr_col].astype(str), categories = cats).codes)
+        tnx_codes.append(pd.Categorical(tnx[curr_col].astype(str), categories = cats).codes)
+
+    ukb_key = pd.MultiIndex.from_arrays(ukb_codes)
+    tnx_key = ukb_key.get_indexer(pd.MultiIndex.from_arrays(tnx_codes))
+
+    # Anything with a code not seen in UKB (-1) can't match
+    tnx_key[np.any(np.column_stack(tnx_codes) < 0, axis = 1)] = -1
+
+    return np.arange(len(ukb)), tnx_key
+
+# One line summary of a TNX test for other_test_str / or_flip_tnx_tests
+def test_desc(combo):
+    return [f"{r.tnx_test_id} [{r.tnx_test}, {r.tnx_mod_method}]:  nCase: {r.tnx_num_case} | "
+            f"nCon: {r.tnx_num_con}, corr p-val: {make_small(r.tnx_per_dis_bh_fdr_corr_p, 3)}, "
+            f"uncorr p-val: {make_small(r.tnx_p_val, 3)}, OR: {make_small(r.tnx_OR, 3)} | "
+            f"model: {r.tnx_model}, glm_warn [{r.tnx_glm_warn_bool}]: {r.tnx_glm_warn_msg} "
+            f"log10 trans: {r.tnx_log_trans} | Notes: {r.tnx_note_str}"
+            for r in combo.loc[:, ['tnx_test_id', 'tnx_test', 'tnx_mod_method',
+                                   'tnx_num_case', 'tnx_num_con',
+                                   'tnx_per_dis_bh_fdr_corr_p', 'tnx_p_val', 'tnx_OR',
+                                   'tnx_model', 'tnx_glm_warn_bool', 'tnx_glm_warn_msg',
+                                   'tnx_log_trans', 'tnx_note_str']].itertuples()]
+
+# Collapse combo to one row per (disease, pathogen): the most significant TNX
+# test in the same direction as UKB, or the most significant opposite one if
+# there are none. other_test_str holds the other same direction tests (all of
+# the opposite ones when the best is opposite) and or_flip_tnx_tests the
+# opposite direction tests (less the best one when it is opposite).
+def collapse_best(combo, dis_col):
+    has_tnx = combo['tnx_test_id'].notna().to_numpy()
+    same_dir = has_tnx & (combo['tnx_risk'] == combo['ukb_risk']).to_numpy()
+
+    combo['_has_tnx'] = has_tnx
+    combo['_same'] = same_dir
+    combo['_grp'] = pd.factorize(pd.MultiIndex.from_frame(combo.loc[:, [dis_col, 'org']]))[0]
+    combo = combo.sort_values(['_grp', '_has_tnx', '_same', 'tnx_per_dis_bh_fdr_corr_p'],
+                              ascending = [True, False, False, True], kind = 'stable')
+
+    is_best = ~combo['_grp'].duplicated().to_numpy()
+    best_same = pd.Series(is_best & combo['_same'].to_numpy(), index = combo.index)
+    best_same = best_same.groupby(combo['_grp']).transform('any').to_numpy()
+
+    desc = pd.Series(test_desc(combo), index = combo.index).where(combo['_has_tnx'], '')
+
+    same = combo['_same'].to_numpy()
+    opp = combo['_has_tnx'].to_numpy() & ~same
+
+    # Best is same direction: rest of same -> other, all opposite -> flip
+    # Best is opposite: all opposite -> other, rest of opposite -> flip
+    to_other = np.where(best_same, same & ~is_best, opp)
+    to_flip = np.where(best_same, opp, opp & ~is_best)
+
+    grp = combo['_grp']
+    other = desc[to_other].groupby(grp[to_other]).agg('\n'.join)
+    flip = desc[to_flip].groupby(grp[to_flip]).agg('\n'.join)
+
+    fin = combo.loc[is_best, :].copy()
+    fin['other_test_str'] = fin['_grp'].map(other).fillna('')
+    fin['or_flip_tnx_tests'] = fin['_grp'].map(flip).fillna('')
+
+    return fin.drop(columns = ['_has_tnx', '_same', '_grp'])
+
+# Replication status per (disease, pathogen), later rules win like the
+# sequential .loc assignments in the notebooks.
+def call_replication(fin, ukb_thresh = UKB_THRESH, tnx_thresh = TNX_THRESH):
+    ukb_sig = (fin['ukb_per_dis_bh_fdr_corr_nom_p'] < ukb_thresh).to_numpy()
+    tnx_p = fin['tnx_per_dis_bh_fdr_corr_p'].to_numpy(dtype = float)
+    flip = (fin['ukb_risk'] != fin['tnx_risk']).to_numpy()
+
+    did_not = ukb_sig & ((tnx_p >= tnx_thresh) | ((tnx_p < tnx_thresh) & flip))
+    could_not = ukb_sig & fin['tnx_p_val'].isna().to_numpy()
+    replicated = ukb_sig & (tnx_p < tnx_thresh)
+
+    fin['rep_stat'] = np.select([did_not, could_not, replicated],
+                                ['did_not', 'could_not', 'replicated'],
+                                default = 'did_not_attempt')
+
+    fin['std_lev'] = fin['std_lev'].replace({'true_neg' : 'exp_neg',
+                                             'Gold'     : 'Tier 1',
+                                             'Silver'   : 'Tier 2',
+                                             'unk'      : 'unk'})
+
+    fin['pair_is_associated'] = np.where(fin['rep_stat'] == 'replicated', 'Yes', 'No')
+
+    # Set all did not attempt TNX stuff to NA
+    not_attempt = (fin['rep_stat'] == 'did_not_attempt').to_numpy()
+    for curr_col in [x for x in TNX_TEST_COLS if x in fin.columns]:
+        fin[curr_col] = fin[curr_col].mask(not_attempt)
+
+    return fin
+
+# Full combination for a level, from loaded UKB and TNX results to the
+# pathogen level replication table.
+def combine(ukb, tnx, level):
+    info = LEVEL_INFO[level]
+    dis_col = info['dis_col']
+
+    ukb, tnx = power_filter(ukb, tnx, level)
+
+    # Per-disease FDR corrected UKB nominal p-value
+    ukb = ukb.copy()
+    ukb['per_dis_bh_fdr_corr_nom_p'] = bh_by_group(ukb['p_val'], ukb[dis_col])
+
+    # Collapse from antibody to pathogen level (keeping most significant)
+    if info['collapse_ukb']:
+        ukb = ukb.sort_values([dis_col, 'org', 'per_dis_bh_fdr_corr_nom_p'], kind = 'stable')
+        ukb = ukb.drop_duplicates([dis_col, 'org'], keep = 'first')
+
+    ukb = ukb.reset_index(drop = True)
+
+    # Limit TNX to UKB pairs and BH correct per disease
+    ukb_key, tnx_key = pair_keys(ukb, tnx, dis_col)
+    tnx = tnx.loc[tnx_key >= 0, :].copy()
+    tnx['_key'] = tnx_key[tnx_key >= 0]
+    tnx['per_dis_bh_fdr_corr_p'] = bh_by_group(tnx['p_val'], tnx[dis_col])
+
+    ukb.columns = [f'ukb_{x}' for x in ukb.columns]
+    tnx.columns = [f'tnx_{x}' if x != '_key' else x for x in tnx.columns]
+    ukb['_key'] = ukb_key
+
+    combo = ukb.merge(tnx, how = 'left', on = '_key').drop(columns = ['_key'])
+    del ukb, tnx
+
+    combo = combo.rename(columns = dict(info['desc_cols'],
+                                        **{f'ukb_{dis_col}' : dis_col, 'ukb_tag' : 'org',
+                                           'ukb_anti' : 'anti', 'ukb_std_lev' : 'std_lev'}))
+
+    for curr_col in [x for x in TNX_INT_COLS if x in combo.columns]:
+        combo[curr_col] = pd.to_numeric(combo[curr_col], errors = 'coerce').astype('Int64')
+
+    # Annotate risk
+    combo['ukb_risk'] = combo['ukb_anti_OR'].astype(float) > 1
+    combo['tnx_risk'] = pd.to_numeric(combo['tnx_OR'], errors = 'coerce') > 1
+
+    fin = collapse_best(combo, dis_col)
+    del combo
+
+    fin = fin.sort_values([dis_col, 'org', 'ukb_per_dis_bh_fdr_corr_nom_p'], kind = 'stable')
+    fin = call_replication(fin)
+
+    # Re-org some cols
+    first_cols = list(info['desc_cols'].values()) + [dis_col, 'org', 'anti',
+                  'pair_is_associated', 'std_lev', 'rep_stat']
+    last_cols = ['ukb_risk', 'tnx_risk', 'other_test_str', 'or_flip_tnx_tests']
+    mid_cols = [x for x in fin.columns if x not in first_cols + last_cols]
+
+    return fin.loc[:, first_cols + mid_cols + last_cols].reset_index(drop = True)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Combine UKB and TNX results and call replication')
+    parser.add_argument('--level', choices = list(LEVEL_INFO.keys()), required = True,
+                        help = 'ICD10 or Phecode results')
+    parser.add_argument('--ukb', default = None, help = 'UKB results file')
+    parser.add_argument('--tnx', default = None, help = 'TNX results file or results store')
+    parser.add_argument('--out', required = True, help = 'Output tsv')
+    args = vars(parser.parse_args())
+
+    info = LEVEL_INFO[args['level']]
+    ukb = load_ukb(args['level'], args['ukb'] or info['ukb_fn'])
+    tnx = load_tnx(args['level'], args['tnx'] or info['tnx_fn'])
+
+    print(f"UKB: {len(ukb):,} results | TNX: {len(tnx):,} results")
+
+    res = combine(ukb, tnx, args['level'])
+    res.to_csv(args['out'], sep = '\t', index = False)
+
+    print(f"{len(res):,} disease-pathogen pairs")
+    print(res['rep_stat'].value_counts().to_string())
+
+if __name__ == '__main__':
+    main()